@@ -0,0 +1,39 @@
+"""Token revocation
+
+Revision ID: c41d7e9a2b10
+Revises: 57ee1b505e8f
+Create Date: 2026-10-18 21:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41d7e9a2b10'
+down_revision: Union[str, Sequence[str], None] = '57ee1b505e8f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('token_revocation',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('jti', sa.String(length=64), nullable=True),
+    sa.Column('user_id', sa.String(length=36), nullable=True),
+    sa.Column('revoked_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_token_revocation_jti'), 'token_revocation', ['jti'], unique=False)
+    op.create_index(op.f('ix_token_revocation_revoked_at'), 'token_revocation', ['revoked_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_token_revocation_revoked_at'), table_name='token_revocation')
+    op.drop_index(op.f('ix_token_revocation_jti'), table_name='token_revocation')
+    op.drop_table('token_revocation')
@@ -1,15 +1,21 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, status, WebSocket
+from starlette.requests import HTTPConnection
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime, timedelta
 from typing import Optional
 import os
+import time
+import uuid
 from dotenv import load_dotenv
 from sqlalchemy.orm import Session
 from database import get_db
 import models, schemas
 import crud, schemas
+from cache import principal_cache
+import passwords
+import revocation
 
 load_dotenv()
 
@@ -17,9 +23,7 @@ SECRET_KEY: str = os.getenv("SECRET_KEY") or ""
 if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY environment variable not set")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="users/token")
 
@@ -27,7 +31,7 @@ def get_password_hash(password: str) -> str:
     """
     Hashes a plain password.
     """
-    return pwd_context.hash(password)
+    return passwords.hash_password_sync(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
@@ -43,55 +47,169 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_user_access_token(user: models.User) -> str:
+    """
+    Creates an access token carrying the claims the routes need (id, email, name,
+    flags), so authenticated requests can be served without reading the user table.
+    """
+    return create_access_token(data={
+        "sub": user.email,
+        "uid": str(user.id),
+        "name": user.name,
+        "pic": user.profile_picture,
+        "staff": bool(user.is_staff),
+        "act": bool(user.is_active),
+        "jti": uuid.uuid4().hex,
+        "iat": time.time(),
+    })
+
 def get_user_from_db_by_email(db: Session, email: str):
     """
     Helper function to get a user from the database by email.
     """
     return db.query(models.User).filter(models.User.email == email).first()
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
-    """
-    Retrieves the current user from the database based on the provided JWT token.
-    Raises HTTPException if the token is invalid or the user is not found.
-    Returns the SQLAlchemy User model instance.
-    """
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def decode_token(token: str) -> dict:
+    """
+    Decodes and verifies a JWT, returning its claims.
+    Raises HTTPException if the token is invalid or has no string subject.
+    """
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if email is None or not isinstance(email, str):
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    if not isinstance(payload.get("sub"), str):
+        raise _credentials_exception()
+    return payload
+
+def decode_token_subject(token: str) -> str:
+    """
+    Decodes a JWT and returns its subject (the user's email).
+    Raises HTTPException if the token is invalid.
+    """
+    return decode_token(token)["sub"]
 
+def principal_from_claims(payload: dict) -> Optional[schemas.UserOut]:
+    """
+    Builds the principal from a token created by create_user_access_token.
+    Returns None for older tokens that only carry the subject.
+    """
+    if "uid" not in payload:
+        return None
+    # The claims are signed by us, so validation is skipped.
+    return schemas.UserOut.model_construct(
+        id=payload["uid"],
+        email=payload["sub"],
+        name=payload.get("name", ""),
+        profile_picture=payload.get("pic"),
+        is_staff=bool(payload.get("staff", False)),
+        is_active=bool(payload.get("act", True)),
+    )
+
+def resolve_principal(db: Session, payload: dict) -> schemas.UserOut:
+    """
+    Resolves verified token claims to the public user schema.
+    Tokens with fresh claims are served without touching the user table; revoked
+    tokens are rejected, and tokens whose claims went stale (or legacy tokens)
+    fall back to a cached lookup by email.
+    """
+    if revocation.is_token_revoked(db, payload.get("jti")):
+        raise _credentials_exception()
+    user = None
+    uid = payload.get("uid")
+    if uid and not revocation.revocations.claims_stale(uid, float(payload.get("iat", 0))):
+        user = principal_from_claims(payload)
+    if user is None:
+        email = payload["sub"]
+        user = principal_cache.get(email)
+        if user is None:
+            db_user = get_user_from_db_by_email(db, email=email)
+            if db_user is None:
+                raise _credentials_exception()
+            user = schemas.UserOut.model_validate(db_user)
+            principal_cache.set(email, user)
+    if not user.is_active:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user")
+    return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
+    """
+    Retrieves the current user from the database based on the provided JWT token.
+    Raises HTTPException if the token is invalid or the user is not found.
+    Returns the SQLAlchemy User model instance.
+    """
+    email = decode_token_subject(token)
     user = get_user_from_db_by_email(db, email=email)
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     return user
 
-async def get_current_active_user(
-    current_user: models.User = Depends(get_current_user)
-) -> schemas.UserOut:
+async def get_current_active_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> schemas.UserOut:
     """
     Ensures the user is active and returns the public user schema.
+    See resolve_principal for when the user table is consulted.
     """
-    if not bool(current_user.is_active):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user")
-    return schemas.UserOut.model_validate(current_user)
+    return resolve_principal(db, decode_token(token))
+
+def get_websocket_token(websocket: HTTPConnection) -> Optional[str]:
+    """
+    Reads the access token from the `token` query parameter (browsers cannot set
+    headers on WebSocket or EventSource requests) or from a Bearer Authorization header.
+    """
+    token = websocket.query_params.get("token")
+    if token:
+        return token
+    scheme, _, value = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and value:
+        return value
+    return None
+
+def authenticate_websocket(websocket: WebSocket, db: Session) -> Optional[schemas.UserOut]:
+    """
+    Authenticates a WebSocket handshake once, before the connection is accepted.
+    Returns None when the token is missing, invalid, revoked or inactive.
+    """
+    token = get_websocket_token(websocket)
+    if not token:
+        return None
+    try:
+        return resolve_principal(db, decode_token(token))
+    except HTTPException:
+        return None
+
+def authenticate_event_stream(request: HTTPConnection, db: Session) -> schemas.UserOut:
+    """
+    Authenticates an EventSource request, which carries its token like a WebSocket.
+    Raises 401 when the token is missing or invalid.
+    """
+    token = get_websocket_token(request)
+    if not token:
+        raise _credentials_exception()
+    return resolve_principal(db, decode_token(token))
 
 def verify_password(plain_password, password):
-    return pwd_context.verify(plain_password, password)
+    return passwords.pwd_context.verify(plain_password, password)
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = crud.get_user_by_email(db, email=email)
+async def authenticate_user(db: Session, email: str, password: str):
+    """
+    Verifies the credentials on the password hashing pool.
+    Rehashes the stored password when it was created with a different BCRYPT_ROUNDS.
+    """
+    user = await run_in_threadpool(crud.get_user_by_email, db, email=email)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    verified, new_hash = await passwords.verify_and_update(password, user.password)
+    if not verified:
         return False
+    if new_hash:
+        await run_in_threadpool(crud.update_user_password, db, user, new_hash)
     return user
 
 # async def get_current_active_superuser(
@@ -0,0 +1,145 @@
+"""
+Shared helpers for the benchmark scripts: an embedded SQLite database, an
+in-process uvicorn server, latency summaries and baseline comparison.
+
+Scripts must call use_embedded_db() before importing any application module,
+because database.py creates its engine at import time.
+"""
+import os
+import sys
+import json
+import socket
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT_DIR, "benchmarks", "baselines")
+
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+
+def use_embedded_db(path: Optional[str] = None) -> str:
+    """
+    Points DATABASE_URL at a fresh SQLite file and returns the URL.
+    """
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "bench.db")
+    url = f"sqlite:///{path}"
+    os.environ["DATABASE_URL"] = url
+    return url
+
+
+def create_schema():
+    from database import Base, engine
+    import models  # noqa: F401  registers the tables
+    Base.metadata.create_all(bind=engine)
+
+
+class EmbeddedServer:
+    """
+    Runs the FastAPI app under uvicorn in a background thread on a free local port.
+    """
+    def __init__(self, app, ws: str = "websockets"):
+        import uvicorn
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        config = uvicorn.Config(app, log_level="warning", ws=ws, lifespan="on")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.sock]}, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "EmbeddedServer":
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Embedded server did not start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float], duration: float, errors: int = 0) -> Dict[str, float]:
+    """
+    Summarizes latencies (in seconds) as throughput and p50/p95/p99 in milliseconds.
+    """
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "throughput": round(len(values) / duration, 2) if duration else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+    }
+
+
+def load_baseline(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: Dict):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare_to_baseline(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+    latency_keys=("p50_ms", "p95_ms", "p99_ms"),
+    throughput_keys=("throughput",),
+) -> List[str]:
+    """
+    Returns a description of every metric that regressed by more than `tolerance`
+    (a fraction) relative to the baseline. Latencies regress upwards, throughput downwards.
+    """
+    regressions = []
+    for name, expected in baseline.items():
+        actual = results.get(name)
+        if actual is None:
+            continue
+        for key in latency_keys:
+            if key in expected and expected[key] > 0 and actual.get(key, 0) > expected[key] * (1 + tolerance):
+                regressions.append(f"{name}.{key}: {actual[key]} > baseline {expected[key]}")
+        for key in throughput_keys:
+            if key in expected and expected[key] > 0 and actual.get(key, 0) < expected[key] * (1 - tolerance):
+                regressions.append(f"{name}.{key}: {actual[key]} < baseline {expected[key]}")
+    return regressions
+
+
+def print_table(results: Dict[str, Dict[str, float]], columns=("count", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms")):
+    width = max([len(name) for name in results] + [10])
+    print("  ".join([f"{'name':<{width}}"] + [f"{c:>10}" for c in columns]))
+    for name, row in results.items():
+        print("  ".join([f"{name:<{width}}"] + [f"{row.get(c, ''):>10}" for c in columns]))
@@ -0,0 +1,376 @@
+"""
+Microbenchmarks for crud.py at realistic data scales.
+
+Bulk-loads a synthetic dataset (users, communities with a skewed membership
+distribution, conversations, one-to-one and community messages, replies and
+pending conversation requests), then times each crud function with a fresh
+Session per call and counts the SQL statements it issues.
+
+    python -m benchmarks.crud_bench --scales small,medium
+    python -m benchmarks.crud_bench --scales full --database-url mysql+mysqlconnector://...
+
+The "full" scale is 10k communities, 1M memberships and 10M messages; loading
+it into SQLite takes a while, so the smaller scales are the default. Running
+several scales prints how much each function slows down as data grows.
+"""
+import argparse
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from benchmarks import common
+
+DEFAULT_BASELINE = f"{common.BASELINE_DIR}/crud_small.json"
+
+FULL_SCALE = {
+    "users": 100_000,
+    "communities": 10_000,
+    "memberships": 1_000_000,
+    "conversations": 200_000,
+    "messages": 5_000_000,
+    "community_messages": 5_000_000,
+    "replies": 1_000_000,
+    "requests": 50_000,
+}
+
+SCALES = {
+    "small": {key: max(10, value // 1000) for key, value in FULL_SCALE.items()},
+    "medium": {key: max(10, value // 100) for key, value in FULL_SCALE.items()},
+    "large": {key: max(10, value // 10) for key, value in FULL_SCALE.items()},
+    "full": dict(FULL_SCALE),
+}
+
+CHUNK_SIZE = 10_000
+
+
+class Dataset:
+    """
+    Ids of the seeded rows, used to pick realistic arguments for each call.
+    """
+    def __init__(self):
+        self.users: List[str] = []
+        self.emails: List[str] = []
+        self.communities: List[str] = []
+        self.members: Dict[str, List[str]] = {}
+        self.memberships: List[str] = []
+        self.conversations: List[str] = []
+        self.messages: List[str] = []
+        self.community_messages: List[str] = []
+        self.replies: List[str] = []
+        self.requests: List[str] = []
+
+
+def _insert(connection, table, rows: List[Dict]):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def _stream_insert(connection, table, count: int, make_row: Callable[[int], Dict], ids: List[str]):
+    """
+    Inserts `count` generated rows in chunks without holding them all in memory.
+    """
+    chunk = []
+    for i in range(count):
+        row = make_row(i)
+        ids.append(row["id"])
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            connection.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        connection.execute(table.insert(), chunk)
+
+
+def load_dataset(engine, scale: Dict[str, int], rng: random.Random) -> Dataset:
+    import models
+    data = Dataset()
+    now = datetime.utcnow()
+    new_id = lambda: str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    stamp = lambda: now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+
+    with engine.begin() as connection:
+        _stream_insert(connection, models.User.__table__, scale["users"], lambda i: {
+            "id": new_id(), "email": f"user{i}@example.com", "name": f"User {i}",
+            "password": None, "profile_picture": None, "is_staff": False, "is_active": True,
+        }, data.users)
+        data.emails = [f"user{i}@example.com" for i in range(scale["users"])]
+
+        _stream_insert(connection, models.Community.__table__, scale["communities"], lambda i: {
+            "id": new_id(), "name": f"community {i}", "description": "synthetic",
+            "created_at": stamp(), "updated_at": now,
+        }, data.communities)
+
+        # Zipf-like membership sizes so a few communities are very popular.
+        weights = [1.0 / (rank + 1) ** 0.8 for rank in range(len(data.communities))]
+        total_weight = sum(weights)
+        membership_rows = []
+        for community_id, weight in zip(data.communities, weights):
+            size = min(len(data.users), max(1, int(scale["memberships"] * weight / total_weight)))
+            members = rng.sample(data.users, size)
+            data.members[community_id] = members
+            for user_id in members:
+                membership_rows.append({
+                    "id": new_id(), "community_id": community_id, "user_id": user_id,
+                    "joined_at": stamp(), "is_admin": False,
+                })
+                data.memberships.append(membership_rows[-1]["id"])
+            if len(membership_rows) >= CHUNK_SIZE:
+                _insert(connection, models.Membership.__table__, membership_rows)
+                membership_rows = []
+        _insert(connection, models.Membership.__table__, membership_rows)
+
+        conversation_pairs = {}
+        def make_conversation(i):
+            user1, user2 = rng.sample(data.users, 2)
+            row = {
+                "id": new_id(), "user1_id": user1, "user2_id": user2, "last_message": "hi",
+                "last_message_time": now, "created_at": stamp(), "updated_at": now,
+            }
+            conversation_pairs[row["id"]] = (user1, user2)
+            return row
+        _stream_insert(connection, models.Conversation.__table__, scale["conversations"], make_conversation, data.conversations)
+
+        def make_message(i):
+            conversation_id = rng.choice(data.conversations)
+            return {
+                "id": new_id(), "conversation_id": conversation_id,
+                "sender_id": rng.choice(conversation_pairs[conversation_id]),
+                "content": "synthetic message", "created_at": stamp(),
+            }
+        _stream_insert(connection, models.OneToOneMessage.__table__, scale["messages"], make_message, data.messages)
+
+        def make_community_message(i):
+            community_id = rng.choice(data.communities)
+            return {
+                "id": new_id(), "community_id": community_id,
+                "sender_id": rng.choice(data.members[community_id]),
+                "content": "synthetic post", "created_at": stamp(), "updated_at": now,
+            }
+        _stream_insert(connection, models.CommunityMessage.__table__, scale["community_messages"], make_community_message, data.community_messages)
+
+        _stream_insert(connection, models.Reply.__table__, scale["replies"], lambda i: {
+            "id": new_id(), "message_id": rng.choice(data.community_messages),
+            "sender_id": rng.choice(data.users), "content": "synthetic reply",
+            "created_at": stamp(), "updated_at": now,
+        }, data.replies)
+
+        used_pairs = set()
+        def make_request(i):
+            while True:
+                sender, expert = rng.sample(data.users, 2)
+                if (sender, expert) not in used_pairs:
+                    used_pairs.add((sender, expert))
+                    break
+            return {
+                "id": new_id(), "sender_id": sender, "expert_id": expert, "request_message": "please chat",
+                "created_at": stamp(), "updated_at": now, "is_accepted": False,
+            }
+        _stream_insert(connection, models.ConversationRequest.__table__, scale["requests"], make_request, data.requests)
+    return data
+
+
+def build_cases(data: Dataset, rng: random.Random) -> Dict[str, Callable]:
+    """
+    Returns name -> callable(db) -> (crud function, kwargs). The callable runs
+    any untimed setup (such as creating a row to delete) before the timed call.
+    """
+    import crud, schemas
+
+    def fresh_user(db):
+        return crud.models.User(id=str(uuid.uuid4()), email=f"{uuid.uuid4().hex}@example.com", name="Fresh", is_staff=False, is_active=True)
+
+    def add(db, obj):
+        db.add(obj)
+        db.commit()
+        return obj
+
+    def pending_request(db):
+        # A pending request may be consumed by an earlier accept/delete call.
+        return data.requests.pop() if data.requests else add(db, crud.models.ConversationRequest(
+            id=str(uuid.uuid4()), sender_id=rng.choice(data.users), expert_id=rng.choice(data.users),
+            request_message="again", is_accepted=False)).id
+
+    def community_and_member():
+        community_id = rng.choice(data.communities)
+        return community_id, rng.choice(data.members[community_id])
+
+    def non_member(db, community_id):
+        members = set(data.members[community_id])
+        candidate = None
+        for _ in range(100):
+            candidate = rng.choice(data.users)
+            if candidate not in members:
+                break
+        else:
+            candidate = add(db, fresh_user(db)).id
+        data.members[community_id].append(candidate)
+        return candidate
+
+    return {
+        "get_user": lambda db: (crud.get_user, {"user_id": rng.choice(data.users)}),
+        "get_user_by_email": lambda db: (crud.get_user_by_email, {"email": rng.choice(data.emails)}),
+        "get_users": lambda db: (crud.get_users, {"skip": rng.randint(0, max(0, len(data.users) - 100)), "limit": 100}),
+        "update_user": lambda db: (crud.update_user, {"user_id": rng.choice(data.users), "user_update": schemas.UserBase.model_construct(name="Renamed")}),
+        "delete_user": lambda db: (crud.delete_user, {"user_id": add(db, fresh_user(db)).id}),
+        "get_conversation": lambda db: (crud.get_conversation, {"conversation_id": rng.choice(data.conversations)}),
+        "get_conversations_by_user": lambda db: (crud.get_conversations_by_user, {"user_id": rng.choice(data.users)}),
+        "create_conversation": lambda db: (crud.create_conversation, {"conversation": schemas.ConversationCreate(user1_id=rng.choice(data.users), user2_id=rng.choice(data.users))}),
+        "update_conversation_last_message": lambda db: (crud.update_conversation_last_message, {"conversation_id": rng.choice(data.conversations), "message_content": "bench", "timestamp": datetime.utcnow()}),
+        "get_message": lambda db: (crud.get_message, {"message_id": rng.choice(data.messages)}),
+        "get_messages_by_conversation": lambda db: (crud.get_messages_by_conversation, {"conversation_id": rng.choice(data.conversations)}),
+        "create_message": lambda db: (crud.create_message, {"message": schemas.OneToOneMessageCreate(conversation_id=rng.choice(data.conversations), sender_id=rng.choice(data.users), content="bench")}),
+        "get_conversation_request": lambda db: (crud.get_conversation_request, {"request_id": rng.choice(data.requests)}),
+        "get_requests_by_sender": lambda db: (crud.get_requests_by_sender, {"sender_id": rng.choice(data.users)}),
+        "get_requests_by_expert": lambda db: (crud.get_requests_by_expert, {"expert_id": rng.choice(data.users)}),
+        "accept_conversation_request": lambda db: (crud.accept_conversation_request, {"request_id": pending_request(db)}),
+        "get_community": lambda db: (crud.get_community, {"community_id": rng.choice(data.communities)}),
+        "get_communities": lambda db: (crud.get_communities, {"skip": 0, "limit": 100}),
+        "create_community": lambda db: (crud.create_community, {"community": schemas.CommunityCreate(name=f"bench {uuid.uuid4().hex}")}),
+        "update_community": lambda db: (crud.update_community, {"community_id": rng.choice(data.communities), "community_update": schemas.CommunityBase.model_construct(description="updated")}),
+        "get_user_communities": lambda db: (crud.get_user_communities, {"user_id": rng.choice(data.users)}),
+        "get_popular_communities": lambda db: (crud.get_popular_communities, {"limit": 10}),
+        "get_community_member_count": lambda db: (crud.get_community_member_count, {"community_id": rng.choice(data.communities)}),
+        "get_membership": lambda db: (crud.get_membership, {"membership_id": rng.choice(data.memberships)}),
+        "get_memberships_by_community": lambda db: (crud.get_memberships_by_community, {"community_id": rng.choice(data.communities)}),
+        "get_memberships_by_user": lambda db: (crud.get_memberships_by_user, {"user_id": rng.choice(data.users)}),
+        "get_membership_by_community_and_user": lambda db: (crud.get_membership_by_community_and_user, dict(zip(("community_id", "user_id"), community_and_member()))),
+        "create_membership": lambda db: (lambda community_id: (crud.create_membership, {"membership": schemas.MembershipCreate(community_id=community_id, user_id=non_member(db, community_id))}))(rng.choice(data.communities)),
+        "is_user_community_member": lambda db: (crud.is_user_community_member, dict(zip(("community_id", "user_id"), community_and_member()))),
+        "get_community_message": lambda db: (crud.get_community_message, {"message_id": rng.choice(data.community_messages)}),
+        "get_community_messages_by_community": lambda db: (crud.get_community_messages_by_community, {"community_id": rng.choice(data.communities)}),
+        "create_community_message": lambda db: (crud.create_community_message, {"message": schemas.CommunityMessageCreate(community_id=rng.choice(data.communities), sender_id=rng.choice(data.users), content="bench")}),
+        "update_community_message": lambda db: (crud.update_community_message, {"message_id": rng.choice(data.community_messages), "content": "edited"}),
+        "get_reply": lambda db: (crud.get_reply, {"reply_id": rng.choice(data.replies)}),
+        "get_replies_by_message": lambda db: (crud.get_replies_by_message, {"message_id": rng.choice(data.community_messages)}),
+        "create_reply": lambda db: (crud.create_reply, {"reply": schemas.ReplyCreate(message_id=rng.choice(data.community_messages), sender_id=rng.choice(data.users), content="bench")}),
+        "delete_conversation": lambda db: (crud.delete_conversation, {"conversation_id": add(db, crud.models.Conversation(id=str(uuid.uuid4()), user1_id=rng.choice(data.users), user2_id=rng.choice(data.users))).id}),
+        "delete_message": lambda db: (crud.delete_message, {"message_id": add(db, crud.models.OneToOneMessage(id=str(uuid.uuid4()), conversation_id=rng.choice(data.conversations), sender_id=rng.choice(data.users), content="bye")).id}),
+        "create_user": lambda db: (crud.create_user, {"user": schemas.UserCreate(email=f"{uuid.uuid4().hex}@example.com", name="Bench", password="bench-password")}),
+        "create_conversation_request": lambda db: (lambda sender, expert: (crud.create_conversation_request, {"sender_id": sender.id, "expert_email": expert.email, "request_message": "hi"}))(add(db, fresh_user(db)), add(db, fresh_user(db))),
+        "delete_conversation_request": lambda db: (crud.delete_conversation_request, {"request_id": pending_request(db)}),
+        "delete_community": lambda db: (crud.delete_community, {"community_id": add(db, crud.models.Community(id=str(uuid.uuid4()), name=f"doomed {uuid.uuid4().hex}")).id}),
+        "update_membership": lambda db: (crud.update_membership, {"membership_id": rng.choice(data.memberships), "is_admin": False}),
+        "delete_membership": lambda db: (lambda community_id: (crud.delete_membership, {"membership_id": add(db, crud.models.Membership(id=str(uuid.uuid4()), community_id=community_id, user_id=non_member(db, community_id))).id}))(rng.choice(data.communities)),
+        "delete_community_message": lambda db: (crud.delete_community_message, {"message_id": add(db, crud.models.CommunityMessage(id=str(uuid.uuid4()), community_id=rng.choice(data.communities), sender_id=rng.choice(data.users), content="bye")).id}),
+        "update_reply": lambda db: (crud.update_reply, {"reply_id": rng.choice(data.replies), "content": "edited"}),
+        "delete_reply": lambda db: (crud.delete_reply, {"reply_id": add(db, crud.models.Reply(id=str(uuid.uuid4()), message_id=rng.choice(data.community_messages), sender_id=rng.choice(data.users), content="bye")).id}),
+        "get_community_discussion_paginated": lambda db: (crud.get_community_discussion_paginated, {"community_id": rng.choice(data.communities[:10]), "skip": 0, "limit": 20}),
+        "get_recent_messages": lambda db: (crud.get_recent_messages, {"conversation_id": rng.choice(data.conversations), "limit": 20}),
+        "get_recent_community_messages": lambda db: (crud.get_recent_community_messages, {"community_id": rng.choice(data.communities[:10]), "limit": 20}),
+        "search_users_in_community": lambda db: (crud.search_users_in_community, {"community_id": rng.choice(data.communities[:10]), "name_startswith": "User 1"}),
+    }
+
+
+class QueryCounter:
+    """
+    Counts statements sent to the database through an engine event hook.
+    """
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def run_cases(cases: Dict[str, Callable], session_factory, counter: QueryCounter, iterations: int, only: List[str]) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, case in cases.items():
+        if only and name not in only:
+            continue
+        latencies = []
+        queries = 0
+        for _ in range(iterations):
+            db = session_factory()
+            try:
+                fn, kwargs = case(db)
+                before = counter.count
+                started = time.perf_counter()
+                fn(db, **kwargs)
+                latencies.append(time.perf_counter() - started)
+                queries += counter.count - before
+            finally:
+                db.close()
+        row = common.summarize(latencies, sum(latencies))
+        row["queries_per_call"] = round(queries / iterations, 2)
+        results[name] = row
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="small", help=f"Comma separated list of {', '.join(SCALES)}.")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--only", default="", help="Comma separated crud function names to run.")
+    parser.add_argument("--database-url", help="Use this (empty) database instead of a temporary SQLite file per scale.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline for the first scale in --scales.")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    scales = [name.strip() for name in args.scales.split(",") if name.strip()]
+    only = [name.strip() for name in args.only.split(",") if name.strip()]
+    columns = ("count", "p50_ms", "p95_ms", "p99_ms", "queries_per_call")
+    all_results = {}
+
+    for index, scale_name in enumerate(scales):
+        if index > 0 and args.database_url:
+            parser.error("--database-url supports a single scale per run")
+        if args.database_url:
+            import os
+            os.environ["DATABASE_URL"] = args.database_url
+        else:
+            common.use_embedded_db()
+        # Each scale needs a fresh engine bound to its own database.
+        for module in ("database", "models", "crud"):
+            sys.modules.pop(module, None)
+        common.create_schema()
+        import database
+
+        rng = random.Random(args.seed)
+        started = time.monotonic()
+        data = load_dataset(database.engine, SCALES[scale_name], rng)
+        print(f"\nLoaded scale '{scale_name}' in {time.monotonic() - started:.1f}s: {SCALES[scale_name]}")
+
+        counter = QueryCounter(database.engine)
+        results = run_cases(build_cases(data, rng), database.SessionLocal, counter, args.iterations, only)
+        common.print_table(results, columns)
+        all_results[scale_name] = results
+        database.engine.dispose()
+
+    if len(scales) > 1:
+        first, last = all_results[scales[0]], all_results[scales[-1]]
+        print(f"\np95 growth from '{scales[0]}' to '{scales[-1]}':")
+        growth = sorted(
+            ((last[name]["p95_ms"] / first[name]["p95_ms"] if first[name]["p95_ms"] else 0.0, name) for name in first if name in last),
+            reverse=True,
+        )
+        for ratio, name in growth:
+            print(f"  {name:<40} x{ratio:.1f}")
+
+    first_results = all_results[scales[0]]
+    if args.update_baseline:
+        common.save_baseline(args.baseline, first_results)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    baseline = common.load_baseline(args.baseline)
+    if baseline is None:
+        return 0
+    regressions = common.compare_to_baseline(first_results, baseline, args.tolerance, throughput_keys=())
+    regressions += [
+        f"{name}.queries_per_call: {first_results[name]['queries_per_call']} > baseline {expected['queries_per_call']}"
+        for name, expected in baseline.items()
+        if name in first_results and first_results[name]["queries_per_call"] > expected.get("queries_per_call", 0)
+    ]
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
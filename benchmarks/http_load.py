@@ -0,0 +1,256 @@
+"""
+HTTP load generator with recorded baselines.
+
+Drives a weighted mix of the hot routes (login, message send, conversation
+reads, community discussion and listing) from a pool of keep-alive client
+threads, then reports throughput and p50/p95/p99 latency per route.
+
+Run against an embedded server and SQLite database:
+
+    python -m benchmarks.http_load --duration 30 --concurrency 16
+
+or against a running deployment:
+
+    python -m benchmarks.http_load --url http://127.0.0.1:8000
+
+Results are compared with benchmarks/baselines/http_load.json and the script
+exits non-zero when a route regresses by more than --tolerance. Baselines are
+hardware specific; record them with --update-baseline on the machine that runs
+the comparison.
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlparse
+
+from benchmarks import common
+
+DEFAULT_BASELINE = f"{common.BASELINE_DIR}/http_load.json"
+
+# Relative weights of each scenario in the traffic mix.
+SCENARIOS = {
+    "login": 5,
+    "send_message": 20,
+    "conversation_messages": 15,
+    "user_conversations": 10,
+    "conversation_detail": 10,
+    "community_discussion": 25,
+    "popular_communities": 10,
+    "community_message": 5,
+}
+
+
+class Client:
+    """
+    A keep-alive HTTP/1.1 connection used by one load thread.
+    """
+    def __init__(self, base_url: str):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def request(self, method: str, path: str, body=None, token: Optional[str] = None, form: bool = False) -> Tuple[int, bytes]:
+        headers = {}
+        payload = None
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if body is not None:
+            if form:
+                payload = urlencode(body)
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+            else:
+                payload = json.dumps(body)
+                headers["Content-Type"] = "application/json"
+        try:
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            raise
+
+
+class Fixture:
+    """
+    Users, communities and accepted conversations created through the public API.
+    """
+    def __init__(self):
+        self.users: List[Dict] = []
+        self.communities: List[str] = []
+        self.conversations: List[Dict] = []
+
+
+def seed(base_url: str, users: int, communities: int, password: str = "bench-password") -> Fixture:
+    client = Client(base_url)
+    fixture = Fixture()
+    run_id = uuid.uuid4().hex[:8]
+
+    for i in range(users):
+        email = f"bench-{run_id}-{i}@example.com"
+        status_code, body = client.request("POST", "/users/", {"email": email, "name": f"Bench {i}", "password": password})
+        if status_code != 201:
+            raise RuntimeError(f"Could not create user: {status_code} {body!r}")
+        user = json.loads(body)
+        status_code, body = client.request("POST", "/users/token", {"username": email, "password": password}, form=True)
+        user["token"] = json.loads(body)["access_token"]
+        user["password"] = password
+        fixture.users.append(user)
+
+    for i in range(communities):
+        owner = fixture.users[i % len(fixture.users)]
+        status_code, body = client.request("POST", "/community/create/", {"name": f"bench-{run_id}-{i}"}, token=owner["token"])
+        community_id = json.loads(body)["id"]
+        fixture.communities.append(community_id)
+        for user in fixture.users:
+            if user is not owner:
+                client.request("POST", f"/community/{community_id}/join/", token=user["token"])
+
+    for i in range(0, len(fixture.users) - 1, 2):
+        sender, expert = fixture.users[i], fixture.users[i + 1]
+        status_code, body = client.request("POST", "/chat/requests/", {
+            "sender_id": sender["id"],
+            "expert_email": expert["email"],
+            "request_message": "hello",
+        })
+        request_id = json.loads(body)["id"]
+        status_code, body = client.request("PUT", f"/chat/requests/{request_id}/accept")
+        fixture.conversations.append({
+            "id": json.loads(body)["conversation_id"],
+            "users": (sender, expert),
+        })
+    return fixture
+
+
+def run_scenario(name: str, client: Client, fixture: Fixture, rng: random.Random) -> int:
+    if name == "login":
+        user = rng.choice(fixture.users)
+        return client.request("POST", "/users/token", {"username": user["email"], "password": user["password"]}, form=True)[0]
+    if name == "send_message":
+        conversation = rng.choice(fixture.conversations)
+        sender = rng.choice(conversation["users"])
+        return client.request("POST", "/chat/messages/", {
+            "conversation_id": conversation["id"],
+            "sender_id": sender["id"],
+            "content": "load test message",
+        }, token=sender["token"])[0]
+    if name == "conversation_messages":
+        conversation = rng.choice(fixture.conversations)
+        return client.request("GET", f"/chat/messages/conversation/{conversation['id']}")[0]
+    if name == "user_conversations":
+        user = rng.choice(fixture.users)
+        return client.request("GET", f"/chat/conversations/user/{user['id']}")[0]
+    if name == "conversation_detail":
+        conversation = rng.choice(fixture.conversations)
+        return client.request("GET", f"/chat/conversations/{conversation['id']}")[0]
+    if name == "community_discussion":
+        community_id = rng.choice(fixture.communities)
+        return client.request("GET", f"/community/{community_id}/discussion/")[0]
+    if name == "popular_communities":
+        return client.request("GET", "/community/")[0]
+    if name == "community_message":
+        community_id = rng.choice(fixture.communities)
+        user = rng.choice(fixture.users)
+        return client.request("POST", f"/community/{community_id}/messages/", {
+            "community_id": community_id,
+            "sender_id": user["id"],
+            "content": "load test post",
+        }, token=user["token"])[0]
+    raise ValueError(f"Unknown scenario {name}")
+
+
+def run_load(base_url: str, fixture: Fixture, duration: float, concurrency: int, seed_value: int = 0) -> Dict[str, Dict[str, float]]:
+    names = list(SCENARIOS)
+    weights = [SCENARIOS[name] for name in names]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index: int):
+        rng = random.Random(seed_value + index)
+        client = Client(base_url)
+        local_latencies = defaultdict(list)
+        local_errors = defaultdict(int)
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status_code = run_scenario(name, client, fixture, rng)
+            except (http.client.HTTPException, OSError):
+                status_code = 599
+            elapsed = time.perf_counter() - started
+            if status_code >= 400:
+                local_errors[name] += 1
+            else:
+                local_latencies[name].append(elapsed)
+        with lock:
+            for name, values in local_latencies.items():
+                latencies[name].extend(values)
+            for name, count in local_errors.items():
+                errors[name] += count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    results = {name: common.summarize(latencies[name], elapsed, errors[name]) for name in names}
+    results["total"] = common.summarize([v for values in latencies.values() for v in values], elapsed, sum(errors.values()))
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Target a running server instead of an embedded one.")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--communities", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression as a fraction of the baseline.")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="Also write the results as JSON to this path.")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        fixture = seed(args.url, args.users, args.communities)
+        results = run_load(args.url, fixture, args.duration, args.concurrency)
+    else:
+        common.use_embedded_db()
+        from main import app
+        with common.EmbeddedServer(app) as server:
+            fixture = seed(server.base_url, args.users, args.communities)
+            results = run_load(server.base_url, fixture, args.duration, args.concurrency)
+
+    common.print_table(results)
+    if args.output:
+        common.save_baseline(args.output, results)
+    if args.update_baseline:
+        common.save_baseline(args.baseline, results)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = common.load_baseline(args.baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one.")
+        return 0
+    regressions = common.compare_to_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+"""
+WebSocket fan-out benchmark and connection-leak soak test.
+
+Fan-out mode opens many listening clients spread over /ws/chat/{id}/ and
+/ws/community/{id}/ rooms, has one sender per room publish messages at a fixed
+rate, and reports end-to-end broadcast latency, deliveries per second and
+connect latency:
+
+    python -m benchmarks.ws_fanout --clients 2000 --messages 50
+    python -m benchmarks.ws_fanout --format msgpack --compress   # compare egress bytes
+    python -m benchmarks.ws_fanout --batch --rate 0              # coalescing in a hot room
+
+Soak mode repeatedly opens clients, sends, and then closes them cleanly,
+abruptly (TCP abort without a close frame) or mid-send. Afterwards it checks
+that every ConnectionManager is empty again and that traced memory returned
+to the level measured after a warm-up cycle:
+
+    python -m benchmarks.ws_fanout --soak-seconds 120
+
+Both modes run against an embedded server so the managers can be inspected;
+--url only supports the fan-out mode. Every client of a room connects with its
+sender's token, so a target server must not set WS_MAX_CONNECTIONS_PER_USER, and
+WS_RATE_MESSAGE=0 / WS_USER_RATE_MESSAGE=0 (and _FRAME) for rates above the
+default inbound limits.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import zlib
+from typing import Dict, List, Union
+
+from benchmarks import common
+
+DEFAULT_BASELINE = f"{common.BASELINE_DIR}/ws_fanout.json"
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class Room:
+    """
+    A room under test: its WebSocket path and a sender able to post in it.
+    Every client connects with the sender's token, which is a participant/member.
+    """
+    def __init__(self, kind: str, room_id: str, sender: Dict):
+        self.kind = kind
+        self.room_id = room_id
+        self.sender = sender
+
+    @property
+    def path(self) -> str:
+        return f"/ws/{self.kind}/{self.room_id}/"
+
+    def frame(self, content: str) -> str:
+        payload = {"content": content}
+        if self.kind == "community":
+            payload["type"] = "message"
+        return json.dumps(payload)
+
+
+def build_rooms(fixture, chat_rooms: int, community_rooms: int) -> List[Room]:
+    rooms = [Room("chat", c["id"], c["users"][0]) for c in fixture.conversations[:chat_rooms]]
+    rooms += [Room("community", community_id, fixture.users[0]) for community_id in fixture.communities[:community_rooms]]
+    return rooms
+
+
+# Wire encoding negotiated by every client: {"format": "json"|"msgpack", "compress": "deflate"|"", "batch": "1"|""}.
+ENCODING = {"format": "json", "compress": "", "batch": ""}
+
+
+def decode(raw: Union[str, bytes]):
+    if isinstance(raw, bytes) and ENCODING["compress"]:
+        raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+    if ENCODING["format"] == "msgpack":
+        import msgpack
+        return msgpack.unpackb(raw)
+    return json.loads(raw)
+
+
+async def _connect(ws_url: str, room: Room):
+    import websockets
+    params = f"token={room.sender['token']}&format={ENCODING['format']}"
+    if ENCODING["compress"]:
+        params += f"&compress={ENCODING['compress']}"
+    if ENCODING["batch"]:
+        params += "&batch=1"
+    # Client-side permessage-deflate is off so the server's own encoding is what gets measured.
+    return await websockets.connect(f"{ws_url}{room.path}?{params}", max_queue=None, open_timeout=30, ping_interval=None, compression=None)
+
+
+async def listen(connection, latencies: List[float], received_bytes: List[int], frames: List[int], expected: int, done: asyncio.Event):
+    """
+    Records the delivery latency and wire size of every benchmark message received by one client.
+    Batched frames (a list of messages) count once in `frames`.
+    """
+    received = 0
+    try:
+        async for raw in connection:
+            now = time.perf_counter()
+            try:
+                decoded = decode(raw)
+            except (ValueError, zlib.error):
+                continue
+            messages = decoded if isinstance(decoded, list) else [decoded]
+            counted = received
+            for message in messages:
+                content = message.get("content", "") if isinstance(message, dict) else ""
+                if content.startswith("bench "):
+                    latencies.append(now - float(content[6:]))
+                    received_bytes.append(len(raw) // len(messages))
+                    received += 1
+            # Presence and heartbeat frames are not part of the measurement.
+            if received > counted:
+                frames.append(1)
+            if received >= expected:
+                break
+    except Exception:
+        pass
+    finally:
+        if received >= expected:
+            done.set()
+
+
+async def run_fanout(ws_url: str, rooms: List[Room], clients: int, messages: int, rate: float, connect_concurrency: int) -> Dict[str, Dict[str, float]]:
+    semaphore = asyncio.Semaphore(connect_concurrency)
+    connect_latencies: List[float] = []
+
+    async def open_client(room: Room):
+        async with semaphore:
+            started = time.perf_counter()
+            connection = await _connect(ws_url, room)
+            connect_latencies.append(time.perf_counter() - started)
+            return connection
+
+    assignments = [rooms[i % len(rooms)] for i in range(clients)]
+    connect_started = time.perf_counter()
+    listeners = await asyncio.gather(*(open_client(room) for room in assignments))
+    connect_elapsed = time.perf_counter() - connect_started
+    senders = {room.room_id: await _connect(ws_url, room) for room in rooms}
+
+    latencies: List[float] = []
+    received_bytes: List[int] = []
+    frames: List[int] = []
+    done_events = []
+    tasks = []
+    for connection in listeners:
+        done = asyncio.Event()
+        done_events.append(done)
+        tasks.append(asyncio.create_task(listen(connection, latencies, received_bytes, frames, messages, done)))
+
+    async def send_all(room: Room):
+        interval = 1.0 / rate if rate else 0
+        for _ in range(messages):
+            await senders[room.room_id].send(room.frame(f"bench {time.perf_counter()}"))
+            await asyncio.sleep(interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send_all(room) for room in rooms))
+    await asyncio.wait(tasks, timeout=60)
+    elapsed = time.perf_counter() - started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*(c.close() for c in list(listeners) + list(senders.values())), return_exceptions=True)
+
+    expected = clients * messages
+    delivery = common.summarize(latencies, elapsed, errors=expected - len(latencies))
+    delivery["messages_per_sec"] = round(len(rooms) * messages / elapsed, 2)
+    delivery["bytes_per_delivery"] = round(sum(received_bytes) / len(received_bytes), 1) if received_bytes else 0.0
+    delivery["deliveries_per_frame"] = round(len(latencies) / len(frames), 2) if frames else 0.0
+    return {
+        "broadcast_delivery": delivery,
+        "connect": common.summarize(connect_latencies, connect_elapsed),
+    }
+
+
+async def soak_cycle(ws_url: str, rooms: List[Room], clients: int, rng_state: List[int]):
+    """
+    Opens a batch of clients, sends a little traffic and tears them down three different ways.
+    """
+    connections = []
+    for i in range(clients):
+        room = rooms[i % len(rooms)]
+        try:
+            connections.append((room, await _connect(ws_url, room)))
+        except Exception:
+            continue
+    for index, (room, connection) in enumerate(connections):
+        mode = (index + rng_state[0]) % 3
+        try:
+            if mode == 0:
+                await connection.send(room.frame("soak"))
+                await connection.close()
+            elif mode == 1:
+                connection.transport.abort()
+            else:
+                await connection.send(room.frame("soak"))
+                connection.transport.abort()
+        except Exception:
+            pass
+    rng_state[0] += 1
+
+
+def active_connection_count() -> int:
+    from proj_websockets import chat_ws, community_ws, user_ws
+    return sum(
+        len(conns)
+        for manager in (chat_ws.manager, community_ws.manager, user_ws.manager)
+        for conns in manager.active_connections.values()
+    )
+
+
+async def wait_for_drain(timeout: float) -> int:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if active_connection_count() == 0:
+            return 0
+        await asyncio.sleep(0.1)
+    return active_connection_count()
+
+
+async def run_soak(ws_url: str, rooms: List[Room], clients: int, seconds: float, max_growth_mb: float) -> Dict[str, float]:
+    tracemalloc.start()
+    rng_state = [0]
+
+    # Warm-up so caches, pools and lazily imported modules are part of the baseline.
+    await soak_cycle(ws_url, rooms, clients, rng_state)
+    await wait_for_drain(10)
+    gc.collect()
+    baseline_bytes = tracemalloc.get_traced_memory()[0]
+
+    cycles = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        await soak_cycle(ws_url, rooms, clients, rng_state)
+        cycles += 1
+
+    leaked = await wait_for_drain(10)
+    gc.collect()
+    growth_mb = (tracemalloc.get_traced_memory()[0] - baseline_bytes) / (1024 * 1024)
+    tracemalloc.stop()
+    return {
+        "cycles": cycles,
+        "connections_opened": cycles * clients,
+        "leaked_connections": leaked,
+        "memory_growth_mb": round(growth_mb, 3),
+        "max_memory_growth_mb": max_growth_mb,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Target a running server (fan-out mode only).")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--chat-rooms", type=int, default=5)
+    parser.add_argument("--community-rooms", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=20, help="Messages sent by each room's sender.")
+    parser.add_argument("--rate", type=float, default=20.0, help="Messages per second per sender (0 = unthrottled).")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--format", choices=("json", "msgpack"), default="json", help="Frame encoding negotiated by the clients.")
+    parser.add_argument("--compress", action="store_true", help="Negotiate deflated frames (enabled on the embedded server's endpoints).")
+    parser.add_argument("--batch", action="store_true", help="Negotiate coalesced array frames.")
+    parser.add_argument("--soak-seconds", type=float, default=0, help="Run the leak soak test instead of the fan-out benchmark.")
+    parser.add_argument("--max-memory-growth-mb", type=float, default=5.0)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    from benchmarks.http_load import seed
+    raise_fd_limit()
+    ENCODING["format"] = args.format
+    ENCODING["compress"] = "deflate" if args.compress else ""
+    ENCODING["batch"] = "1" if args.batch else ""
+    users = max(2, args.chat_rooms * 2)
+
+    if args.url:
+        if args.soak_seconds:
+            parser.error("--soak-seconds needs the embedded server")
+        fixture = seed(args.url, users, args.community_rooms)
+        ws_url = args.url.replace("http", "ws", 1)
+        results = asyncio.run(run_fanout(ws_url, build_rooms(fixture, args.chat_rooms, args.community_rooms), args.clients, args.messages, args.rate, args.connect_concurrency))
+    else:
+        common.use_embedded_db()
+        # All clients of a room share the sender's token.
+        os.environ.setdefault("WS_MAX_CONNECTIONS_PER_USER", "0")
+        # Senders publish faster than a person types; lift the inbound frame limits.
+        for category in ("FRAME", "MESSAGE", "REPLY", "EVENT"):
+            os.environ.setdefault(f"WS_RATE_{category}", "0")
+            os.environ.setdefault(f"WS_USER_RATE_{category}", "0")
+        if args.compress:
+            os.environ.setdefault("WS_CHAT_COMPRESSION", "deflate")
+            os.environ.setdefault("WS_COMMUNITY_COMPRESSION", "deflate")
+        from main import app
+        with common.EmbeddedServer(app) as server:
+            fixture = seed(server.base_url, users, args.community_rooms)
+            rooms = build_rooms(fixture, args.chat_rooms, args.community_rooms)
+            if args.soak_seconds:
+                soak = asyncio.run(run_soak(server.ws_url, rooms, args.clients, args.soak_seconds, args.max_memory_growth_mb))
+                print(json.dumps(soak, indent=2))
+                ok = soak["leaked_connections"] == 0 and soak["memory_growth_mb"] <= args.max_memory_growth_mb
+                print("SOAK OK" if ok else "SOAK FAILED")
+                return 0 if ok else 1
+            results = asyncio.run(run_fanout(server.ws_url, rooms, args.clients, args.messages, args.rate, args.connect_concurrency))
+
+    common.print_table(results, ("count", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms"))
+    print(f"messages/sec: {results['broadcast_delivery']['messages_per_sec']}")
+    print(f"bytes/delivery: {results['broadcast_delivery']['bytes_per_delivery']} ({args.format}{', deflate' if args.compress else ''})")
+    print(f"deliveries/frame: {results['broadcast_delivery']['deliveries_per_frame']}")
+    if args.update_baseline:
+        common.save_baseline(args.baseline, results)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    baseline = common.load_baseline(args.baseline)
+    if baseline is None:
+        return 0
+    regressions = common.compare_to_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
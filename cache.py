@@ -0,0 +1,486 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    Sync routes run in the threadpool, so every operation takes the lock.
+    A maxsize or ttl of 0 disables the cache.
+    """
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        metrics.register(f"cache.{name}", self.stats)
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the cached value for `key`, or `default` on a miss or expired entry.
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[0] < time.monotonic():
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Optional[Hashable]):
+        if key is None:
+            return
+        with self._lock:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class EntityCache(TTLCache):
+    """
+    Read-through TTLCache of rows by primary key, for the crud getters.
+    Values are column snapshots rather than ORM instances, which belong to one
+    Session. Writes in this worker invalidate their row, and a load that
+    overlaps an invalidation of its key is not stored; `ttl` bounds how long
+    writes through other workers can go unseen. Missing rows are not cached.
+    """
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        super().__init__(name, maxsize, ttl)
+        # key -> [loads in flight, invalidations seen meanwhile]
+        self._loading: Dict[Hashable, List[int]] = {}
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value for `key`, or calls `load()` and caches what it returns.
+        """
+        if not self.enabled:
+            return load()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] >= time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not _MISSING:
+                del self._data[key]
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            writes = loading[1]
+        self.misses += 1
+        value = None
+        try:
+            value = load()
+        finally:
+            with self._lock:
+                loading = self._loading[key]
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[key]
+                if value is not None and writes == loading[1]:
+                    self._set(key, value)
+        return value
+
+    def invalidate(self, key: Optional[Hashable]):
+        if key is None:
+            return
+        with self._lock:
+            loading = self._loading.get(key)
+            if loading is not None:
+                loading[1] += 1
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for loading in self._loading.values():
+                loading[1] += 1
+            self._data.clear()
+
+
+class MembershipCache:
+    """
+    Bounded LRU of room id -> set of user ids allowed in it (community members or
+    conversation participants), cold-loaded from the database on first use.
+
+    Writes in this worker update loaded rooms in place. A negative answer is
+    re-checked against the database, so members added by another worker are
+    never rejected; `ttl` bounds how long a removal elsewhere can go unnoticed.
+    Every room counts at least once toward `max_entries`, so lookups of unknown
+    ids cannot grow the cache without bound. Rooms larger than `max_entries` are
+    only remembered as such and checked one user at a time.
+    """
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # room -> (expiry, member ids, or None for a room too large to hold)
+        self._rooms: "OrderedDict[str, tuple]" = OrderedDict()
+        self._entries = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.oversized = 0
+        metrics.register(f"cache.{name}", self.stats)
+
+    @staticmethod
+    def _cost(members: Optional[Set[str]]) -> int:
+        return max(1, len(members)) if members is not None else 1
+
+    def _get(self, room_id: str) -> Optional[tuple]:
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(room_id)
+            return None
+        self._rooms.move_to_end(room_id)
+        return entry
+
+    def _drop(self, room_id: str):
+        entry = self._rooms.pop(room_id, None)
+        if entry is not None:
+            self._entries -= self._cost(entry[1])
+
+    def contains(self, room_id: str, user_id: str, load: Callable[[Optional[int]], Iterable[str]], confirm: Callable[[], bool]) -> bool:
+        """
+        Checks whether `user_id` belongs to `room_id`.
+        `load(limit)` returns up to `limit` user ids of the room, all if None (used on a cold miss);
+        `confirm` checks a single user directly when the cached answer is "no",
+        or when the room is too large to cache.
+        """
+        room_id, user_id = str(room_id), str(user_id)
+        with self._lock:
+            entry = self._get(room_id)
+            writes = self._writes
+        if entry is not None:
+            self.hits += 1
+            members = entry[1]
+        else:
+            self.misses += 1
+            if not self.max_entries or self.ttl <= 0:
+                return user_id in {str(member) for member in load(None)} or confirm()
+            members = {str(member) for member in load(self.max_entries + 1)}
+            if len(members) > self.max_entries:
+                # Only part of the room was loaded; its absence from it says nothing.
+                self._store(room_id, None, writes)
+                return user_id in members or confirm()
+            self._store(room_id, members, writes)
+        if members is not None and user_id in members:
+            return True
+        if confirm():
+            self.add(room_id, user_id)
+            return True
+        return False
+
+    def _store(self, room_id: str, members: Optional[Set[str]], writes: int):
+        with self._lock:
+            # A write while we were loading may be missing from `members`.
+            if writes != self._writes:
+                return
+            self._drop(room_id)
+            self._rooms[room_id] = (time.monotonic() + self.ttl, members)
+            self._entries += self._cost(members)
+            if members is None:
+                self.oversized += 1
+            else:
+                self.loads += 1
+            while self._entries > self.max_entries and self._rooms:
+                _, evicted = self._rooms.popitem(last=False)
+                self._entries -= self._cost(evicted[1])
+                self.evictions += 1
+
+    def add(self, room_id: str, user_id: str):
+        with self._lock:
+            self._writes += 1
+            entry = self._get(str(room_id))
+            if entry is not None and entry[1] is not None and str(user_id) not in entry[1]:
+                before = self._cost(entry[1])
+                entry[1].add(str(user_id))
+                self._entries += self._cost(entry[1]) - before
+
+    def remove(self, room_id: str, user_id: str):
+        with self._lock:
+            self._writes += 1
+            entry = self._get(str(room_id))
+            if entry is not None and entry[1] is not None and str(user_id) in entry[1]:
+                before = self._cost(entry[1])
+                entry[1].discard(str(user_id))
+                self._entries += self._cost(entry[1]) - before
+
+    def drop(self, room_id: str):
+        with self._lock:
+            self._writes += 1
+            self._drop(str(room_id))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "rooms": len(self._rooms),
+            "entries": self._entries,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "loads": self.loads,
+            "oversized": self.oversized,
+            "evictions": self.evictions,
+        }
+
+
+class RecentMessagesCache:
+    """
+    Bounded LRU of room id -> its newest `per_room` messages (response snapshots,
+    oldest first), cold-loaded from the database on the first read of a room.
+
+    Writes in this worker append to loaded rooms; edits and deletions drop the
+    room. `ttl` bounds how long messages posted through other workers can go
+    unseen. A room holding all of its messages is `complete` and can also answer
+    unpaginated reads. `max_entries` bounds the messages held across all rooms;
+    an empty room counts as one, so reads of unknown rooms cannot grow it unbounded.
+    """
+    def __init__(self, name: str, per_room: int, max_entries: int, ttl: float, key: Callable[[Any], Any] = lambda item: item.created_at):
+        self.name = name
+        self.per_room = per_room
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.key = key
+        # room -> (expiry, complete, items)
+        self._rooms: "OrderedDict[str, tuple]" = OrderedDict()
+        self._entries = 0
+        # room -> [loads in flight, writes seen meanwhile]
+        self._loading: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        metrics.register(f"cache.{name}", self.stats)
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_room > 0 and self.max_entries > 0 and self.ttl > 0
+
+    def _get(self, room_id: str) -> Optional[tuple]:
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(room_id)
+            return None
+        self._rooms.move_to_end(room_id)
+        return entry
+
+    def _drop(self, room_id: str):
+        entry = self._rooms.pop(room_id, None)
+        if entry is not None:
+            self._entries -= max(1, len(entry[2]))
+
+    def _written(self, room_id: str):
+        loading = self._loading.get(room_id)
+        if loading is not None:
+            loading[1] += 1
+
+    def get(self, room_id: str, limit: Optional[int], load: Callable[[int], List[Any]]) -> Optional[List[Any]]:
+        """
+        Returns the newest `limit` messages of the room (all of them if None), oldest
+        first, or None when the cache cannot answer and the caller must query.
+        `load(count)` returns the room's newest `count` messages, oldest first.
+        """
+        if not self.enabled or (limit is not None and limit > self.per_room):
+            return None
+        room_id = str(room_id)
+        with self._lock:
+            entry = self._get(room_id)
+            if entry is not None:
+                self.hits += 1
+                return self._answer(entry[1], entry[2], limit)
+            loading = self._loading.setdefault(room_id, [0, 0])
+            loading[0] += 1
+            writes = loading[1]
+        self.misses += 1
+        items: Optional[List[Any]] = None
+        try:
+            items = load(self.per_room + 1)
+        finally:
+            self._store(room_id, items, writes)
+        return self._answer(len(items) <= self.per_room, items[-self.per_room:], limit)
+
+    @staticmethod
+    def _answer(complete: bool, items: List[Any], limit: Optional[int]) -> Optional[List[Any]]:
+        if limit is None:
+            return list(items) if complete else None
+        if len(items) < limit and not complete:
+            return None
+        return items[-limit:] if limit > 0 else []
+
+    def _store(self, room_id: str, items: Optional[List[Any]], writes: int):
+        with self._lock:
+            loading = self._loading[room_id]
+            loading[0] -= 1
+            if not loading[0]:
+                del self._loading[room_id]
+            # A write to the room while we were loading may be missing from `items`.
+            if items is None or writes != loading[1]:
+                return
+            complete = len(items) <= self.per_room
+            items = items[-self.per_room:]
+            self._drop(room_id)
+            self._rooms[room_id] = (time.monotonic() + self.ttl, complete, items)
+            self._entries += max(1, len(items))
+            self.loads += 1
+            while self._entries > self.max_entries and self._rooms:
+                _, evicted = self._rooms.popitem(last=False)
+                self._entries -= max(1, len(evicted[2]))
+                self.evictions += 1
+
+    def append(self, room_id: str, build: Callable[[], Any]):
+        """
+        Records a message just written to the room. Called for every write, so
+        a load of the room running meanwhile is not stored; `build()` makes the
+        message's snapshot, and is only called when the room is loaded.
+        """
+        room_id = str(room_id)
+        with self._lock:
+            self._written(room_id)
+            entry = self._get(room_id)
+            if entry is None:
+                return
+            _, complete, items = entry
+            item = build()
+            items.append(item)
+            if len(items) > 1 and self.key(items[-2]) > self.key(item):
+                items.sort(key=self.key)
+            if len(items) > self.per_room:
+                items.pop(0)
+                if complete:
+                    self._rooms[room_id] = (entry[0], False, items)
+            elif len(items) > 1:
+                self._entries += 1
+
+    def drop(self, room_id: str):
+        room_id = str(room_id)
+        with self._lock:
+            self._written(room_id)
+            self._drop(room_id)
+
+    def clear(self):
+        with self._lock:
+            for loading in self._loading.values():
+                loading[1] += 1
+            self._rooms.clear()
+            self._entries = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "rooms": len(self._rooms),
+            "entries": self._entries,
+            "per_room": self.per_room,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+# Resolved principals (schemas.UserOut) keyed by the JWT subject (the user's email).
+# Invalidated by crud.update_user/delete_user; the TTL bounds staleness across workers.
+principal_cache = TTLCache(
+    "principals",
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", "60")),
+)
+
+# Column snapshots of rows looked up by id (crud.get_user, get_community, ...).
+# Conversations change with every message, so they get a shorter TTL.
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+user_entities = EntityCache("users", maxsize=ENTITY_CACHE_SIZE, ttl=float(os.getenv("USER_CACHE_TTL", "60")))
+community_entities = EntityCache("communities", maxsize=ENTITY_CACHE_SIZE, ttl=float(os.getenv("COMMUNITY_CACHE_TTL", "300")))
+conversation_entities = EntityCache("conversations", maxsize=ENTITY_CACHE_SIZE, ttl=float(os.getenv("CONVERSATION_CACHE_TTL", "30")))
+community_message_entities = EntityCache("community_messages", maxsize=ENTITY_CACHE_SIZE, ttl=float(os.getenv("COMMUNITY_MESSAGE_CACHE_TTL", "120")))
+
+# Community id -> member user ids, and conversation id -> its two participants.
+community_members = MembershipCache(
+    "community_members",
+    max_entries=int(os.getenv("MEMBERSHIP_CACHE_ENTRIES", "1000000")),
+    ttl=float(os.getenv("MEMBERSHIP_CACHE_TTL", "300")),
+)
+conversation_participants = MembershipCache(
+    "conversation_participants",
+    max_entries=int(os.getenv("PARTICIPANT_CACHE_ENTRIES", "200000")),
+    ttl=float(os.getenv("MEMBERSHIP_CACHE_TTL", "300")),
+)
+
+# Newest messages per conversation / community, serving first history pages.
+recent_conversation_messages = RecentMessagesCache(
+    "recent_conversation_messages",
+    per_room=int(os.getenv("RECENT_MESSAGES_PER_ROOM", "50")),
+    max_entries=int(os.getenv("RECENT_MESSAGES_MAX_ENTRIES", "50000")),
+    ttl=float(os.getenv("RECENT_MESSAGES_TTL", "60")),
+)
+recent_community_messages = RecentMessagesCache(
+    "recent_community_messages",
+    per_room=int(os.getenv("RECENT_MESSAGES_PER_ROOM", "50")),
+    max_entries=int(os.getenv("RECENT_MESSAGES_MAX_ENTRIES", "50000")),
+    ttl=float(os.getenv("RECENT_MESSAGES_TTL", "60")),
+)
@@ -1,19 +1,72 @@
 import uuid
 from datetime import datetime
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
-from typing import Optional, List, Dict
+from sqlalchemy.orm import Session, joinedload, aliased, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy import func, inspect
+from typing import Any, Optional, List, Dict, Union
 import models, schemas
+from cache import (
+    EntityCache, principal_cache, community_members, conversation_participants, recent_conversation_messages, recent_community_messages,
+    user_entities, community_entities, conversation_entities, community_message_entities,
+)
 from fastapi import HTTPException, status
-from passlib.context import CryptContext
+import passwords
+import revocation
+
+def _snapshot(instance: Any) -> Optional[Dict[str, Any]]:
+    state = inspect(instance)
+    values = state.dict
+    keys = [attr.key for attr in state.mapper.column_attrs]
+    if any(key not in values for key in keys):
+        return None
+    return {key: values[key] for key in keys}
+
+
+def _get_cached(db: Session, cache: EntityCache, model: Any, key: str) -> Any:
+    """
+    Looks up a row by primary key through `cache`. A cached snapshot is rebuilt
+    into an instance attached to `db` as if it had been loaded, without a query:
+    relationships still lazy-load and changes are flushed as usual.
+    """
+    key = str(key)
+    instance = db.identity_map.get(identity_key(model, key))
+    if instance is not None:
+        # The session's own copy is at least as fresh as the cache's.
+        if not inspect(instance).expired:
+            return instance
+        return db.query(model).filter(model.id == key).first()
+
+    loaded: List[Any] = []
+
+    def load():
+        row = db.query(model).filter(model.id == key).first()
+        loaded.append(row)
+        return _snapshot(row) if row is not None else None
+
+    snapshot = cache.get_or_load(key, load)
+    if loaded:
+        return loaded[0]
+    instance = model(**snapshot)
+    make_transient_to_detached(instance)
+    db.add(instance)
+    return instance
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def get_user(db: Session, user_id: str) -> Optional[models.User]:
     """
     Retrieves a single user by their ID.
     """
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return _get_cached(db, user_entities, models.User, user_id)
+
+def get_user_row(db: Session, user_id: str):
+    """
+    Retrieves the columns of schemas.UserOut for a user, without building the ORM object.
+    Returns None if the user does not exist.
+    """
+    return db.query(
+        models.User.id, models.User.email, models.User.name, models.User.profile_picture,
+        models.User.is_staff, models.User.is_active,
+    ).filter(models.User.id == user_id).first()
 
 def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
     """
@@ -28,11 +81,12 @@ def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[models.User]
     """
     return db.query(models.User).offset(skip).limit(limit).all()
 
-def create_user(db: Session, user: schemas.UserCreate) -> models.User:
+def create_user(db: Session, user: schemas.UserCreate, password_hash: Optional[str] = None) -> models.User:
     """
     Creates a new user with a hashed password.
+    Pass `password_hash` when the password was already hashed on the hashing pool.
     """
-    password = pwd_context.hash(user.password)
+    password = password_hash or passwords.hash_password_sync(user.password)
     db_user = models.User(
         id=str(uuid.uuid4()),
         email=user.email,
@@ -55,10 +109,28 @@ def update_user(db: Session, user_id: str, user_update: schemas.UserBase) -> Opt
     db_user = get_user(db, user_id)
     if not db_user:
         return None
+    previous_email = db_user.email
     for key, value in user_update.model_dump(exclude_unset=True).items():
         setattr(db_user, key, value)
     db.commit()
+    user_entities.invalidate(str(user_id))
     db.refresh(db_user)
+    principal_cache.invalidate(previous_email)
+    principal_cache.invalidate(db_user.email)
+    # Cached history embeds sender details; finding the user's rooms would cost more than reloading.
+    recent_conversation_messages.clear()
+    recent_community_messages.clear()
+    revocation.mark_user_changed(db, user_id)
+    return db_user
+
+
+def update_user_password(db: Session, db_user: models.User, password_hash: str) -> models.User:
+    """
+    Replaces a user's stored password hash, e.g. after a work factor change.
+    """
+    db_user.password = password_hash # type: ignore
+    db.commit()
+    user_entities.invalidate(str(db_user.id))
     return db_user
 
 
@@ -70,15 +142,39 @@ def delete_user(db: Session, user_id: str) -> bool:
     db_user = get_user(db, user_id)
     if not db_user:
         return False
+    email = db_user.email
     db.delete(db_user)
     db.commit()
+    user_entities.invalidate(str(user_id))
+    principal_cache.invalidate(email)
+    recent_conversation_messages.clear()
+    recent_community_messages.clear()
+    revocation.mark_user_changed(db, user_id)
     return True
 
 def get_conversation(db: Session, conversation_id: str) -> Optional[models.Conversation]:
     """
     Retrieves a single conversation by its ID.
     """
-    return db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
+    return _get_cached(db, conversation_entities, models.Conversation, conversation_id)
+
+
+def get_conversation_version(db: Session, conversation_id: str) -> Optional[tuple]:
+    """
+    The values of a conversation and its two users that schemas.ConversationOut
+    can change with, in one query and without loading the ORM objects.
+    Returns None if the conversation does not exist.
+    """
+    user1 = aliased(models.User)
+    user2 = aliased(models.User)
+    row = db.query(
+        models.Conversation.updated_at, models.Conversation.last_message, models.Conversation.last_message_time,
+        user1.email, user1.name, user1.profile_picture, user1.is_staff, user1.is_active,
+        user2.email, user2.name, user2.profile_picture, user2.is_staff, user2.is_active,
+    ).outerjoin(user1, user1.id == models.Conversation.user1_id).outerjoin(
+        user2, user2.id == models.Conversation.user2_id
+    ).filter(models.Conversation.id == conversation_id).first()
+    return tuple(row) if row is not None else None
 
 
 def get_conversations_by_user(db: Session, user_id: str) -> List[models.Conversation]:
@@ -121,6 +217,7 @@ def update_conversation_last_message(
     db_conversation.last_message = message_content # type: ignore
     db_conversation.last_message_time = timestamp # type: ignore
     db.commit()
+    conversation_entities.invalidate(str(conversation_id))
     db.refresh(db_conversation)
     return db_conversation
 
@@ -135,8 +232,25 @@ def delete_conversation(db: Session, conversation_id: str) -> bool:
         return False
     db.delete(db_conversation)
     db.commit()
+    conversation_entities.invalidate(str(conversation_id))
+    conversation_participants.drop(conversation_id)
+    recent_conversation_messages.drop(conversation_id)
     return True
 
+
+def is_conversation_participant(db: Session, user_id: str, conversation_id: str) -> bool:
+    """
+    Checks if a user is one of the two participants of a conversation.
+    Answers from the participant cache; a missing conversation has no participants.
+    """
+    def load(limit: Optional[int]):
+        row = db.query(models.Conversation.user1_id, models.Conversation.user2_id)\
+            .filter(models.Conversation.id == str(conversation_id)).first()
+        return row if row else ()
+
+    # Participants never change, so a cached "no" needs no second look.
+    return conversation_participants.contains(conversation_id, user_id, load, lambda: False)
+
 def get_message(db: Session, message_id: str) -> Optional[models.OneToOneMessage]:
     """
     Retrieves a single one-to-one message by its ID.
@@ -151,6 +265,26 @@ def get_messages_by_conversation(db: Session, conversation_id: str) -> List[mode
     return db.query(models.OneToOneMessage).filter(models.OneToOneMessage.conversation_id == conversation_id).all()
 
 
+def get_recent_messages(db: Session, conversation_id: str, limit: Optional[int] = None) -> List[schemas.OneToOneMessageOut]:
+    """
+    Retrieves the newest `limit` messages of a conversation (all of them if None), oldest first.
+    Served from the recent-message cache when it holds enough of the conversation.
+    """
+    def load(count: Optional[int]) -> List[schemas.OneToOneMessageOut]:
+        query = db.query(models.OneToOneMessage)\
+            .options(joinedload(models.OneToOneMessage.sender_obj))\
+            .filter(models.OneToOneMessage.conversation_id == conversation_id)\
+            .order_by(models.OneToOneMessage.created_at.desc())
+        if count is not None:
+            query = query.limit(count)
+        return [schemas.OneToOneMessageOut.model_validate(message) for message in reversed(query.all())]
+
+    cached = recent_conversation_messages.get(conversation_id, limit, load)
+    if cached is not None:
+        return cached
+    return load(limit)
+
+
 def create_message(
     db: Session, message: schemas.OneToOneMessageCreate
 ) -> models.OneToOneMessage:
@@ -166,6 +300,7 @@ def create_message(
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
+    recent_conversation_messages.append(db_message.conversation_id, lambda: schemas.OneToOneMessageOut.model_validate(db_message)) # type: ignore
 
     update_conversation_last_message(
         db=db,
@@ -177,6 +312,28 @@ def create_message(
     return db_message
 
 
+def get_messages_after(db: Session, conversation_id: str, message_id: str, limit: int) -> Optional[List[models.OneToOneMessage]]:
+    """
+    Retrieves the messages of a conversation sent after `message_id`, oldest first,
+    for resuming a WebSocket. Messages sharing its timestamp may be repeated.
+    Returns None if `message_id` is not in the conversation or more than `limit` messages follow it.
+    """
+    anchor = db.query(models.OneToOneMessage.created_at).filter(
+        models.OneToOneMessage.id == message_id,
+        models.OneToOneMessage.conversation_id == conversation_id
+    ).first()
+    if anchor is None:
+        return None
+    messages = db.query(models.OneToOneMessage).filter(
+        models.OneToOneMessage.conversation_id == conversation_id,
+        models.OneToOneMessage.created_at >= anchor.created_at,
+        models.OneToOneMessage.id != message_id
+    ).order_by(models.OneToOneMessage.created_at).limit(limit + 1).all()
+    if len(messages) > limit:
+        return None
+    return messages
+
+
 def delete_message(db: Session, message_id: str) -> bool:
     """
     Deletes a one-to-one message by its ID.
@@ -187,6 +344,7 @@ def delete_message(db: Session, message_id: str) -> bool:
         return False
     db.delete(db_message)
     db.commit()
+    recent_conversation_messages.drop(db_message.conversation_id) # type: ignore
     return True
 
 def get_conversation_request(db: Session, request_id: str) -> Optional[models.ConversationRequest]:
@@ -353,7 +511,18 @@ def get_community(db: Session, community_id: str) -> Optional[models.Community]:
     """
     Retrieves a single community by its ID.
     """
-    return db.query(models.Community).filter(models.Community.id == community_id).first()
+    return _get_cached(db, community_entities, models.Community, community_id)
+
+
+def get_community_row(db: Session, community_id: str):
+    """
+    Retrieves the columns of schemas.CommunityOut for a community, without building the ORM object.
+    Returns None if the community does not exist.
+    """
+    return db.query(
+        models.Community.id, models.Community.name, models.Community.description,
+        models.Community.created_at, models.Community.updated_at,
+    ).filter(models.Community.id == community_id).first()
 
 
 def get_communities(db: Session, skip: int = 0, limit: int = 100) -> List[models.Community]:
@@ -388,7 +557,9 @@ def update_community(db: Session, community_id: str, community_update: schemas.C
     for key, value in community_update.model_dump(exclude_unset=True).items():
         setattr(db_community, key, value)
     db.commit()
+    community_entities.invalidate(str(community_id))
     db.refresh(db_community)
+    recent_community_messages.drop(community_id)
     return db_community
 
 
@@ -402,6 +573,9 @@ def delete_community(db: Session, community_id: str) -> bool:
         return False
     db.delete(db_community)
     db.commit()
+    community_entities.invalidate(str(community_id))
+    community_members.drop(community_id)
+    recent_community_messages.drop(community_id)
     return True
 
 
@@ -476,6 +650,7 @@ def create_membership(db: Session, membership: schemas.MembershipCreate) -> mode
     db.add(db_membership)
     db.commit()
     db.refresh(db_membership)
+    community_members.add(db_membership.community_id, db_membership.user_id) # type: ignore
     return db_membership
 
 
@@ -500,25 +675,37 @@ def delete_membership(db: Session, membership_id: str) -> bool:
     db_membership = get_membership(db, membership_id)
     if not db_membership:
         return False
+    community_id, user_id = db_membership.community_id, db_membership.user_id
     db.delete(db_membership)
     db.commit()
+    community_members.remove(community_id, user_id) # type: ignore
     return True
 
 
 def is_user_community_member(db: Session, user_id: str, community_id: str) -> bool:
     """
     Checks if a user is a member of a specific community.
+    Answers from the membership cache, loading the community's member ids on a miss.
+    A cached "no" is confirmed in the database, since another worker may have
+    added the membership.
     """
-    return db.query(models.Membership).filter(
-        models.Membership.user_id == str(user_id),
-        models.Membership.community_id == str(community_id)
-    ).first() is not None
+    def load(limit: Optional[int]):
+        return [row.user_id for row in db.query(models.Membership.user_id)
+                .filter(models.Membership.community_id == str(community_id)).limit(limit)]
+
+    def confirm():
+        return db.query(models.Membership.id).filter(
+            models.Membership.user_id == str(user_id),
+            models.Membership.community_id == str(community_id)
+        ).first() is not None
+
+    return community_members.contains(community_id, user_id, load, confirm)
 
 def get_community_message(db: Session, message_id: str) -> Optional[models.CommunityMessage]:
     """
     Retrieves a single community message by its ID.
     """
-    return db.query(models.CommunityMessage).filter(models.CommunityMessage.id == message_id).first()
+    return _get_cached(db, community_message_entities, models.CommunityMessage, message_id)
 
 
 def get_community_messages_by_community(db: Session, community_id: str, skip: int = 0, limit: int = 20) -> List[models.CommunityMessage]:
@@ -544,6 +731,7 @@ def create_community_message(db: Session, message: schemas.CommunityMessageCreat
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
+    recent_community_messages.append(db_message.community_id, lambda: schemas.CommunityMessageOut.model_validate(db_message)) # type: ignore
     return db_message
 
 
@@ -556,7 +744,9 @@ def update_community_message(db: Session, message_id: str, content: str) -> Opti
         return None
     db_message.content = content # type: ignore
     db.commit()
+    community_message_entities.invalidate(str(message_id))
     db.refresh(db_message)
+    recent_community_messages.drop(db_message.community_id) # type: ignore
     return db_message
 
 
@@ -570,6 +760,8 @@ def delete_community_message(db: Session, message_id: str) -> bool:
         return False
     db.delete(db_message)
     db.commit()
+    community_message_entities.invalidate(str(message_id))
+    recent_community_messages.drop(db_message.community_id) # type: ignore
     return True
 
 def get_reply(db: Session, reply_id: str) -> Optional[models.Reply]:
@@ -647,6 +839,72 @@ def get_community_discussion_paginated(db: Session, community_id: str, skip: int
     return messages
 
 
+def get_community_activity_after(db: Session, community_id: str, message_id: str, limit: int) -> Optional[List[Union[models.CommunityMessage, models.Reply]]]:
+    """
+    Retrieves the messages and replies posted in a community after `message_id`
+    (itself a message or a reply), oldest first, for resuming a WebSocket.
+    Returns None if `message_id` is not in the community or more than `limit` items follow it.
+    """
+    anchor = db.query(models.CommunityMessage.created_at).filter(
+        models.CommunityMessage.id == message_id,
+        models.CommunityMessage.community_id == community_id
+    ).first()
+    if anchor is None:
+        anchor = db.query(models.Reply.created_at)\
+            .join(models.CommunityMessage, models.Reply.message_id == models.CommunityMessage.id)\
+            .filter(models.Reply.id == message_id, models.CommunityMessage.community_id == community_id)\
+            .first()
+    if anchor is None:
+        return None
+    messages = db.query(models.CommunityMessage)\
+        .options(joinedload(models.CommunityMessage.sender_obj))\
+        .filter(
+            models.CommunityMessage.community_id == community_id,
+            models.CommunityMessage.created_at >= anchor.created_at,
+            models.CommunityMessage.id != message_id
+        )\
+        .order_by(models.CommunityMessage.created_at)\
+        .limit(limit + 1)\
+        .all()
+    replies = db.query(models.Reply)\
+        .join(models.CommunityMessage, models.Reply.message_id == models.CommunityMessage.id)\
+        .filter(
+            models.CommunityMessage.community_id == community_id,
+            models.Reply.created_at >= anchor.created_at,
+            models.Reply.id != message_id
+        )\
+        .order_by(models.Reply.created_at)\
+        .limit(limit + 1)\
+        .all()
+    activity: List[Union[models.CommunityMessage, models.Reply]] = sorted([*messages, *replies], key=lambda item: item.created_at)
+    if len(activity) > limit:
+        return None
+    return activity
+
+
+def get_recent_community_messages(db: Session, community_id: str, limit: int = 20) -> List[schemas.CommunityMessageOut]:
+    """
+    Retrieves the first discussion page: the newest `limit` messages of a community, newest first.
+    Served from the recent-message cache when it holds enough of the community.
+    """
+    def load(count: int) -> List[schemas.CommunityMessageOut]:
+        messages = db.query(models.CommunityMessage)\
+            .options(
+                joinedload(models.CommunityMessage.sender_obj),
+                joinedload(models.CommunityMessage.community_obj)
+            )\
+            .filter(models.CommunityMessage.community_id == community_id)\
+            .order_by(models.CommunityMessage.created_at.desc())\
+            .limit(count)\
+            .all()
+        return [schemas.CommunityMessageOut.model_validate(message) for message in reversed(messages)]
+
+    cached = recent_community_messages.get(community_id, limit, load)
+    if cached is None:
+        cached = load(limit)
+    return cached[::-1]
+
+
 def search_users_in_community(db: Session, community_id: str, name_startswith: Optional[str] = None) -> List[models.User]:
     """
     Searches for users within a specific community, optionally filtering by name.
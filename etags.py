@@ -0,0 +1,52 @@
+import hashlib
+from typing import Any, Dict, Optional
+from fastapi import Request, Response
+import metrics
+
+# Conditional GET for polled read endpoints. An ETag is a hash of the values a
+# representation is built from, so routes can answer If-None-Match with a 304
+# before loading related objects or serializing the body.
+
+_counts: Dict[str, int] = {"checked": 0, "not_modified": 0}
+metrics.register("http.etags", lambda: dict(_counts))
+
+
+def make_etag(*parts: Any) -> str:
+    """
+    A weak ETag over `parts`. Weak, since equal values give an equivalent body
+    but not necessarily the same bytes.
+    """
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    """
+    Whether the request's If-None-Match lists `etag`, with the weak comparison
+    RFC 9110 prescribes for it.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in header.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque:
+            return True
+    return False
+
+
+def conditional(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """
+    Sets the ETag on the route's `response`. Returns a 304 to send instead when
+    the client already holds this version.
+    """
+    _counts["checked"] += 1
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if if_none_match(request, etag):
+        _counts["not_modified"] += 1
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
@@ -1,17 +1,37 @@
-from fastapi import FastAPI, WebSocket, Depends
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, WebSocket, status
+from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.websockets import WebSocketState
 from proj_websockets.chat_ws import handle_chat_websocket
 from proj_websockets.community_ws import handle_community_websocket
-from database import get_db
-from routers import users, chat, community
+from proj_websockets.user_ws import handle_user_websocket
+from database import scoped_session
+from routers import users, chat, community, debug
 from database import Base, engine
+import profiling
+import metrics
+import revocation
+import auth
+from proj_websockets import drain, pubsub
 
 Base.metadata.create_all(bind=engine)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    revocation.start_sync()
+    await pubsub.start()
+    drain.install()
+    yield
+    drain.uninstall()
+    await pubsub.stop()
+    revocation.stop_sync()
+
 app = FastAPI(
     title="FastAPI Chat Backend",
     description="Backend API for a real-time chat application with user authentication and conversation management.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -22,23 +42,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if profiling.PROFILER_ENABLED:
+    app.add_middleware(profiling.ProfilerMiddleware)
+
 app.include_router(users.router, prefix="/users", tags=["Users"])
 app.include_router(chat.router, prefix="/chat", tags=["Chat"])
 app.include_router(community.router, prefix="/community", tags=["Community"])
 
+if profiling.PROFILER_ENABLED:
+    app.include_router(debug.router, prefix="/debug", tags=["Debug"])
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the FastAPI Chat Backend!"}
 
+if metrics.METRICS_TOKEN:
+    @app.get("/metrics")
+    def read_metrics(x_metrics_token: Optional[str] = Header(None)):
+        """
+        Process-local cache, pool and connection metrics for this worker.
+        Requires the `X-Metrics-Token` header to match METRICS_TOKEN.
+        """
+        if not metrics.is_authorized(x_metrics_token):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to read metrics")
+        return metrics.snapshot()
+
 @app.websocket("/ws/chat/{conversation_id}/")
-async def chat_websocket_endpoint(websocket: WebSocket, conversation_id: str, db=Depends(get_db)):
+async def chat_websocket_endpoint(websocket: WebSocket, conversation_id: str):
     print(f"--- Attempting WebSocket connection for chat: {conversation_id} ---")
+    with scoped_session("ws.auth") as db:
+        user = auth.authenticate_websocket(websocket, db)
+    if user is None:
+        await websocket.close(code=1008, reason="Not authenticated")
+        return
+    websocket.state.user = user
     try:
-        await handle_chat_websocket(websocket, conversation_id, db)
+        await handle_chat_websocket(websocket, conversation_id)
     except Exception as e:
         print(f"!!! Error in chat_websocket_endpoint: {e} !!!")
-        await websocket.close(code=1011, reason=f"Internal Server Error: {e}")
+        if websocket.application_state == WebSocketState.CONNECTED and websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close(code=1011, reason=f"Internal Server Error: {e}")
 
 @app.websocket("/ws/community/{community_id}/")
-async def community_websocket_endpoint(websocket: WebSocket, community_id: str, db=Depends(get_db)):
-    await handle_community_websocket(websocket, community_id, db)
\ No newline at end of file
+async def community_websocket_endpoint(websocket: WebSocket, community_id: str):
+    with scoped_session("ws.auth") as db:
+        user = auth.authenticate_websocket(websocket, db)
+    if user is None:
+        await websocket.close(code=1008, reason="Not authenticated")
+        return
+    websocket.state.user = user
+    await handle_community_websocket(websocket, community_id)
+
+@app.websocket("/ws/")
+async def user_websocket_endpoint(websocket: WebSocket):
+    with scoped_session("ws.auth") as db:
+        user = auth.authenticate_websocket(websocket, db)
+    if user is None:
+        await websocket.close(code=1008, reason="Not authenticated")
+        return
+    websocket.state.user = user
+    await handle_user_websocket(websocket)
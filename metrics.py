@@ -0,0 +1,38 @@
+import os
+import secrets
+from typing import Callable, Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# GET /metrics is only served when METRICS_TOKEN is set, to requests sending it
+# in an X-Metrics-Token header.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Process-local metrics. Components register a callable returning their current
+# values; GET /metrics in main.py returns a snapshot of every registered source.
+_sources: Dict[str, Callable[[], Dict]] = {}
+
+
+def register(name: str, source: Callable[[], Dict]):
+    """
+    Registers (or replaces) a metrics source under `name`.
+    """
+    _sources[name] = source
+
+
+def snapshot() -> Dict[str, Dict]:
+    """
+    Returns the current values of every registered source.
+    """
+    return {name: source() for name, source in sorted(_sources.items())}
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """
+    Checks a client-supplied token against METRICS_TOKEN.
+    Always False when no token is configured.
+    """
+    if not METRICS_TOKEN or not token:
+        return False
+    return secrets.compare_digest(token, METRICS_TOKEN)
@@ -180,3 +180,18 @@ class Reply(Base):
 
     def __repr__(self):
         return f"<Reply(id='{self.id}', message_id='{self.message_id}', sender_id='{self.sender_id}')>"
+
+
+class TokenRevocation(Base):
+    __tablename__ = "token_revocation"
+
+    # A row either revokes one access token (jti) or records that a user's
+    # token claims became stale (user_id), e.g. after an update or deactivation.
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    jti = Column(String(64), nullable=True, index=True)
+    user_id = Column(String(36), nullable=True)
+    revoked_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<TokenRevocation(id='{self.id}', jti='{self.jti}', user_id='{self.user_id}')>"
@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+import metrics
+
+load_dotenv()
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+# min/max rounds are pinned to the configured cost so that verify_and_update
+# flags any hash created with a different work factor for rehashing.
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+
+class HashingPool:
+    """
+    Dedicated, size-limited executor for bcrypt work.
+    Keeps password hashing off the shared AnyIO threadpool so a burst of logins
+    cannot starve the sync routes. When more than `max_queue` jobs are waiting,
+    new ones are rejected with 503 instead of queueing without bound.
+    """
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, fn: Callable, *args) -> Any:
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many concurrent password operations, please retry",
+                    headers={"Retry-After": "1"},
+                )
+            self.queued += 1
+        submitted = time.perf_counter()
+
+        def job():
+            wait = time.perf_counter() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.in_flight += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+
+        return await asyncio.wrap_future(self._executor.submit(job))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "rounds": BCRYPT_ROUNDS,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / self.completed * 1000, 3) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+
+pool = HashingPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+metrics.register("password_hashing", pool.stats)
+
+
+async def hash_password(password: str) -> str:
+    """
+    Hashes a plain password on the hashing pool.
+    """
+    return await pool.run(pwd_context.hash, password)
+
+
+async def verify_and_update(password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """
+    Verifies a password on the hashing pool.
+    Returns (verified, new_hash); new_hash is set when the stored hash used a
+    different work factor and should be replaced.
+    """
+    if not hashed:
+        return False, None
+    return await pool.run(pwd_context.verify_and_update, password, hashed)
+
+
+def hash_password_sync(password: str) -> str:
+    """
+    Hashes a plain password in the calling thread, for sync callers outside a request.
+    """
+    return pwd_context.hash(password)
@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import random
+import secrets
+import threading
+import cProfile
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
+PROFILER_SAMPLE_RATE = float(os.getenv("PROFILER_SAMPLE_RATE", "0"))
+PROFILER_OUTPUT_DIR = os.getenv("PROFILER_OUTPUT_DIR", "profiles")
+PROFILER_FORMAT = os.getenv("PROFILER_FORMAT", "collapsed")
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+PROFILE_HEADER = b"x-profile"
+
+# Held while a request is being profiled. Both formats observe the whole
+# process (every thread, or every task on the event loop), so a profile is only
+# attributable to its request while no other profiled request overlaps it.
+# cProfile also allows a single active profiler per thread.
+_request_profile_lock = threading.Lock()
+
+# Frames that mean "this thread is parked", e.g. an idle threadpool worker
+# or the event loop sitting in select(). They are left out of the output.
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+}
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES
+
+
+def _collapse(frame) -> str:
+    """
+    Renders a frame and its callers as a root-first, semicolon separated stack.
+    """
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    parts.reverse()
+    return ";".join(parts)
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread in the process at a fixed interval.
+    Covers both the event loop thread (async routes and WebSocket handlers) and
+    the AnyIO threadpool workers that run sync routes. Each stack is rooted at
+    the thread name so the two can be told apart in a flame graph.
+    """
+    def __init__(self, interval_ms: float = PROFILER_INTERVAL_MS, max_seconds: float = PROFILER_MAX_SECONDS):
+        self.interval = interval_ms / 1000.0
+        self.max_seconds = max_seconds
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or _is_idle(frame):
+                    continue
+                self.samples[f"{names.get(ident, ident)};{_collapse(frame)}"] += 1
+
+    def write_collapsed(self, path: str) -> str:
+        """
+        Writes the samples in the collapsed-stack format understood by
+        flamegraph.pl, speedscope and similar tools.
+        """
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def _output_path(kind: str, label: str, extension: str) -> str:
+    os.makedirs(PROFILER_OUTPUT_DIR, exist_ok=True)
+    slug = "".join(c if c.isalnum() else "_" for c in label).strip("_") or "root"
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    return os.path.join(PROFILER_OUTPUT_DIR, f"{timestamp}-{kind}-{slug}.{extension}")
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """
+    Checks a client-supplied token against PROFILER_TOKEN.
+    Always False when no token is configured.
+    """
+    if not PROFILER_TOKEN or not token:
+        return False
+    return secrets.compare_digest(token, PROFILER_TOKEN)
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware that profiles individual HTTP requests or WebSocket sessions.
+    A request is profiled when it carries an `X-Profile` header matching
+    PROFILER_TOKEN, or when it is picked by PROFILER_SAMPLE_RATE.
+
+    PROFILER_FORMAT=collapsed samples all threads; PROFILER_FORMAT=pstats uses
+    cProfile, which only sees the event loop thread and is therefore meant for
+    async routes and WebSocket handlers. Either way the profile covers all work
+    done while the request runs, not only its own: one request is profiled at
+    a time, and requests arriving meanwhile run unprofiled.
+
+    main.py only installs this middleware when PROFILER_ENABLED is set.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == PROFILE_HEADER:
+                return is_authorized(value.decode("latin-1"))
+        return PROFILER_SAMPLE_RATE > 0 and random.random() < PROFILER_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        label = f"{scope.get('method', 'WS')}{scope['path']}"
+        if not _request_profile_lock.acquire(blocking=False):
+            print(f"Not profiling {label}: another request is being profiled")
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self._profile(scope, receive, send, label)
+        finally:
+            _request_profile_lock.release()
+
+    async def _profile(self, scope, receive, send, label: str):
+        if PROFILER_FORMAT == "pstats":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                profiler.disable()
+                path = _output_path(scope["type"], label, "pstats")
+                profiler.dump_stats(path)
+                print(f"Profile written to {path}")
+            return
+
+        sampler = StackSampler().start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.stop()
+            path = sampler.write_collapsed(_output_path(scope["type"], label, "collapsed"))
+            print(f"Profile written to {path}")
+
+
+def profile_window_start() -> StackSampler:
+    """
+    Starts sampling the whole process; used for time-window profiles of the event loop
+    and threadpool rather than of a single request.
+    """
+    return StackSampler().start()
+
+
+def profile_window_finish(sampler: StackSampler) -> str:
+    sampler.stop()
+    return sampler.write_collapsed(_output_path("window", "process", "collapsed"))
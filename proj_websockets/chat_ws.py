@@ -1,111 +1,159 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List
-import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 from sqlalchemy.orm import Session
 from datetime import datetime
 import crud
+import models
+from database import scoped_session
 import schemas
-import uuid
-
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, conversation_id: str):
-        await websocket.accept()
-        if conversation_id not in self.active_connections:
-            self.active_connections[conversation_id] = []
-        self.active_connections[conversation_id].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, conversation_id: str):
-        if conversation_id in self.active_connections:
-            if websocket in self.active_connections[conversation_id]:
-                self.active_connections[conversation_id].remove(websocket)
-                if not self.active_connections[conversation_id]:
-                    del self.active_connections[conversation_id]
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str, conversation_id: str):
-        if conversation_id in self.active_connections:
-            for connection in self.active_connections[conversation_id]:
-                await connection.send_text(message)
+from proj_websockets import frames, ratelimit
+from proj_websockets.manager import ConnectionManager, valid_room_id
+from proj_websockets.replay import WS_REPLAY_DB_LIMIT
+
+manager = ConnectionManager("chat", room_key="conversation_id")
+
+
+def message_frame(message: models.OneToOneMessage) -> Dict[str, Any]:
+    """
+    The frame broadcast for a stored message, live or replayed on resume.
+    """
+    return {
+        "id": str(message.id),
+        "conversation_id": str(message.conversation_id),
+        "content": message.content,
+        "sender_id": str(message.sender_id),
+        "created_at": message.created_at.isoformat(),
+        "type": "message"
+    }
+
+
+def load_gap(db: Session, conversation_id: str, last_id: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Frames for the messages after `last_id`, for resumes the replay buffer cannot serve.
+    """
+    messages = crud.get_messages_after(db, conversation_id, last_id, WS_REPLAY_DB_LIMIT)
+    if messages is None:
+        return None
+    return [message_frame(message) for message in messages]
+
+
+async def process_chat_frame(
+    db: Session,
+    user,
+    conversation_id: str,
+    frame: frames.PostFrame,
+    reply: Callable[[str], Awaitable[None]],
+):
+    """
+    Validates, stores and broadcasts one frame sent to a conversation by `user`,
+    who was already checked to be a participant. Problems are reported through `reply`.
+    Shared by /ws/chat/{conversation_id}/ and the multiplexed /ws/ endpoint.
+    """
+    if frame.type == "typing":
+        manager.presence.typing(conversation_id, str(user.id)) # type: ignore
+        return
+
+    message_content = frame.content
+    sender_id = user.id
+    timestamp = datetime.utcnow()
+
+    if not message_content:
+        await reply("Missing 'content'")
+        return
+
+    # sender_id is optional in frames; when present it must match the authenticated user.
+    if frame.sender_id not in (None, sender_id):
+        await reply("Not authorized to send message as this user")
+        return
+
+    # Step 1: Create message schema (pydantic parses the UUID strings)
+    message_obj = schemas.OneToOneMessageCreate(
+        content=message_content,
+        sender_id=sender_id,
+        conversation_id=conversation_id,
+    )
+
+    # Step 2: Store in DB
+    saved_msg = crud.create_message(db=db, message=message_obj)
+
+    # Step 3: Broadcast to all participants
+    await manager.broadcast(message_frame(saved_msg), conversation_id)
+
+    # Step 4: Optionally update conversation metadata
+    crud.update_conversation_last_message(
+        db=db,
+        conversation_id=conversation_id,
+        message_content=message_content,
+        timestamp=timestamp
+    )
 
-manager = ConnectionManager()
 
 async def handle_chat_websocket(
     websocket: WebSocket,
     conversation_id: str,
-    db: Session,
-    # === REMOVE THIS PARAMETER: current_user: models.User
 ):
+    """
+    Handles WebSocket communication for a one-to-one conversation.
+    The user was authenticated during the handshake (websocket.state.user) and
+    is checked to be a participant once here; frames are sent as that user.
+    A client reconnecting with ?last_id=<message id> first receives the messages
+    it missed, or {"type": "resync"} if it must refetch the history.
+    {"type": "typing"} frames are rate limited and reported in presence frames.
+    Frames are JSON text or MessagePack binary (see frames.RoomFrame); invalid
+    ones are answered with {"type": "error", "detail": ...}.
+    Every frame borrows its own DB session, so an idle socket holds no connection.
+    """
+    user = websocket.state.user
+
+    async def reply(text: str):
+        await manager.send_personal_message(frames.error_frame(text), websocket)
+
     try:
-        await manager.connect(websocket, conversation_id)
+        # Checked before joining, so outsiders never see or show up in the room's presence.
+        allowed = False
+        if valid_room_id(conversation_id):
+            with scoped_session("ws.join") as db:
+                allowed = crud.is_conversation_participant(db, user.id, conversation_id)
+        if not allowed:
+            await websocket.accept()
+            await manager.close(websocket, code=1008, reason="Conversation not found or accessible.")
+            return
 
-        # Check conversation exists (removed current_user check)
-        conversation = crud.get_conversation(db=db, conversation_id=conversation_id)
-        if not conversation:
-            await websocket.close(code=1008, reason="Conversation not found or accessible.")
+        if not await manager.connect(websocket, conversation_id):
             return
 
-        # await manager.send_personal_message(f"You joined conversation: {conversation.id}", websocket) # Removed user email
+        last_id = websocket.query_params.get("last_id")
+        if last_id:
+            with scoped_session("ws.resume") as db:
+                resumed = manager.resume(websocket, conversation_id, last_id, lambda: load_gap(db, conversation_id, last_id))
+            if not resumed:
+                await manager.send_personal_message({"type": "resync", "conversation_id": conversation_id}, websocket)
+
+        # await manager.send_personal_message(f"You joined conversation: {conversation_id}", websocket) # Removed user email
 
         while True:
             try:
-                data = await websocket.receive_text()
-                message_data = json.loads(data)
-
-                message_content = message_data.get("content", "").strip()
-                sender_id = message_data.get("sender_id") # Now sender_id comes directly from frontend, less secure!
-                timestamp = datetime.utcnow()
-
-                if not message_content or not sender_id:
-                    await manager.send_personal_message("Missing 'content' or 'sender_id'", websocket)
+                data = await frames.receive(websocket)
+                manager.touch(websocket)
+                if not await manager.allow(websocket, "frame"):
+                    continue
+                frame = frames.decode(frames.room_frames, data)
+                if await manager.handle_heartbeat(websocket, frame):
                     continue
+                if not await manager.allow(websocket, ratelimit.category_of(frame)):
+                    continue
+                with scoped_session("ws.chat") as db:
+                    await process_chat_frame(db, user, conversation_id, frame, reply)
 
-                # === IMPORTANT SECURITY NOTE:
-                # If you're not authenticating, the sender_id provided by the client
-                # cannot be trusted. Anyone can claim to be any sender_id.
-                # If sender_id is meant to represent the current user,
-                # you will have to find another way to establish their identity.
-                # For basic functionality, you can proceed, but be aware of the implications.
-                # If sender_id is still a UUID, ensure it's converted correctly.
-
-                # Step 1: Create message schema
-                message_obj = schemas.OneToOneMessageCreate(
-                    content=message_content,
-                    sender_id=uuid.UUID(sender_id), # Ensure it's a valid UUID
-                    conversation_id=uuid.UUID(conversation_id),
-                )
-
-                # Step 2: Store in DB
-                saved_msg = crud.create_message(db=db, message=message_obj)
-
-                # Step 3: Broadcast to all participants
-                response = {
-                    "conversation_id": conversation_id,
-                    "content": message_content,
-                    "sender_id": str(sender_id), # Still send back as string
-                    "created_at": timestamp.isoformat(),
-                    "type": "message"
-                }
-                await manager.broadcast(json.dumps(response), conversation_id)
-
-                # Step 4: Optionally update conversation metadata
-                crud.update_conversation_last_message(
-                    db=db,
-                    conversation_id=conversation_id,
-                    message_content=message_content,
-                    timestamp=timestamp
-                )
-
-            except json.JSONDecodeError:
-                await manager.send_personal_message("Invalid JSON format.", websocket)
+            except frames.FrameError as e:
+                await reply(e.detail)
 
     except WebSocketDisconnect:
         manager.disconnect(websocket, conversation_id)
         await manager.broadcast(f"Client left the conversation {conversation_id}", conversation_id) # Removed current_user.email
     except Exception as e:
         print(f"An error occurred in chat_websocket: {e}")
-        await websocket.close(code=1011, reason=f"Server error: {e}")
\ No newline at end of file
+        await manager.close(websocket, code=1011, reason=f"Server error: {e}")
+    finally:
+        # Any exit path must drop the socket, otherwise it stays in every later broadcast.
+        manager.disconnect(websocket, conversation_id)
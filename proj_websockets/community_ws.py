@@ -1,178 +1,207 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List
-import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 from sqlalchemy.orm import Session
-from datetime import datetime
 import crud
+import models
+from database import scoped_session
 import schemas
-import uuid
+from proj_websockets import frames, ratelimit
+from proj_websockets.manager import ConnectionManager, valid_room_id
+from proj_websockets.replay import WS_REPLAY_DB_LIMIT
 
-class ConnectionManager:
+manager = ConnectionManager("community", room_key="community_id")
+
+
+def message_frame(message: models.CommunityMessage) -> Dict[str, Any]:
     """
-    Manages active WebSocket connections for different communities.
-    Each community_id can have multiple active WebSocket connections.
+    The frame broadcast for a stored community message, live or replayed on resume.
     """
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, community_id: str):
-        """
-        Accepts a new WebSocket connection and adds it to the active connections
-        for the specified community.
-        """
-        await websocket.accept()
-        if community_id not in self.active_connections:
-            self.active_connections[community_id] = []
-        self.active_connections[community_id].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, community_id: str):
-        """
-        Removes a WebSocket connection from the active connections for its community.
-        If no connections remain for a community, its entry is removed from the dictionary.
-        """
-        if community_id in self.active_connections:
-            if websocket in self.active_connections[community_id]:
-                self.active_connections[community_id].remove(websocket)
-                if not self.active_connections[community_id]:
-                    del self.active_connections[community_id]
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        """
-        Sends a message to a single WebSocket connection.
-        """
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str, community_id: str):
-        """
-        Sends a message to all active WebSocket connections within a specific community.
-        """
-        if community_id in self.active_connections:
-            for connection in list(self.active_connections[community_id]):
-                try:
-                    await connection.send_text(message)
-                except RuntimeError as e:
-                    print(f"Error sending to a connection in community {community_id}: {e}")
-                    self.disconnect(connection, community_id)
-
-
-manager = ConnectionManager()
+    payload = {
+        "type": "message",
+        "id": str(message.id),
+        "sender_id": str(message.sender_id),
+        "content": message.content,
+        "created_at": message.created_at.isoformat(),
+        "community_id": str(message.community_id),
+    }
+    if message.sender_obj:
+        payload["sender_name"] = message.sender_obj.name
+    return payload
+
+
+def reply_frame(reply: models.Reply, community_id: str) -> Dict[str, Any]:
+    """
+    The frame broadcast for a stored reply, live or replayed on resume.
+    """
+    return {
+        "type": "reply",
+        "id": str(reply.id),
+        "sender_id": str(reply.sender_id),
+        "content": reply.content,
+        "created_at": reply.created_at.isoformat(),
+        "community_id": community_id,
+        "message_id": str(reply.message_id),
+    }
+
+
+def load_gap(db: Session, community_id: str, last_id: str) -> Optional[List[Dict[str, Any]]]:
+    """
+    Frames for the messages and replies after `last_id`, for resumes the replay buffer cannot serve.
+    """
+    activity = crud.get_community_activity_after(db, community_id, last_id, WS_REPLAY_DB_LIMIT)
+    if activity is None:
+        return None
+    return [
+        reply_frame(item, community_id) if isinstance(item, models.Reply) else message_frame(item)
+        for item in activity
+    ]
+
+
+async def process_community_frame(
+    db: Session,
+    user,
+    community_id: str,
+    frame: frames.PostFrame,
+    reply: Callable[[str], Awaitable[None]],
+):
+    """
+    Validates, stores and broadcasts one message or reply sent to a community by
+    `user`. Membership is checked on every post through the membership cache, so
+    users who join mid-session can post. Problems are reported through `reply`.
+    Shared by /ws/community/{community_id}/ and the multiplexed /ws/ endpoint.
+    """
+    msg_type = frame.type
+    if msg_type == "typing":
+        if crud.is_user_community_member(db, user.id, community_id):
+            manager.presence.typing(community_id, str(user.id)) # type: ignore
+        return
+
+    content = frame.content
+
+    if not content:
+        await reply("Missing 'content'.")
+        return
+
+    if frame.sender_id not in (None, user.id):
+        await reply("Not authorized to send message as this user")
+        return
+
+    if not crud.is_user_community_member(db, user.id, community_id):
+        await reply("You are not a member of this community.")
+        return
+
+    if msg_type == "message":
+        message_obj = schemas.CommunityMessageCreate(
+            community_id=community_id,
+            sender_id=user.id,
+            content=content,
+        )
+        saved_msg = crud.create_community_message(db=db, message=message_obj)
+        response_payload = message_frame(saved_msg)
+
+    elif msg_type == "reply":
+        message_id = frame.message_id
+        if not message_id:
+            await reply("Missing 'message_id' for reply.")
+            return
+
+        parent_message = crud.get_community_message(db, message_id)
+        if not parent_message or str(parent_message.community_id) != community_id:
+            await reply("Parent message not found for reply.")
+            return
+
+        reply_obj = schemas.ReplyCreate(
+            message_id=message_id,
+            sender_id=user.id,
+            content=content,
+        )
+        saved_reply = crud.create_reply(db=db, reply=reply_obj)
+        response_payload = reply_frame(saved_reply, community_id)
+
+    else:
+        await reply("Unknown message type. Expected 'message' or 'reply'.")
+        return
+
+    await manager.broadcast(response_payload, community_id)
+
 
 async def handle_community_websocket(
     websocket: WebSocket,
     community_id: str,
-    db: Session
 ):
     """
     Handles WebSocket communication for a specific community.
     It receives messages, stores them in the database, and broadcasts them.
-    Expected incoming message format (JSON):
+    The user was authenticated during the handshake (websocket.state.user),
+    so frames need no identity lookups. Non-members may listen but not post.
+    Expected incoming message format (JSON text, or MessagePack in binary frames):
     For new community messages:
     {
         "type": "message",
-        "sender_id": "uuid_of_sender",
         "content": "Your message content"
     }
     For replies to a message:
     {
         "type": "reply",
         "message_id": "uuid_of_parent_message",
-        "sender_id": "uuid_of_sender",
         "content": "Your reply content"
     }
+    Members may send {"type": "typing"}; it is rate limited and reported in presence frames.
+    A "sender_id" may still be included but must match the authenticated user.
+    A client reconnecting with ?last_id=<message or reply id> first receives what
+    it missed, or {"type": "resync"} if it must refetch the discussion.
+    Problems are answered with {"type": "error", "detail": ...}.
+    Every frame borrows its own DB session, so an idle socket holds no connection.
     """
-    try:
-        await manager.connect(websocket, community_id)
+    user = websocket.state.user
+    community = None
+
+    async def reply(text: str):
+        await manager.send_personal_message(frames.error_frame(text), websocket)
 
-        community = crud.get_community(db=db, community_id=community_id)
+    try:
+        # Checked before joining: the id becomes a room key and a pub/sub channel name.
+        if valid_room_id(community_id):
+            with scoped_session("ws.join") as db:
+                community = crud.get_community(db=db, community_id=community_id)
         if not community:
-            await manager.send_personal_message("Community not found.", websocket)
-            await websocket.close(code=1008)
+            await websocket.accept()
+            await manager.close(websocket, code=1008, reason="Community not found.")
+            return
+
+        if not await manager.connect(websocket, community_id):
             return
 
+        last_id = websocket.query_params.get("last_id")
+        if last_id:
+            with scoped_session("ws.resume") as db:
+                resumed = manager.resume(websocket, community_id, last_id, lambda: load_gap(db, community_id, last_id))
+            if not resumed:
+                await manager.send_personal_message({"type": "resync", "community_id": community_id}, websocket)
+
         # await manager.send_personal_message(f"You joined community: {community.name}", websocket)
 
         while True:
             try:
-                data = await websocket.receive_text()
-                message_data = json.loads(data)
-
-                msg_type = message_data.get("type")
-                sender_id = message_data.get("sender_id")
-                content = message_data.get("content", "").strip()
-                timestamp = datetime.utcnow()
-
-                if not sender_id or not content or not msg_type:
-                    await manager.send_personal_message("Missing 'type', 'sender_id', or 'content'.", websocket)
-                    continue
-
-                try:
-                    sender_uuid = uuid.UUID(sender_id)
-                except ValueError:
-                    await manager.send_personal_message("Invalid 'sender_id' format (must be UUID).", websocket)
-                    continue
-
-                user = crud.get_user(db, str(sender_uuid))
-                if not user:
-                    await manager.send_personal_message("Sender user not found.", websocket)
+                data = await frames.receive(websocket)
+                manager.touch(websocket)
+                if not await manager.allow(websocket, "frame"):
                     continue
-                
-                if not crud.is_user_community_member(db, str(sender_uuid), community_id):
-                    await manager.send_personal_message("You are not a member of this community.", websocket)
+                frame = frames.decode(frames.room_frames, data)
+                if await manager.handle_heartbeat(websocket, frame):
                     continue
-
-
-                response_payload = {
-                    "type": msg_type,
-                    "sender_id": str(sender_uuid),
-                    "content": content,
-                    "created_at": timestamp.isoformat(),
-                }
-
-                if msg_type == "message":
-                    message_obj = schemas.CommunityMessageCreate(
-                        community_id=uuid.UUID(community_id),
-                        sender_id=sender_uuid,
-                        content=content,
-                    )
-                    saved_msg = crud.create_community_message(db=db, message=message_obj)
-                    response_payload["id"] = str(saved_msg.id)
-                    response_payload["community_id"] = community_id
-                    if saved_msg.sender_obj:
-                        response_payload["sender_name"] = saved_msg.sender_obj.name
-                    
-                elif msg_type == "reply":
-                    message_id = message_data.get("message_id")
-                    if not message_id:
-                        await manager.send_personal_message("Missing 'message_id' for reply.", websocket)
-                        continue
-                    
-                    parent_message = crud.get_community_message(db, message_id)
-                    if not parent_message:
-                        await manager.send_personal_message("Parent message not found for reply.", websocket)
-                        continue
-
-                    reply_obj = schemas.ReplyCreate(
-                        message_id=uuid.UUID(message_id),
-                        sender_id=sender_uuid,
-                        content=content,
-                    )
-                    saved_reply = crud.create_reply(db=db, reply=reply_obj)
-                    response_payload["id"] = str(saved_reply.id)
-                    response_payload["message_id"] = message_id
-                    
-                else:
-                    await manager.send_personal_message("Unknown message type. Expected 'message' or 'reply'.", websocket)
+                if not await manager.allow(websocket, ratelimit.category_of(frame)):
                     continue
+                with scoped_session("ws.community") as db:
+                    await process_community_frame(db, user, community_id, frame, reply)
 
-                await manager.broadcast(json.dumps(response_payload), community_id)
-
-            except json.JSONDecodeError:
-                await manager.send_personal_message("Invalid JSON format.", websocket)
+            except frames.FrameError as e:
+                await reply(e.detail)
             except WebSocketDisconnect:
                 raise
             except Exception as e:
                 print(f"WebSocket error in community {community_id}: {e}")
-                await manager.send_personal_message(f"An error occurred: {e}", websocket)
+                await manager.send_personal_message({"type": "error", "detail": f"An error occurred: {e}"}, websocket)
 
     except WebSocketDisconnect:
         manager.disconnect(websocket, community_id)
@@ -180,4 +209,6 @@ async def handle_community_websocket(
             await manager.broadcast(f"Client left community {community_id}", community_id)
     except Exception as e:
         print(f"Error establishing community WebSocket connection: {e}")
-
+    finally:
+        # Any exit path must drop the socket, otherwise it stays in every later broadcast.
+        manager.disconnect(websocket, community_id)
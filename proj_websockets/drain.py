@@ -0,0 +1,148 @@
+import os
+import time
+import random
+import signal
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+# On SIGTERM the worker's sockets are closed over WS_DRAIN_SECONDS, WS_DRAIN_BATCH
+# at a time, before uvicorn shuts down. 0 leaves shutdown to uvicorn, which drops
+# them all at once.
+WS_DRAIN_SECONDS = float(os.getenv("WS_DRAIN_SECONDS", "10"))
+WS_DRAIN_BATCH = int(os.getenv("WS_DRAIN_BATCH", "100"))
+# How long frames already queued get to go out before the first batch is closed.
+WS_DRAIN_FLUSH_TIMEOUT = float(os.getenv("WS_DRAIN_FLUSH_TIMEOUT", "2"))
+# Closed clients are asked to wait a random delay of up to this many seconds before reconnecting.
+WS_DRAIN_RECONNECT_JITTER = float(os.getenv("WS_DRAIN_RECONNECT_JITTER", "5"))
+
+CLOSE_SERVICE_RESTART = 1012
+
+
+class Drain:
+    """
+    Graceful shutdown of this worker's WebSockets.
+
+    uvicorn closes every socket the moment it gets SIGTERM, and all clients
+    reconnect to the remaining workers within the same second. Instead, the
+    signal first puts the worker in drain mode: managers refuse new sockets,
+    queued frames are given WS_DRAIN_FLUSH_TIMEOUT to go out, and the open
+    sockets are closed in batches spread over WS_DRAIN_SECONDS, each told
+    to reconnect after a random delay. The signal is then passed on to the
+    handler it replaced (uvicorn's), which shuts the server down as before.
+    A second signal skips whatever is left of the drain.
+    """
+    def __init__(self):
+        self.managers: List[Any] = []
+        self.draining = False
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.closed = 0
+        self.unflushed = 0
+        self._previous: Dict[int, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, manager: Any):
+        self.managers.append(manager)
+
+    def install(self):
+        """
+        Hooks SIGTERM in front of the server's own handler; called from the
+        application lifespan, once uvicorn installed its handlers.
+        """
+        if not WS_DRAIN_SECONDS or threading.current_thread() is not threading.main_thread():
+            return
+        loop = asyncio.get_running_loop()
+        self._previous[signal.SIGTERM] = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, lambda sig, frame: self._on_signal(loop, sig, frame))
+
+    def uninstall(self):
+        for sig, previous in self._previous.items():
+            signal.signal(sig, previous)
+        self._previous.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def _on_signal(self, loop: asyncio.AbstractEventLoop, sig: int, frame: Any):
+        if self.draining:
+            print("Signal received again while draining; shutting down now")
+            self._forward(sig, frame)
+            return
+        # Signal handlers run between any two bytecodes; only schedule from here.
+        self.draining = True
+        loop.call_soon_threadsafe(self._start, sig, frame)
+
+    def _start(self, sig: int, frame: Any):
+        self._task = asyncio.get_running_loop().create_task(self._drain_then_forward(sig, frame))
+
+    async def _drain_then_forward(self, sig: int, frame: Any):
+        try:
+            await self.drain()
+        except Exception as e:
+            print(f"Error draining WebSockets: {e}")
+        finally:
+            self._forward(sig, frame)
+
+    def _forward(self, sig: int, frame: Any):
+        previous = self._previous.get(sig, signal.SIG_DFL)
+        if callable(previous):
+            previous(sig, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(sig, signal.SIG_DFL)
+            os.kill(os.getpid(), sig)
+
+    async def drain(self):
+        """
+        Stops accepting sockets, flushes the outbound queues, then closes the open
+        sockets with 1012 (and ends event streams) in paced batches.
+        """
+        self.draining = True
+        self.started = time.monotonic()
+        connections = [connection for manager in self.managers for connection in manager.connections()]
+        print(f"Draining {len(connections)} WebSocket connections and event streams over {WS_DRAIN_SECONDS:g}s")
+
+        deadline = self.started + WS_DRAIN_FLUSH_TIMEOUT
+        while any(connection.pending for connection in connections) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.unflushed = sum(1 for connection in connections if connection.pending)
+
+        batch_size = max(1, WS_DRAIN_BATCH)
+        batches = [connections[i:i + batch_size] for i in range(0, len(connections), batch_size)]
+        interval = WS_DRAIN_SECONDS / len(batches) if batches else 0
+        for index, batch in enumerate(batches):
+            if index:
+                await asyncio.sleep(interval)
+            for connection in batch:
+                connection.shed(random.uniform(0, WS_DRAIN_RECONNECT_JITTER))
+                self.closed += 1
+        writers = {connection.writer for connection in connections if connection.writer is not None and not connection.writer.done()}
+        if writers:
+            await asyncio.wait(writers, timeout=WS_DRAIN_FLUSH_TIMEOUT)
+        self.finished = time.monotonic()
+        print(f"Drained {self.closed} WebSocket connections and event streams in {self.finished - self.started:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "seconds": WS_DRAIN_SECONDS,
+            "batch": WS_DRAIN_BATCH,
+            "closed": self.closed,
+            "unflushed": self.unflushed,
+            "elapsed": round((self.finished or time.monotonic()) - self.started, 3) if self.started else None,
+        }
+
+
+coordinator = Drain()
+metrics.register("websockets.drain", coordinator.stats)
+
+
+def install():
+    coordinator.install()
+
+
+def uninstall():
+    coordinator.uninstall()
@@ -0,0 +1,139 @@
+import os
+import asyncio
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+import metrics
+from database import scoped_session
+from proj_websockets import drain
+from proj_websockets.manager import ConnectionManager, OutboundFrame
+
+load_dotenv()
+
+# Seconds between comment lines that keep idle streams open through proxies.
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+# Event streams per worker (0 = unlimited); requests over it get 503.
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "20000"))
+
+_counts: Dict[str, int] = {"open": 0, "opened": 0, "rejected": 0, "overflows": 0}
+metrics.register("websockets.event_streams", lambda: dict(_counts))
+
+
+class EventStream:
+    """
+    A Server-Sent Events client reading one room of a ConnectionManager.
+    Broadcasts are queued like for a WebSocket and written by the response
+    itself, so a reader costs a queue and no receive loop or DB session.
+    A reader that falls WS_SEND_QUEUE_SIZE frames behind is disconnected:
+    EventSource reconnects with Last-Event-ID and resumes where it left off.
+    """
+    def __init__(self, manager: ConnectionManager, room_id: str, last_id: Optional[str] = None, load_gap: Optional[Callable[[Session, str, str], Optional[List[Dict[str, Any]]]]] = None):
+        self.manager = manager
+        self.room_id = room_id
+        self.last_id = last_id
+        self.load_gap = load_gap
+        self.pending: Deque[OutboundFrame] = deque()
+        self.closing = False
+        self.retry_ms: Optional[int] = None
+        # The task writing the response, known once the body is being sent.
+        self.writer: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def enqueue(self, message: OutboundFrame, force: bool = False):
+        if self.closing:
+            return
+        if not force and len(self.pending) >= self.manager.queue_size:
+            _counts["overflows"] += 1
+            self.close_later()
+            return
+        self.pending.append(message)
+        self._wakeup.set()
+
+    def shed(self, reconnect_after: float):
+        """
+        Ends the stream once the queue is sent, asking the browser to wait
+        `reconnect_after` seconds before reconnecting. Used to drain the worker.
+        """
+        self.close_later(int(reconnect_after * 1000))
+
+    def close_later(self, retry_ms: Optional[int] = None):
+        self.closing = True
+        self.retry_ms = retry_ms
+        self._wakeup.set()
+
+    def _resume(self):
+        # Called right after joining the room, so the gap comes ahead of any live frame.
+        with scoped_session("sse.resume") as db:
+            frames = self.manager.gap(self.room_id, self.last_id, lambda: self.load_gap(db, self.room_id, self.last_id))
+        if frames is None:
+            frames = [OutboundFrame({"type": "resync", self.manager.room_key or "room": self.room_id})]
+        for frame in frames:
+            self.enqueue(frame, force=True)
+
+    async def body(self) -> AsyncIterator[str]:
+        # The stream joins its room only once the response starts, so a request
+        # abandoned before that leaves nothing behind.
+        self.writer = asyncio.current_task()
+        self.manager.open_stream(self)
+        _counts["open"] += 1
+        _counts["opened"] += 1
+        try:
+            if self.last_id and self.load_gap is not None:
+                self._resume()
+            while True:
+                while not self.pending and not self.closing:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), SSE_KEEPALIVE_INTERVAL or None)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                if not self.pending:
+                    if self.retry_ms is not None:
+                        yield f"retry: {self.retry_ms}\n\n"
+                    return
+                yield format_event(self.pending.popleft())
+        finally:
+            self.manager.close_stream(self)
+            _counts["open"] -= 1
+
+
+def format_event(frame: OutboundFrame) -> str:
+    """
+    One SSE event per frame, with the frame's JSON (encoded once per broadcast)
+    as data and its "id", if any, as the event id.
+    """
+    payload = frame.payload
+    if isinstance(payload, dict) and "id" in payload:
+        return f"id: {payload['id']}\ndata: {frame.wire_json()}\n\n"
+    return f"data: {frame.wire_json()}\n\n"
+
+
+def stream_room(
+    request: Request,
+    manager: ConnectionManager,
+    room_id: str,
+    load_gap: Callable[[Session, str, str], Optional[List[Dict[str, Any]]]],
+) -> StreamingResponse:
+    """
+    Opens an event stream of the room's broadcasts. A reconnecting EventSource
+    sends Last-Event-ID (a first connection may pass ?last_id=): the messages
+    since then are sent first, or a {"type": "resync"} event if the client must
+    refetch the history. Callers check access beforehand.
+    """
+    if drain.coordinator.draining:
+        _counts["rejected"] += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server restarting", headers={"Retry-After": "5"})
+    if SSE_MAX_STREAMS and _counts["open"] >= SSE_MAX_STREAMS:
+        _counts["rejected"] += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many event streams")
+
+    last_id = request.headers.get("last-event-id") or request.query_params.get("last_id")
+    stream = EventStream(manager, room_id, last_id, load_gap)
+    return StreamingResponse(
+        stream.body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
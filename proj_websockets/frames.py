@@ -0,0 +1,150 @@
+from functools import lru_cache
+from typing import Any, Literal, Optional, Union
+from typing_extensions import Annotated
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, ConfigDict, Discriminator, StringConstraints, Tag, TypeAdapter, ValidationError
+from proj_websockets.manager import OutboundFrame
+
+try:
+    import msgpack
+except ImportError:  # optional: only needed by clients sending binary MessagePack frames
+    msgpack = None
+
+
+# Inbound frame schemas. They are compiled once into the adapters below, so a
+# frame is decoded and validated in a single pass instead of json.loads plus
+# per-field checks. Unknown fields are ignored.
+
+class HeartbeatFrame(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    type: Literal["ping", "pong"]
+
+
+class PostFrame(BaseModel):
+    """
+    A message, reply or typing event sent to a chat or community room.
+    Which types a room accepts, and which fields they need, is up to its processor.
+    """
+    model_config = ConfigDict(extra="ignore")
+    type: Literal["message", "reply", "typing"] = "message"
+    content: Annotated[str, StringConstraints(strip_whitespace=True)] = ""
+    message_id: Optional[str] = None
+    # Optional; when present it must match the authenticated user.
+    sender_id: Optional[str] = None
+
+
+class SubscribeFrame(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    op: Literal["subscribe"]
+    room: str
+    last_id: Optional[Union[str, int]] = None
+
+
+class UnsubscribeFrame(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    op: Literal["unsubscribe"]
+    room: str
+
+
+class SendFrame(PostFrame):
+    op: Literal["send"]
+    room: str
+
+
+def _room_tag(value: Any) -> str:
+    kind = value.get("type") if isinstance(value, dict) else getattr(value, "type", None)
+    return "heartbeat" if kind in ("ping", "pong") else "post"
+
+
+def _mux_tag(value: Any) -> Optional[str]:
+    if isinstance(value, dict):
+        return value.get("op") or ("heartbeat" if value.get("type") in ("ping", "pong") else None)
+    return getattr(value, "op", None) or "heartbeat"
+
+
+# Frames of /ws/chat/{id}/ and /ws/community/{id}/; a frame without "type" is a message.
+RoomFrame = Annotated[
+    Union[Annotated[HeartbeatFrame, Tag("heartbeat")], Annotated[PostFrame, Tag("post")]],
+    Discriminator(_room_tag),
+]
+# Frames of the multiplexed /ws/, keyed by "op".
+MuxFrame = Annotated[
+    Union[
+        Annotated[HeartbeatFrame, Tag("heartbeat")],
+        Annotated[SubscribeFrame, Tag("subscribe")],
+        Annotated[UnsubscribeFrame, Tag("unsubscribe")],
+        Annotated[SendFrame, Tag("send")],
+    ],
+    Discriminator(_mux_tag, custom_error_type="invalid_op", custom_error_message="Unknown op. Expected 'subscribe', 'unsubscribe' or 'send'."),
+]
+
+room_frames: TypeAdapter = TypeAdapter(RoomFrame)
+mux_frames: TypeAdapter = TypeAdapter(MuxFrame)
+
+
+class FrameError(ValueError):
+    """
+    An inbound frame that could not be decoded or failed validation; `detail` is
+    a short description for the client.
+    """
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+def _describe(error: ValidationError) -> str:
+    first = error.errors(include_url=False, include_context=False, include_input=False)[0]
+    kind = first["type"]
+    field = ".".join(str(part) for part in first["loc"] if not isinstance(part, int) and part not in ("heartbeat", "post", "subscribe", "unsubscribe", "send"))
+    if kind == "json_invalid":
+        return "Invalid JSON format."
+    if kind in ("model_type", "model_attributes_type", "dict_type"):
+        return "Expected a JSON object."
+    if kind == "missing":
+        return f"Missing '{field}'."
+    if field:
+        return f"Invalid '{field}': {first['msg']}"
+    return first["msg"]
+
+
+def decode(adapter: TypeAdapter, data: Union[str, bytes]) -> Any:
+    """
+    Decodes and validates one inbound frame: JSON text frames, or MessagePack
+    in binary frames. Raises FrameError with a client-facing detail.
+    """
+    try:
+        if isinstance(data, str):
+            return adapter.validate_json(data)
+        if msgpack is None:
+            raise FrameError("Binary frames need MessagePack support on the server.")
+        try:
+            value = msgpack.unpackb(data)
+        except Exception:
+            raise FrameError("Invalid MessagePack frame.")
+        return adapter.validate_python(value)
+    except ValidationError as e:
+        raise FrameError(_describe(e))
+
+
+async def receive(websocket: WebSocket) -> Union[str, bytes]:
+    """
+    The next text or binary frame from the client.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    text = message.get("text")
+    if text is not None:
+        return text
+    return message.get("bytes") or b""
+
+
+@lru_cache(maxsize=1024)
+def error_frame(detail: str, room: Optional[str] = None, multiplexed: bool = False) -> OutboundFrame:
+    """
+    {"type": "error", "detail": ...}, plus the room on /ws/. The details come from
+    a small set of messages, so frames are cached and encoded once per wire encoding.
+    """
+    if multiplexed:
+        return OutboundFrame({"type": "error", "room": room, "detail": detail})
+    return OutboundFrame({"type": "error", "detail": detail})
@@ -0,0 +1,721 @@
+import os
+import json
+import zlib
+import time
+import uuid
+import struct
+import asyncio
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+from dotenv import load_dotenv
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
+import metrics
+from proj_websockets import drain, pubsub, ratelimit
+from proj_websockets.replay import ReplayBuffer
+from proj_websockets.presence import Presence
+
+try:
+    import msgpack
+except ImportError:  # optional: only needed by clients negotiating ?format=msgpack
+    msgpack = None
+
+load_dotenv()
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do with a client whose queue is full: "drop_oldest" or "disconnect".
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+WS_CLOSE_TIMEOUT = float(os.getenv("WS_CLOSE_TIMEOUT", "5"))
+
+WS_COMPRESSION_LEVEL = int(os.getenv("WS_COMPRESSION_LEVEL", "6"))
+# Coalescing for clients connecting with ?batch=1: in rooms receiving at least
+# WS_BATCH_HOT_RATE messages/sec the writer waits WS_BATCH_WINDOW_MS to gather
+# frames; elsewhere it only merges frames that are already queued.
+WS_BATCH_WINDOW_MS = float(os.getenv("WS_BATCH_WINDOW_MS", "20"))
+WS_BATCH_MAX = int(os.getenv("WS_BATCH_MAX", "64"))
+WS_BATCH_HOT_RATE = float(os.getenv("WS_BATCH_HOT_RATE", "50"))
+# Application-level heartbeats: a {"type": "ping"} frame goes to connections silent
+# for WS_HEARTBEAT_INTERVAL seconds; those silent for WS_IDLE_TIMEOUT are reaped.
+# Any frame from the client, e.g. {"type": "pong"}, counts as activity. 0 disables.
+# Reaping is off by default: listen-only clients that predate pongs never send anything.
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "0"))
+# Connection caps (0 = unlimited); connections over a cap are closed with 1013.
+# No per-user cap by default: existing clients open one socket per conversation.
+WS_MAX_CONNECTIONS_PER_ROOM = int(os.getenv("WS_MAX_CONNECTIONS_PER_ROOM", "10000"))
+WS_MAX_CONNECTIONS_PER_USER = int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "0"))
+WS_MAX_CONNECTIONS_PER_WORKER = int(os.getenv("WS_MAX_CONNECTIONS_PER_WORKER", "20000"))
+
+CLOSE_TRY_AGAIN_LATER = 1013
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "disconnect")
+
+if WS_SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(f"WS_SLOW_CONSUMER_POLICY must be one of {SLOW_CONSUMER_POLICIES}, got {WS_SLOW_CONSUMER_POLICY!r}")
+
+# (format, deflate) as negotiated by a client; JSON text frames unless asked otherwise.
+Encoding = Tuple[str, bool]
+DEFAULT_ENCODING: Encoding = ("json", False)
+
+_encode_counts: Dict[str, int] = {"json": 0, "msgpack": 0, "deflate": 0, "encoded_bytes": 0}
+metrics.register("websockets.encoding", lambda: dict(_encode_counts))
+
+
+class OutboundFrame:
+    """
+    A message shared by every recipient of a broadcast.
+    It is encoded lazily and at most once per wire encoding, so a room of N
+    clients costs one json.dumps (or msgpack/deflate pass) instead of N.
+    """
+    __slots__ = ("payload", "_encoded")
+
+    def __init__(self, payload: Union[str, Dict[str, Any]]):
+        self.payload = payload
+        self._encoded: Dict[Encoding, Union[str, bytes]] = {}
+
+    @classmethod
+    def from_json(cls, text: str) -> "OutboundFrame":
+        """
+        Rebuilds a frame published by another worker, reusing its JSON text for JSON clients.
+        """
+        frame = cls(json.loads(text))
+        if isinstance(frame.payload, dict):
+            frame._encoded[DEFAULT_ENCODING] = text
+        return frame
+
+    def wire_json(self) -> str:
+        """
+        The payload as JSON, for handing the frame to other workers.
+        """
+        if isinstance(self.payload, str):
+            return json.dumps(self.payload)
+        return self.encode(DEFAULT_ENCODING) # type: ignore
+
+    def encode(self, encoding: Encoding) -> Union[str, bytes]:
+        data = self._encoded.get(encoding)
+        if data is not None:
+            return data
+        fmt, deflate = encoding
+        if deflate:
+            plain = self.encode((fmt, False))
+            compressor = zlib.compressobj(WS_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+            data = compressor.compress(plain.encode() if isinstance(plain, str) else plain) + compressor.flush()
+            _encode_counts["deflate"] += 1
+        elif fmt == "msgpack":
+            data = msgpack.packb(self.payload)
+            _encode_counts["msgpack"] += 1
+        else:
+            data = self.payload if isinstance(self.payload, str) else json.dumps(self.payload)
+            _encode_counts["json"] += 1
+        _encode_counts["encoded_bytes"] += len(data)
+        self._encoded[encoding] = data
+        return data
+
+
+def encode_batch(frames: List[OutboundFrame], encoding: Encoding) -> Union[str, bytes]:
+    """
+    Joins frames into one array frame from their cached per-frame encodings,
+    so coalescing never re-serializes a payload.
+    """
+    fmt, deflate = encoding
+    if fmt == "msgpack":
+        count = len(frames)
+        header = bytes([0x90 | count]) if count < 16 else b"\xdc" + struct.pack(">H", count)
+        data: Union[str, bytes] = header + b"".join(frame.encode(("msgpack", False)) for frame in frames) # type: ignore
+    else:
+        data = "[" + ",".join(frame.wire_json() for frame in frames) + "]"
+    if deflate:
+        compressor = zlib.compressobj(WS_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(data.encode() if isinstance(data, str) else data) + compressor.flush()
+        _encode_counts["deflate"] += 1
+    return data
+
+
+PING_FRAME = OutboundFrame({"type": "ping"})
+PONG_FRAME = OutboundFrame({"type": "pong"})
+# Published on a room's channel instead of a frame: the room's replay buffers are stale.
+REPLAY_INVALIDATE = '{"_replay": "invalidate"}'
+
+# Shared by every manager so that the per-user and per-worker caps span endpoints.
+_worker_connections = 0
+_user_connections: Dict[str, int] = {}
+
+
+def valid_room_id(room_id: str) -> bool:
+    """
+    Whether `room_id` has the form of a stored id (a canonical UUID). Checked
+    before any lookup, so raw path segments never become room or channel names.
+    """
+    try:
+        return str(uuid.UUID(room_id)) == room_id
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+
+def negotiate_encoding(websocket: WebSocket, compression: bool) -> Optional[Encoding]:
+    """
+    Reads ?format=json|msgpack and ?compress=deflate from the handshake.
+    Returns None when the client asked for something this endpoint cannot serve.
+    """
+    fmt = websocket.query_params.get("format", "json")
+    compress = websocket.query_params.get("compress", "")
+    if fmt not in ("json", "msgpack") or (fmt == "msgpack" and msgpack is None):
+        return None
+    if compress not in ("", "deflate") or (compress and not compression):
+        return None
+    return fmt, bool(compress)
+
+
+class _Close:
+    def __init__(self, code: int, reason: Optional[str]):
+        self.code = code
+        self.reason = reason
+
+
+class Connection:
+    """
+    An accepted WebSocket with its own bounded outbound queue.
+    A writer task is the only coroutine that sends on the socket, so a slow
+    client only ever delays itself. JSON without compression goes out as text
+    frames; msgpack or deflated payloads as binary frames.
+
+    With `batching`, several queued frames go out as one array frame. A frame
+    that is alone in the queue of a quiet room is still sent on its own.
+
+    `manager` is the manager that accepted the socket and owns its lifecycle;
+    `rooms` lists every (manager, room_id) the socket is currently indexed under,
+    which is more than one for the multiplexed /ws/ endpoint.
+    """
+    def __init__(self, websocket: WebSocket, manager: "ConnectionManager", encoding: Encoding = DEFAULT_ENCODING, batching: bool = False, user_id: Optional[str] = None):
+        self.websocket = websocket
+        self.manager = manager
+        self.encoding = encoding
+        self.batching = batching
+        self.user_id = user_id
+        self.rooms: Set[Tuple["ConnectionManager", str]] = set()
+        self.last_seen = time.monotonic()
+        self.buckets: Dict[str, ratelimit.TokenBucket] = {}
+        self.violations = 0
+        self.pending: Deque[Any] = deque()
+        self.closing = False
+        self._wakeup = asyncio.Event()
+        self.writer = asyncio.create_task(self._run())
+
+    def enqueue(self, message: OutboundFrame, force: bool = False):
+        """
+        Queues a message without waiting, applying the slow-consumer policy when full.
+        `force` skips the bound, for a replayed gap the client explicitly asked for.
+        """
+        if self.closing:
+            return
+        if not force and len(self.pending) >= self.manager.queue_size:
+            if self.manager.policy == "disconnect":
+                self.manager.slow_disconnects += 1
+                self.close_later(1008, "Slow consumer")
+                return
+            self.pending.popleft()
+            self.manager.dropped += 1
+        self.pending.append(message)
+        self.manager.max_depth_seen = max(self.manager.max_depth_seen, len(self.pending))
+        self._wakeup.set()
+
+    def shed(self, reconnect_after: float):
+        """
+        Tells the client to reconnect after `reconnect_after` seconds and closes the
+        socket with 1012 once everything queued was sent. Used to drain the worker.
+        """
+        self.enqueue(OutboundFrame({"type": "reconnect", "after": round(reconnect_after, 3)}), force=True)
+        self.close_later(drain.CLOSE_SERVICE_RESTART, "Server restarting", discard_pending=False)
+
+    def close_later(self, code: int = 1000, reason: Optional[str] = None, discard_pending: bool = True):
+        """
+        Has the writer close the socket, after the queued messages unless `discard_pending`.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        if discard_pending:
+            self.pending.clear()
+        self.pending.append(_Close(code, reason))
+        self._wakeup.set()
+
+    async def _run(self):
+        websocket = self.websocket
+        try:
+            while True:
+                while not self.pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                item = self.pending.popleft()
+                if isinstance(item, _Close):
+                    if websocket.application_state == WebSocketState.CONNECTED and websocket.client_state == WebSocketState.CONNECTED:
+                        await websocket.close(code=item.code, reason=item.reason)
+                    return
+                if self.batching:
+                    if not self.pending and WS_BATCH_WINDOW_MS > 0 and any(m.is_hot(r) for m, r in self.rooms):
+                        await asyncio.sleep(WS_BATCH_WINDOW_MS / 1000)
+                    batch = [item]
+                    while self.pending and len(batch) < WS_BATCH_MAX and not isinstance(self.pending[0], _Close):
+                        batch.append(self.pending.popleft())
+                    if len(batch) > 1:
+                        data = encode_batch(batch, self.encoding)
+                        self.manager.batches += 1
+                        self.manager.batched_frames += len(batch)
+                    else:
+                        data = item.encode(self.encoding)
+                else:
+                    data = item.encode(self.encoding)
+                if isinstance(data, str):
+                    await websocket.send_text(data)
+                else:
+                    await websocket.send_bytes(data)
+                self.manager.sent += 1
+                self.manager.bytes_sent += len(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending to a connection in {self.manager.name}: {e}")
+            self.manager.send_errors += 1
+            self.manager.release(self)
+
+
+class ConnectionManager:
+    """
+    Manages active WebSocket connections grouped by room (a conversation, a
+    community, or a user for the multiplexed endpoint).
+    `active_connections` indexes room -> sockets; `_by_socket` holds the sockets
+    this manager accepted. A socket accepted by one manager may also be indexed
+    in rooms of another (see join).
+    Broadcasting only appends to each recipient's queue; per-connection writer
+    tasks do the network I/O. `compression` allows clients of this endpoint to
+    negotiate deflated frames (WS_<NAME>_COMPRESSION=deflate).
+
+    Broadcasts are also published on the pub/sub channel "<name>:<room_id>" so
+    that other workers hosting the room deliver them too; a worker subscribes
+    to a room's channel only while it has local connections or streams in it.
+
+    Read-only Server-Sent Events clients are kept in `streams` and get the same
+    broadcast frames, without a socket or receive loop (see events.EventStream).
+
+    Broadcast frames carrying an "id" are kept in `replay`, so a reconnecting
+    client can get the messages it missed (see resume).
+
+    With a `room_key` (the field naming the room in frames, e.g. "conversation_id"),
+    `presence` tracks the users connected to each room; joining sockets get a
+    presence snapshot and the room aggregated changes (see presence.Presence).
+    """
+    def __init__(self, name: str, queue_size: int = WS_SEND_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY, compression: Optional[bool] = None, room_key: Optional[str] = None):
+        self.name = name
+        self.room_key = room_key
+        self.queue_size = queue_size
+        self.policy = policy
+        if compression is None:
+            compression = os.getenv(f"WS_{name.upper()}_COMPRESSION", "off") == "deflate"
+        self.compression = compression
+        self.active_connections: Dict[str, Dict[WebSocket, Connection]] = {}
+        self._by_socket: Dict[WebSocket, Connection] = {}
+        # room_id -> Server-Sent Events streams reading the room
+        self.streams: Dict[str, Set[Any]] = {}
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+        self.send_errors = 0
+        self.max_depth_seen = 0
+        self.batches = 0
+        self.batched_frames = 0
+        self.pings_sent = 0
+        self.reaped = 0
+        self.rejected: Dict[str, int] = {"room": 0, "user": 0, "worker": 0, "draining": 0}
+        self._reaper: Optional[asyncio.Task] = None
+        # room_id -> [window start, messages in window, rate of the previous window]
+        self._rates: Dict[str, List[float]] = {}
+        self.replay = ReplayBuffer(name)
+        self.presence = Presence(self, room_key) if room_key else None
+        self.resumes: Dict[str, int] = {"buffer": 0, "database": 0, "resync": 0}
+        metrics.register(f"websockets.{name}", self.stats)
+        pubsub.register(name, self._deliver_remote, self.replay.clear)
+        drain.coordinator.register(self)
+
+    def _over_cap(self, user_id: Optional[str]) -> Optional[str]:
+        if WS_MAX_CONNECTIONS_PER_WORKER and _worker_connections >= WS_MAX_CONNECTIONS_PER_WORKER:
+            return "worker"
+        if user_id and WS_MAX_CONNECTIONS_PER_USER and _user_connections.get(user_id, 0) >= WS_MAX_CONNECTIONS_PER_USER:
+            return "user"
+        return None
+
+    async def accept(self, websocket: WebSocket) -> Optional[Connection]:
+        """
+        Accepts a WebSocket and starts its writer, without joining any room.
+        Returns None after closing the socket if the requested encoding is not
+        available (1003), a connection cap is reached (1013) or the worker is
+        draining (1012).
+        """
+        global _worker_connections
+        await websocket.accept()
+        if drain.coordinator.draining:
+            self.rejected["draining"] += 1
+            await websocket.close(code=drain.CLOSE_SERVICE_RESTART, reason="Server restarting")
+            return None
+        encoding = negotiate_encoding(websocket, self.compression)
+        if encoding is None:
+            await websocket.close(code=1003, reason="Unsupported format or compression")
+            return None
+        user = getattr(websocket.state, "user", None)
+        user_id = str(user.id) if user is not None else None
+        cap = self._over_cap(user_id)
+        if cap is not None:
+            self.rejected[cap] += 1
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason=f"Too many connections for this {cap}")
+            return None
+        self._ensure_reaper()
+        batching = websocket.query_params.get("batch") in ("1", "true")
+        connection = Connection(websocket, self, encoding, batching, user_id)
+        _worker_connections += 1
+        if user_id:
+            _user_connections[user_id] = _user_connections.get(user_id, 0) + 1
+        self._by_socket[websocket] = connection
+        return connection
+
+    def join(self, connection: Connection, room_id: str) -> bool:
+        """
+        Indexes a connection (accepted by any manager) under one of this manager's rooms.
+        Returns False if the room is full.
+        """
+        room = self.active_connections.get(room_id)
+        if room is None:
+            if room_id not in self.streams:
+                pubsub.backend.subscribe(f"{self.name}:{room_id}")
+            room = self.active_connections[room_id] = {}
+        elif WS_MAX_CONNECTIONS_PER_ROOM and len(room) >= WS_MAX_CONNECTIONS_PER_ROOM and connection.websocket not in room:
+            self.rejected["room"] += 1
+            return False
+        joined = connection.websocket not in room
+        room[connection.websocket] = connection
+        connection.rooms.add((self, room_id))
+        if joined and self.presence is not None and self.presence.enabled:
+            self.presence.joined(room_id, connection.user_id)
+            connection.enqueue(OutboundFrame(self.presence.snapshot(room_id)))
+        return True
+
+    def leave(self, connection: Connection, room_id: str):
+        """
+        Removes a connection from one room; an empty room's entry is removed.
+        """
+        connection.rooms.discard((self, room_id))
+        room = self.active_connections.get(room_id)
+        if room is not None:
+            if room.pop(connection.websocket, None) is not None and self.presence is not None:
+                self.presence.left(room_id, connection.user_id)
+            if not room:
+                del self.active_connections[room_id]
+                if not self._hosts(room_id):
+                    self._unhost(room_id)
+
+    def _hosts(self, room_id: str) -> bool:
+        """
+        Whether this worker has sockets or event streams in the room, and so is
+        subscribed to the room's pub/sub channel.
+        """
+        return room_id in self.active_connections or room_id in self.streams
+
+    def _unhost(self, room_id: str):
+        self._rates.pop(room_id, None)
+        pubsub.backend.unsubscribe(f"{self.name}:{room_id}")
+        if pubsub.backend.distributed:
+            # Other workers' messages stop arriving here, so the buffer would get a hole.
+            self.replay.invalidate(room_id)
+
+    def release(self, connection: Connection):
+        """
+        Removes a connection this manager accepted from every room and stops its writer.
+        """
+        global _worker_connections
+        for manager, room_id in list(connection.rooms):
+            manager.leave(connection, room_id)
+        if self._by_socket.pop(connection.websocket, None) is not None:
+            _worker_connections -= 1
+            if connection.user_id:
+                remaining = _user_connections.get(connection.user_id, 1) - 1
+                if remaining > 0:
+                    _user_connections[connection.user_id] = remaining
+                else:
+                    _user_connections.pop(connection.user_id, None)
+        if not connection.writer.done() and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    async def connect(self, websocket: WebSocket, room_id: str) -> bool:
+        """
+        Accepts a new WebSocket connection and adds it to the room.
+        Returns False after closing the socket if the requested encoding is not
+        available (1003), a connection cap is reached (1013) or the worker is
+        draining (1012).
+        """
+        connection = await self.accept(websocket)
+        if connection is None:
+            return False
+        if not self.join(connection, room_id):
+            await self.close(websocket, code=CLOSE_TRY_AGAIN_LATER, reason="Too many connections for this room")
+            self.release(connection)
+            return False
+        return True
+
+    def disconnect(self, websocket: WebSocket, room_id: str):
+        """
+        Removes a connection from its rooms and stops its writer.
+        """
+        connection = self._by_socket.get(websocket)
+        if connection is not None:
+            self.release(connection)
+            return
+        connection = self.active_connections.get(room_id, {}).get(websocket)
+        if connection is not None:
+            self.leave(connection, room_id)
+
+    def connections(self) -> List[Any]:
+        """
+        The connections this manager accepted and its event streams.
+        """
+        return list(self._by_socket.values()) + [stream for streams in self.streams.values() for stream in streams]
+
+    def open_stream(self, stream: Any):
+        """
+        Adds a Server-Sent Events stream (see events.EventStream) to its room.
+        Streams receive the room's broadcasts but are not counted as connections.
+        """
+        if not self._hosts(stream.room_id):
+            pubsub.backend.subscribe(f"{self.name}:{stream.room_id}")
+        self.streams.setdefault(stream.room_id, set()).add(stream)
+
+    def close_stream(self, stream: Any):
+        streams = self.streams.get(stream.room_id)
+        if streams is None or stream not in streams:
+            return
+        streams.discard(stream)
+        if not streams:
+            del self.streams[stream.room_id]
+            if not self._hosts(stream.room_id):
+                self._unhost(stream.room_id)
+
+    def touch(self, websocket: WebSocket):
+        """
+        Records inbound activity; handlers call it for every frame received.
+        """
+        connection = self._by_socket.get(websocket)
+        if connection is not None:
+            connection.last_seen = time.monotonic()
+
+    async def allow(self, websocket: WebSocket, category: str) -> bool:
+        """
+        Charges an inbound frame to the socket's and its user's token bucket for
+        `category` (see ratelimit). Handlers call it with "frame" before parsing and
+        with the frame's category before doing any work, and skip the frame on False.
+        The client is told once per streak of rejected frames; after
+        WS_RATE_MAX_VIOLATIONS of them in a row it is closed with 1008 and
+        WebSocketDisconnect is raised to end the handler.
+        """
+        connection = self._by_socket.get(websocket)
+        if connection is None:
+            return True
+        bucket = ratelimit.limiter.allow(connection.buckets, connection.user_id, category)
+        if bucket is None:
+            connection.violations = 0
+            return True
+        connection.violations += 1
+        if connection.violations == 1:
+            connection.enqueue(OutboundFrame({"type": "rate_limited", "category": category, "retry_after": round(bucket.retry_after(), 3)}))
+        elif ratelimit.WS_RATE_MAX_VIOLATIONS and connection.violations >= ratelimit.WS_RATE_MAX_VIOLATIONS:
+            await self.close(websocket, code=1008, reason="Rate limit exceeded")
+            raise WebSocketDisconnect(code=1008, reason="Rate limit exceeded")
+        return False
+
+    async def handle_heartbeat(self, websocket: WebSocket, message: Any) -> bool:
+        """
+        Answers client pings. Returns True if `message` (a parsed dict or a
+        frames model) was a heartbeat frame that the handler should not process further.
+        """
+        kind = message.get("type") if isinstance(message, dict) else getattr(message, "type", None)
+        if kind == "ping":
+            connection = self._by_socket.get(websocket)
+            if connection is not None:
+                connection.enqueue(PONG_FRAME)
+            return True
+        return kind == "pong"
+
+    def _ensure_reaper(self):
+        if not WS_HEARTBEAT_INTERVAL:
+            return
+        loop = asyncio.get_running_loop()
+        if self._reaper is None or self._reaper.done() or self._reaper.get_loop() is not loop:
+            self._reaper = loop.create_task(self._reap_loop())
+
+    async def _reap_loop(self):
+        """
+        Pings quiet connections and drops those that stopped answering, so
+        half-open sockets do not linger in every broadcast.
+        """
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for connection in list(self._by_socket.values()):
+                idle = now - connection.last_seen
+                if WS_IDLE_TIMEOUT and idle >= WS_IDLE_TIMEOUT:
+                    self.reaped += 1
+                    self.release(connection)
+                    asyncio.create_task(self._force_close(connection.websocket, 1001, "Idle timeout"))
+                elif idle >= WS_HEARTBEAT_INTERVAL:
+                    connection.enqueue(PING_FRAME)
+                    self.pings_sent += 1
+
+    async def _force_close(self, websocket: WebSocket, code: int, reason: str):
+        # The writer may be stuck on a dead socket, so close from here, bounded in time.
+        try:
+            if websocket.application_state == WebSocketState.CONNECTED and websocket.client_state == WebSocketState.CONNECTED:
+                await asyncio.wait_for(websocket.close(code=code, reason=reason), WS_CLOSE_TIMEOUT)
+        except Exception as e:
+            print(f"Error closing an idle connection in {self.name}: {e}")
+
+    async def send_personal_message(self, message: Union[str, Dict[str, Any], OutboundFrame], websocket: WebSocket):
+        """
+        Queues a message for a single connection, behind anything already queued for it.
+        """
+        frame = message if isinstance(message, OutboundFrame) else OutboundFrame(message)
+        connection = self._by_socket.get(websocket)
+        if connection is None:
+            await websocket.send_text(frame.wire_json() if isinstance(frame.payload, dict) else frame.payload) # type: ignore
+            return
+        connection.enqueue(frame)
+
+    async def broadcast(self, message: Union[str, Dict[str, Any], OutboundFrame], room_id: str, local: bool = False):
+        """
+        Queues a message for every connection in the room without waiting on any of them.
+        The frame is encoded once per wire encoding in use, not once per recipient.
+        With `local`, only this worker's connections get it, even when distributed.
+        """
+        frame = message if isinstance(message, OutboundFrame) else OutboundFrame(message)
+        self._deliver(frame, room_id)
+        if pubsub.backend.distributed and not local:
+            pubsub.backend.publish(f"{self.name}:{room_id}", frame.wire_json())
+
+    def _deliver(self, frame: OutboundFrame, room_id: str):
+        local = self._hosts(room_id)
+        # Rates are only kept for rooms hosted here; _unhost drops them, so a
+        # broadcast to an emptied room (e.g. a "left" notice) must not recreate one.
+        if local:
+            now = time.monotonic()
+            rate = self._rates.get(room_id)
+            if rate is None:
+                self._rates[room_id] = [now, 1, 0.0]
+            elif now - rate[0] >= 1.0:
+                rate[2] = rate[1] / (now - rate[0])
+                rate[0], rate[1] = now, 1
+            else:
+                rate[1] += 1
+        # Across workers, only rooms subscribed here are known to be complete.
+        hosted = local or not pubsub.backend.distributed
+        if hosted and isinstance(frame.payload, dict) and "id" in frame.payload:
+            self.replay.record(room_id, str(frame.payload["id"]), frame)
+        for connection in list(self.active_connections.get(room_id, {}).values()):
+            connection.enqueue(frame)
+        for stream in list(self.streams.get(room_id, ())):
+            stream.enqueue(frame)
+
+    def invalidate_replay(self, room_id: str):
+        """
+        Drops the room's replay buffer on every worker hosting it, after a change
+        that was not broadcast (a REST post or a deletion), so resumes read the gap
+        from the database instead.
+        """
+        self.replay.invalidate(room_id)
+        if pubsub.backend.distributed:
+            pubsub.backend.publish(f"{self.name}:{room_id}", REPLAY_INVALIDATE)
+
+    def _deliver_remote(self, room_id: str, text: str):
+        if text == REPLAY_INVALIDATE:
+            self.replay.invalidate(room_id)
+            return
+        if self._hosts(room_id):
+            self._deliver(OutboundFrame.from_json(text), room_id)
+
+    def resume(self, websocket: WebSocket, room_id: str, last_id: str, load: Callable[[], Optional[List[Dict[str, Any]]]]) -> bool:
+        """
+        Queues for a socket that just joined the room the frames broadcast after
+        message `last_id`: from the replay buffer while it still holds that id,
+        otherwise from `load` (a database query for the gap). Must be called right
+        after join(), without awaiting in between, so that the gap is queued
+        ahead of any live frame. Returns False if neither could fill the gap; the
+        client should then refetch the history over REST.
+        """
+        connection = self.active_connections.get(room_id, {}).get(websocket)
+        if connection is None:
+            return False
+        frames = self.gap(room_id, last_id, load)
+        if frames is None:
+            return False
+        for frame in frames:
+            connection.enqueue(frame, force=True)
+        return True
+
+    def gap(self, room_id: str, last_id: str, load: Callable[[], Optional[List[Dict[str, Any]]]]) -> Optional[List[OutboundFrame]]:
+        """
+        The frames broadcast in the room after message `last_id`, from the replay
+        buffer or else from `load`; None if the client must resync.
+        """
+        frames = self.replay.since(room_id, last_id)
+        if frames is not None:
+            self.resumes["buffer"] += 1
+            return frames
+        payloads = load()
+        if payloads is None:
+            self.resumes["resync"] += 1
+            return None
+        self.resumes["database"] += 1
+        return [OutboundFrame(payload) for payload in payloads]
+
+    def is_hot(self, room_id: str) -> bool:
+        """
+        Whether the room currently receives at least WS_BATCH_HOT_RATE messages/sec.
+        """
+        rate = self._rates.get(room_id)
+        return rate is not None and max(rate[1], rate[2]) >= WS_BATCH_HOT_RATE
+
+    async def close(self, websocket: WebSocket, code: int = 1000, reason: Optional[str] = None):
+        """
+        Closes a connection once the messages already queued for it were sent.
+        """
+        connection = self._by_socket.get(websocket)
+        if connection is None:
+            if websocket.application_state == WebSocketState.CONNECTED and websocket.client_state == WebSocketState.CONNECTED:
+                await websocket.close(code=code, reason=reason)
+            return
+        connection.close_later(code, reason, discard_pending=False)
+        await asyncio.wait({connection.writer}, timeout=WS_CLOSE_TIMEOUT)
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [len(c.pending) for c in self._by_socket.values()]
+        return {
+            "connections": len(self._by_socket),
+            "event_streams": sum(len(streams) for streams in self.streams.values()),
+            "rooms": len(self.active_connections),
+            "queue_size": self.queue_size,
+            "compression": self.compression,
+            "slow_consumer_policy": self.policy,
+            "queued": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "max_queue_depth_seen": self.max_depth_seen,
+            "sent": self.sent,
+            "bytes_sent": self.bytes_sent,
+            "dropped": self.dropped,
+            "slow_consumer_disconnects": self.slow_disconnects,
+            "send_errors": self.send_errors,
+            "batches": self.batches,
+            "batched_frames": self.batched_frames,
+            "hot_rooms": sum(1 for room_id in self._rates if self.is_hot(room_id)),
+            "pings_sent": self.pings_sent,
+            "reaped": self.reaped,
+            "rejected": dict(self.rejected),
+            "resumes": dict(self.resumes),
+            "replay": self.replay.stats(),
+            "presence": self.presence.stats() if self.presence is not None else None,
+            "worker_connections": _worker_connections,
+        }
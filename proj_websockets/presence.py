@@ -0,0 +1,155 @@
+import os
+import time
+import asyncio
+from typing import Any, Dict, List, Optional, Set, TYPE_CHECKING
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    from proj_websockets.manager import ConnectionManager
+
+load_dotenv()
+
+# Seconds between presence frames of a room; changes in between are merged. 0 disables presence.
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "1"))
+# Typing events accepted per user and room, at most one every PRESENCE_TYPING_INTERVAL seconds.
+PRESENCE_TYPING_INTERVAL = float(os.getenv("PRESENCE_TYPING_INTERVAL", "3"))
+# Rooms with more users online only get counts, not the ids that came and went.
+PRESENCE_MAX_LISTED = int(os.getenv("PRESENCE_MAX_LISTED", "500"))
+
+
+class Presence:
+    """
+    Who is online and typing in each room of one ConnectionManager, kept in
+    memory only and derived from its connection registry.
+
+    Changes are not broadcast as they happen. They are merged per room and a
+    flusher sends one {"type": "presence"} frame per changed room every
+    PRESENCE_INTERVAL, so a room costs O(changes) per interval however busy
+    it is; a user who leaves and comes back within an interval is not reported.
+    Presence is tracked per worker and its frames are only delivered locally:
+    counts and ids computed here would be wrong on the other workers.
+    """
+    def __init__(self, manager: "ConnectionManager", room_key: str):
+        self.manager = manager
+        self.room_key = room_key
+        # room -> user id -> open connections of the user in the room
+        self.online: Dict[str, Dict[str, int]] = {}
+        # room -> user id -> whether the user was online when the interval began
+        self._changed: Dict[str, Dict[str, bool]] = {}
+        self._typing: Dict[str, Set[str]] = {}
+        self._last_typing: Dict[tuple, float] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.frames = 0
+        self.typing_accepted = 0
+        self.typing_dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return PRESENCE_INTERVAL > 0
+
+    def _mark(self, room_id: str, user_id: str, was_online: bool):
+        self._changed.setdefault(room_id, {}).setdefault(user_id, was_online)
+        self._ensure_flusher()
+
+    def joined(self, room_id: str, user_id: Optional[str]):
+        if not self.enabled or not user_id:
+            return
+        users = self.online.setdefault(room_id, {})
+        count = users.get(user_id, 0)
+        users[user_id] = count + 1
+        if not count:
+            self._mark(room_id, user_id, False)
+
+    def left(self, room_id: str, user_id: Optional[str]):
+        if not self.enabled or not user_id:
+            return
+        users = self.online.get(room_id)
+        if users is None or user_id not in users:
+            return
+        if users[user_id] > 1:
+            users[user_id] -= 1
+            return
+        del users[user_id]
+        if not users:
+            del self.online[room_id]
+        self._mark(room_id, user_id, True)
+
+    def typing(self, room_id: str, user_id: str) -> bool:
+        """
+        Records that a user is typing in the room. Returns False if the event was
+        rate limited; the flusher reports at most one per user per interval anyway.
+        """
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        key = (room_id, user_id)
+        if now - self._last_typing.get(key, -PRESENCE_TYPING_INTERVAL) < PRESENCE_TYPING_INTERVAL:
+            self.typing_dropped += 1
+            return False
+        self._last_typing[key] = now
+        self._typing.setdefault(room_id, set()).add(user_id)
+        self.typing_accepted += 1
+        self._ensure_flusher()
+        return True
+
+    def snapshot(self, room_id: str) -> Dict[str, Any]:
+        """
+        The frame sent to a connection joining the room: everyone online here, or
+        only the count in rooms above PRESENCE_MAX_LISTED.
+        """
+        users = self.online.get(room_id, {})
+        frame: Dict[str, Any] = {"type": "presence", self.room_key: room_id, "snapshot": True, "online_count": len(users)}
+        if len(users) <= PRESENCE_MAX_LISTED:
+            frame["online"] = list(users)
+        return frame
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._changed or self._typing:
+            await asyncio.sleep(PRESENCE_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        """
+        Sends one frame per room whose presence changed since the last flush, to
+        this worker's connections only.
+        """
+        changed, self._changed = self._changed, {}
+        typing, self._typing = self._typing, {}
+        for room_id in set(changed) | set(typing):
+            users = self.online.get(room_id, {})
+            frame: Dict[str, Any] = {"type": "presence", self.room_key: room_id, "online_count": len(users)}
+            came: List[str] = []
+            went: List[str] = []
+            for user_id, was_online in changed.get(room_id, {}).items():
+                if (user_id in users) != was_online:
+                    (went if was_online else came).append(user_id)
+            if not came and not went and room_id not in typing:
+                continue
+            if len(users) <= PRESENCE_MAX_LISTED:
+                if came:
+                    frame["online"] = came
+                if went:
+                    frame["offline"] = went
+            if room_id in typing:
+                frame["typing"] = sorted(typing[room_id])
+            await self.manager.broadcast(frame, room_id, local=True)
+            self.frames += 1
+        now = time.monotonic()
+        for key, at in list(self._last_typing.items()):
+            if now - at >= PRESENCE_TYPING_INTERVAL:
+                del self._last_typing[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rooms": len(self.online),
+            "users_online": sum(len(users) for users in self.online.values()),
+            "pending_rooms": len(set(self._changed) | set(self._typing)),
+            "frames": self.frames,
+            "typing_accepted": self.typing_accepted,
+            "typing_dropped": self.typing_dropped,
+        }
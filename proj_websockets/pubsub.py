@@ -0,0 +1,318 @@
+import os
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Set
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+# "local": one process, nothing leaves the worker. "unix": workers on one host
+# exchange room messages through a broker on a Unix domain socket.
+WS_PUBSUB_BACKEND = os.getenv("WS_PUBSUB_BACKEND", "local")
+WS_PUBSUB_SOCKET = os.getenv("WS_PUBSUB_SOCKET", "/tmp/fastapi_chat_pubsub.sock")
+WS_PUBSUB_MAX_FRAME = int(os.getenv("WS_PUBSUB_MAX_FRAME", str(1024 * 1024)))
+# Bytes allowed to pile up towards the broker (or a subscriber) before messages are dropped.
+WS_PUBSUB_MAX_BUFFER = int(os.getenv("WS_PUBSUB_MAX_BUFFER", str(8 * 1024 * 1024)))
+
+# Channels are "<manager name>:<room id>"; each manager registers a callback
+# receiving (room_id, json_text) for messages published by other workers.
+_handlers: Dict[str, Callable[[str, str], None]] = {}
+# Called whenever this worker (re)joins the broker: messages published in the
+# meantime were lost, so anything assuming a complete history must be reset.
+_reset_handlers: List[Callable[[], None]] = []
+
+
+def register(name: str, handler: Callable[[str, str], None], on_reset: Optional[Callable[[], None]] = None):
+    _handlers[name] = handler
+    if on_reset is not None:
+        _reset_handlers.append(on_reset)
+
+
+def valid_channel(channel: str) -> bool:
+    """
+    Channel names travel in a line based protocol, so they may not contain
+    whitespace or control characters.
+    """
+    return bool(channel) and channel.isprintable() and not any(c.isspace() for c in channel)
+
+
+def _dispatch(channel: str, text: str):
+    name, _, room_id = channel.partition(":")
+    handler = _handlers.get(name)
+    if handler is not None:
+        handler(room_id, text)
+
+
+def _on_loop(loop: asyncio.AbstractEventLoop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class PubSubBackend:
+    """
+    Interface for cross-worker fan-out. Every call is synchronous and must not
+    wait on the network, since it runs inside ConnectionManager.broadcast.
+    """
+    distributed = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, channel: str):
+        pass
+
+    def unsubscribe(self, channel: str):
+        pass
+
+    def publish(self, channel: str, text: str):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "local"}
+
+
+class LocalBackend(PubSubBackend):
+    """
+    Single-process deployments: the ConnectionManager already delivers locally.
+    """
+
+
+class UnixSocketBackend(PubSubBackend):
+    """
+    Fan-out between the workers of one host over a Unix domain socket.
+
+    The worker holding an exclusive flock on `<path>.lock` runs the broker; every
+    worker, the broker's included, connects to it as a client. If the broker's
+    worker dies the OS releases the lock, the others reconnect and one of them
+    takes over. Messages published while no broker is reachable are dropped.
+
+    The protocol is line based: "S <channel>", "U <channel>" and
+    "P <channel> <json>". The broker forwards a "P" line as-is to every other
+    client subscribed to the channel, so it never decodes payloads.
+    """
+    distributed = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.channels: Set[str] = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._lock_fd: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self._clients: Set[asyncio.StreamWriter] = set()
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.reconnects = 0
+
+    async def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            # Closing the listener leaves accepted connections open; end them so
+            # the other workers notice at once and elect a new broker.
+            for client in list(self._clients):
+                client.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _send(self, line: bytes) -> bool:
+        writer = self._writer
+        if writer is None or writer.transport.get_write_buffer_size() > WS_PUBSUB_MAX_BUFFER:
+            return False
+        writer.write(line)
+        return True
+
+    def _reject(self, channel: str) -> bool:
+        if valid_channel(channel):
+            return False
+        self.rejected += 1
+        print(f"Pub/sub: refusing channel name {channel!r}")
+        return True
+
+    def subscribe(self, channel: str):
+        if self._reject(channel):
+            return
+        self.channels.add(channel)
+        self._send(f"S {channel}\n".encode())
+
+    def unsubscribe(self, channel: str):
+        if self._reject(channel):
+            return
+        self.channels.discard(channel)
+        self._send(f"U {channel}\n".encode())
+
+    def publish(self, channel: str, text: str):
+        loop = self._loop
+        if loop is not None and not _on_loop(loop):
+            # Sync routes run in the threadpool; the writer belongs to the event loop.
+            loop.call_soon_threadsafe(self.publish, channel, text)
+            return
+        # json.dumps escapes newlines, so a payload always stays on its line.
+        if self._reject(channel) or "\n" in text:
+            self.dropped += 1
+            return
+        if self._send(f"P {channel} {text}\n".encode()):
+            self.published += 1
+        else:
+            self.dropped += 1
+
+    async def _become_broker(self):
+        """
+        Starts the broker in this worker if no other worker holds the lock.
+        """
+        if self._server is not None:
+            return
+        # Imported here: fcntl is POSIX only, and the default local backend must import everywhere.
+        import fcntl
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        # Whoever held the lock before us is gone; its socket file is stale.
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_client, path=self.path, limit=WS_PUBSUB_MAX_FRAME)
+        print(f"Pub/sub broker listening on {self.path} (pid {os.getpid()})")
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: Set[bytes] = set()
+        self._clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                op, _, rest = line.partition(b" ")
+                if op == b"P":
+                    channel = rest.split(b" ", 1)[0]
+                    for subscriber in list(self._subscribers.get(channel, ())):
+                        if subscriber is writer:
+                            continue
+                        if subscriber.transport.get_write_buffer_size() > WS_PUBSUB_MAX_BUFFER:
+                            self.dropped += 1
+                            continue
+                        subscriber.write(line)
+                elif op == b"S":
+                    channel = rest.rstrip(b"\n")
+                    if not channel or b" " in channel:
+                        continue
+                    self._subscribers.setdefault(channel, set()).add(writer)
+                    subscribed.add(channel)
+                elif op == b"U":
+                    channel = rest.rstrip(b"\n")
+                    subscribers = self._subscribers.get(channel)
+                    if subscribers is not None:
+                        subscribers.discard(writer)
+                        if not subscribers:
+                            del self._subscribers[channel]
+                    subscribed.discard(channel)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            print(f"Pub/sub broker dropped a client: {e}")
+        finally:
+            for channel in subscribed:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(writer)
+                    if not subscribers:
+                        del self._subscribers[channel]
+            self._clients.discard(writer)
+            writer.close()
+
+    async def _run(self):
+        delay = 0.05
+        while True:
+            try:
+                await self._become_broker()
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=WS_PUBSUB_MAX_FRAME)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                continue
+            delay = 0.05
+            self._writer = writer
+            # Rooms this worker hosts, re-announced after every (re)connect.
+            for channel in self.channels:
+                writer.write(f"S {channel}\n".encode())
+            for on_reset in _reset_handlers:
+                on_reset()
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    op, _, rest = line.partition(b" ")
+                    if op != b"P":
+                        continue
+                    channel, _, text = rest.rstrip(b"\n").partition(b" ")
+                    self.received += 1
+                    _dispatch(channel.decode(), text.decode())
+            except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+                print(f"Pub/sub connection lost: {e}")
+            finally:
+                self._writer = None
+                writer.close()
+            self.reconnects += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "unix",
+            "path": self.path,
+            "connected": self._writer is not None,
+            "is_broker": self._server is not None,
+            "broker_clients": len(self._clients),
+            "channels": len(self.channels),
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "reconnects": self.reconnects,
+        }
+
+
+BACKENDS = {
+    "local": lambda: LocalBackend(),
+    "unix": lambda: UnixSocketBackend(WS_PUBSUB_SOCKET),
+}
+if WS_PUBSUB_BACKEND not in BACKENDS:
+    raise ValueError(f"WS_PUBSUB_BACKEND must be one of {tuple(BACKENDS)}, got {WS_PUBSUB_BACKEND!r}")
+
+backend: PubSubBackend = BACKENDS[WS_PUBSUB_BACKEND]()
+metrics.register("websockets.pubsub", lambda: backend.stats())
+
+
+async def start():
+    """
+    Starts the configured backend; called from the application lifespan.
+    """
+    await backend.start()
+
+
+async def stop():
+    await backend.stop()
@@ -0,0 +1,129 @@
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+# "frame" counts every inbound frame and is checked before parsing; the others
+# are checked once the frame's type is known, before any database work.
+CATEGORIES = ("frame", "message", "reply", "event")
+
+
+def _limits(prefix: str, defaults: Dict[str, str]) -> Dict[str, Tuple[float, float]]:
+    """
+    Reads "<rate per second>/<burst>" limits, e.g. WS_RATE_MESSAGE=5/10. A rate of 0 disables the limit.
+    """
+    limits = {}
+    for category in CATEGORIES:
+        rate, _, burst = os.getenv(f"{prefix}_{category.upper()}", defaults[category]).partition("/")
+        limits[category] = (float(rate), float(burst or rate))
+    return limits
+
+
+CONNECTION_LIMITS = _limits("WS_RATE", {"frame": "20/40", "message": "5/10", "reply": "5/10", "event": "10/20"})
+USER_LIMITS = _limits("WS_USER_RATE", {"frame": "50/100", "message": "10/20", "reply": "10/20", "event": "20/40"})
+# Rejected frames in a row after which the connection is closed with 1008.
+WS_RATE_MAX_VIOLATIONS = int(os.getenv("WS_RATE_MAX_VIOLATIONS", "100"))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def category_of(message: Any) -> str:
+    """
+    The bucket a parsed frame (a dict or a frames model) is charged to: typing
+    and (un)subscribing are events, community replies are replies, anything else
+    counts as a message.
+    """
+    if isinstance(message, dict):
+        op, kind = message.get("op"), message.get("type")
+    else:
+        op, kind = getattr(message, "op", None), getattr(message, "type", None)
+    if op in ("subscribe", "unsubscribe") or kind == "typing":
+        return "event"
+    if kind == "reply":
+        return "reply"
+    return "message"
+
+
+class FrameLimiter:
+    """
+    Token buckets for inbound WebSocket frames, per connection and per user.
+    Connection buckets live on the connection; user buckets are shared by every
+    endpoint and dropped once full again, since a full bucket equals a new one.
+    """
+    def __init__(self):
+        self._users: Dict[Tuple[str, str], TokenBucket] = {}
+        self._pruned = time.monotonic()
+        self.rejected: Dict[str, int] = {category: 0 for category in CATEGORIES}
+
+    def allow(self, buckets: Dict[str, TokenBucket], user_id: Optional[str], category: str) -> Optional[TokenBucket]:
+        """
+        Spends one token of `category` from the connection's `buckets` and the user's.
+        Returns None if allowed, otherwise the bucket that ran out.
+        """
+        now = time.monotonic()
+        if now - self._pruned > 60:
+            self._prune(now)
+        rate, burst = CONNECTION_LIMITS[category]
+        if rate > 0:
+            bucket = buckets.get(category)
+            if bucket is None:
+                bucket = buckets[category] = TokenBucket(rate, burst, now)
+            if not bucket.take(now):
+                self.rejected[category] += 1
+                return bucket
+        rate, burst = USER_LIMITS[category]
+        if rate > 0 and user_id:
+            bucket = self._users.get((user_id, category))
+            if bucket is None:
+                bucket = self._users[(user_id, category)] = TokenBucket(rate, burst, now)
+            if not bucket.take(now):
+                self.rejected[category] += 1
+                return bucket
+        return None
+
+    def _prune(self, now: float):
+        self._pruned = now
+        for key, bucket in list(self._users.items()):
+            if bucket.full(now):
+                del self._users[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connection_limits": {category: f"{rate:g}/{burst:g}" for category, (rate, burst) in CONNECTION_LIMITS.items()},
+            "user_limits": {category: f"{rate:g}/{burst:g}" for category, (rate, burst) in USER_LIMITS.items()},
+            "user_buckets": len(self._users),
+            "rejected": dict(self.rejected),
+        }
+
+
+limiter = FrameLimiter()
+metrics.register("websockets.rate_limits", limiter.stats)
@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Frames kept per room, and across all rooms of one manager (least recently
+# active rooms are evicted first). 0 disables the buffer.
+WS_REPLAY_SIZE = int(os.getenv("WS_REPLAY_SIZE", "200"))
+WS_REPLAY_MAX_FRAMES = int(os.getenv("WS_REPLAY_MAX_FRAMES", "200000"))
+# Largest gap a resume may fill from the database once it aged out of the buffer.
+WS_REPLAY_DB_LIMIT = int(os.getenv("WS_REPLAY_DB_LIMIT", "200"))
+
+
+class ReplayBuffer:
+    """
+    Per-room ring buffers of the recent broadcast frames that carry an "id".
+
+    A buffer only answers for a room when it saw every message of the room since
+    its oldest frame; whoever learns of a message that bypassed it (a REST post,
+    a pub/sub outage, the room going unwatched on a multi-worker deployment)
+    invalidates the room, and the next resume falls back to the database.
+    REST routes run in the threadpool, so every operation takes the lock.
+    """
+    def __init__(self, name: str, per_room: int = WS_REPLAY_SIZE, max_frames: int = WS_REPLAY_MAX_FRAMES):
+        self.name = name
+        self.per_room = per_room
+        self.max_frames = max_frames
+        self._rooms: "OrderedDict[str, Deque[Tuple[str, Any]]]" = OrderedDict()
+        self._frames = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.replayed = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def record(self, room_id: str, message_id: str, frame: Any):
+        if not self.per_room or not self.max_frames:
+            return
+        with self._lock:
+            frames = self._rooms.get(room_id)
+            if frames is None:
+                frames = self._rooms[room_id] = deque(maxlen=self.per_room)
+            else:
+                self._rooms.move_to_end(room_id)
+            if len(frames) < self.per_room:
+                self._frames += 1
+            frames.append((message_id, frame))
+            while self._frames > self.max_frames:
+                _, evicted = self._rooms.popitem(last=False)
+                self._frames -= len(evicted)
+                self.evictions += 1
+
+    def since(self, room_id: str, last_id: str) -> Optional[List[Any]]:
+        """
+        Returns the frames broadcast in the room after `last_id`, oldest first,
+        or None if `last_id` is no longer (or was never) in the room's buffer.
+        """
+        with self._lock:
+            frames = self._rooms.get(room_id)
+            if frames is not None:
+                for index, (message_id, _) in enumerate(frames):
+                    if message_id == last_id:
+                        gap = [frame for _, frame in list(frames)[index + 1:]]
+                        self.hits += 1
+                        self.replayed += len(gap)
+                        return gap
+            self.misses += 1
+            return None
+
+    def invalidate(self, room_id: str):
+        with self._lock:
+            frames = self._rooms.pop(room_id, None)
+            if frames is not None:
+                self._frames -= len(frames)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._rooms)
+            self._rooms.clear()
+            self._frames = 0
+
+    def stats(self) -> Dict[str, Any]:
+        resumes = self.hits + self.misses
+        return {
+            "rooms": len(self._rooms),
+            "frames": self._frames,
+            "per_room": self.per_room,
+            "max_frames": self.max_frames,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / resumes, 4) if resumes else 0.0,
+            "replayed": self.replayed,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,136 @@
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from fastapi import WebSocket, WebSocketDisconnect
+from sqlalchemy.orm import Session
+import crud
+from database import scoped_session
+from proj_websockets import chat_ws, community_ws, frames, ratelimit
+from proj_websockets.manager import ConnectionManager, valid_room_id
+
+load_dotenv()
+
+WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "200"))
+
+# Rooms of the multiplexed endpoint are indexed by user id, so every socket of
+# a user can be reached with manager.broadcast(payload, user_id).
+manager = ConnectionManager("user")
+
+
+def _can_join_chat(db: Session, user, conversation_id: str) -> bool:
+    return crud.is_conversation_participant(db, user.id, conversation_id)
+
+
+def _can_join_community(db: Session, user, community_id: str) -> bool:
+    # Anyone authenticated may listen; posting checks membership.
+    return crud.get_community(db=db, community_id=community_id) is not None
+
+
+# "<kind>:<id>" -> (room manager, subscribe check, frame processor, resume gap loader)
+ROOM_KINDS: Dict[str, Tuple[ConnectionManager, Callable[..., bool], Callable[..., Awaitable[None]], Callable[..., Optional[List[Dict[str, Any]]]]]] = {
+    "chat": (chat_ws.manager, _can_join_chat, chat_ws.process_chat_frame, chat_ws.load_gap),
+    "community": (community_ws.manager, _can_join_community, community_ws.process_community_frame, community_ws.load_gap),
+}
+
+
+async def handle_user_websocket(websocket: WebSocket):
+    """
+    Handles one multiplexed WebSocket per user, across conversations and communities.
+    The user was authenticated during the handshake (websocket.state.user).
+    Rooms are named "chat:<conversation_id>" or "community:<community_id>".
+    Expected incoming frames (JSON):
+    {"op": "subscribe", "room": "chat:<id>", "last_id": "<optional last message id seen>"}
+    {"op": "unsubscribe", "room": "chat:<id>"}
+    {"op": "send", "room": "chat:<id>", "content": "..."}
+    {"op": "send", "room": "community:<id>", "type": "message" | "reply", "content": "...", "message_id": "..."}
+    {"op": "send", "room": "chat:<id>", "type": "typing"}
+    Frames may also be sent as MessagePack in binary frames (see frames.MuxFrame).
+    Subscriptions are acknowledged with {"type": "subscribed" | "unsubscribed", "room": ...};
+    problems with {"type": "error", "room": ..., "detail": ...}. Room broadcasts are the
+    same frames the per-room endpoints send and carry their conversation_id or community_id.
+    With "last_id", the messages missed since then are queued right after the ack,
+    or {"type": "resync", "room": ...} if the client must refetch the history.
+    Each subscribe or send borrows its own DB session for as long as it runs.
+    """
+    user = websocket.state.user
+    user_id = str(user.id)
+    connection = await manager.accept(websocket)
+    if connection is None:
+        return
+    manager.join(connection, user_id)
+
+    async def send(payload: Dict[str, Any]):
+        await manager.send_personal_message(payload, websocket)
+
+    try:
+        while True:
+            data = await frames.receive(websocket)
+            manager.touch(websocket)
+            if not await manager.allow(websocket, "frame"):
+                continue
+            try:
+                frame = frames.decode(frames.mux_frames, data)
+            except frames.FrameError as e:
+                await manager.send_personal_message(frames.error_frame(e.detail, None, multiplexed=True), websocket)
+                continue
+            if await manager.handle_heartbeat(websocket, frame):
+                continue
+            if not await manager.allow(websocket, ratelimit.category_of(frame)):
+                continue
+
+            op = frame.op
+            room = frame.room
+            kind, _, room_id = room.partition(":")
+            if kind not in ROOM_KINDS or not valid_room_id(room_id):
+                await send({"type": "error", "room": room, "detail": "Unknown room. Expected 'chat:<id>' or 'community:<id>'."})
+                continue
+            room_manager, can_join, process, load_gap = ROOM_KINDS[kind]
+            subscribed = (room_manager, room_id) in connection.rooms
+
+            async def reply(text: str):
+                await manager.send_personal_message(frames.error_frame(text, room, multiplexed=True), websocket)
+
+            try:
+                if op == "subscribe":
+                    if not subscribed:
+                        if len(connection.rooms) > WS_MAX_SUBSCRIPTIONS:
+                            await reply("Too many subscriptions on this connection.")
+                            continue
+                        with scoped_session("ws.subscribe") as db:
+                            allowed = can_join(db, user, room_id)
+                        if not allowed:
+                            await reply("Room not found or not accessible.")
+                            continue
+                        if not room_manager.join(connection, room_id):
+                            await reply("Too many connections for this room.")
+                            continue
+                    await send({"type": "subscribed", "room": room})
+                    last_id = frame.last_id
+                    if last_id:
+                        with scoped_session("ws.resume") as db:
+                            resumed = room_manager.resume(websocket, room_id, str(last_id), lambda: load_gap(db, room_id, str(last_id)))
+                        if not resumed:
+                            await send({"type": "resync", "room": room})
+                elif op == "unsubscribe":
+                    room_manager.leave(connection, room_id)
+                    await send({"type": "unsubscribed", "room": room})
+                elif op == "send":
+                    if not subscribed:
+                        await reply("Subscribe to the room first.")
+                        continue
+                    with scoped_session(f"ws.{kind}") as db:
+                        await process(db, user, room_id, frame, reply)
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                print(f"WebSocket error in {room} for user {user_id}: {e}")
+                await send({"type": "error", "room": room, "detail": f"An error occurred: {e}"})
+
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"An error occurred in user_websocket: {e}")
+        await manager.close(websocket, code=1011, reason=f"Server error: {e}")
+    finally:
+        # Leaves every subscribed room as well as the user's own entry.
+        manager.disconnect(websocket, user_id)
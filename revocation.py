@@ -0,0 +1,247 @@
+import os
+import math
+import time
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+import models
+import metrics
+from database import SessionLocal
+
+load_dotenv()
+
+TOKEN_LIFETIME_SECONDS = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30")) * 60
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", "5"))
+# Rows are stamped with the writer's clock before they commit, so one can become
+# visible after a newer row was already synced. Each sync re-reads this many
+# seconds before the newest row seen and skips the rows it already applied.
+REVOCATION_SYNC_OVERLAP = float(os.getenv("REVOCATION_SYNC_OVERLAP", "60"))
+REVOCATION_FILTER_CAPACITY = int(os.getenv("REVOCATION_FILTER_CAPACITY", "100000"))
+REVOCATION_FILTER_ERROR_RATE = float(os.getenv("REVOCATION_FILTER_ERROR_RATE", "0.001"))
+
+# Seconds past a user's stale mark during which newly issued tokens are still distrusted.
+STALE_CLAIMS_MARGIN = 1.0
+
+
+def _epoch(value: datetime) -> float:
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings.
+    Sized for `capacity` entries at roughly `error_rate` false positives.
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationFilter:
+    """
+    In-memory view of the token_revocation table.
+
+    Revoked token ids live in two Bloom filter generations that rotate every
+    token lifetime, so entries for tokens that have expired anyway fall out
+    without deletes. A positive answer is confirmed against the database.
+
+    Users whose claims went stale (profile update, deactivation, deletion) are
+    kept as user_id -> timestamp; tokens issued before that moment are resolved
+    through the database instead of being trusted.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = BloomFilter(REVOCATION_FILTER_CAPACITY, REVOCATION_FILTER_ERROR_RATE)
+        self._previous = BloomFilter(REVOCATION_FILTER_CAPACITY, REVOCATION_FILTER_ERROR_RATE)
+        self._rotated_at = time.time()
+        self._stale_users: Dict[str, float] = {}
+        # Row id -> revoked_at of the rows applied within the overlap window.
+        self._applied: Dict[str, datetime] = {}
+        self.last_synced: Optional[datetime] = None
+        self.confirmed = 0
+        self.false_positives = 0
+
+    def _rotate_if_needed(self):
+        if time.time() - self._rotated_at >= TOKEN_LIFETIME_SECONDS:
+            self._previous = self._current
+            self._current = BloomFilter(REVOCATION_FILTER_CAPACITY, REVOCATION_FILTER_ERROR_RATE)
+            self._rotated_at = time.time()
+
+    def add_jti(self, jti: str):
+        with self._lock:
+            self._rotate_if_needed()
+            self._current.add(jti)
+
+    def mark_user(self, user_id: str, at: float):
+        with self._lock:
+            self._stale_users[user_id] = max(at, self._stale_users.get(user_id, 0.0))
+
+    def might_be_revoked(self, jti: str) -> bool:
+        return jti in self._current or jti in self._previous
+
+    def claims_stale(self, user_id: str, issued_at: float) -> bool:
+        stale_since = self._stale_users.get(user_id)
+        # revoked_at is stored as a plain DATETIME, which MySQL rounds to the second,
+        # so a token issued up to a second after a synced mark may predate it.
+        return stale_since is not None and issued_at <= stale_since + STALE_CLAIMS_MARGIN
+
+    def apply(self, row: models.TokenRevocation):
+        if row.jti:
+            self.add_jti(str(row.jti))
+        if row.user_id:
+            self.mark_user(str(row.user_id), _epoch(row.revoked_at)) # type: ignore
+
+    def applied(self, row_id: str, revoked_at: datetime):
+        """
+        Records that a row was applied, so the next syncs skip it.
+        """
+        with self._lock:
+            self._applied[row_id] = revoked_at
+
+    def sync(self, db: Session):
+        """
+        Applies revocations recorded by any worker since the previous sync.
+        """
+        if self.last_synced is None:
+            since = datetime.utcnow() - timedelta(seconds=TOKEN_LIFETIME_SECONDS)
+        else:
+            since = self.last_synced - timedelta(seconds=REVOCATION_SYNC_OVERLAP)
+        rows = db.query(models.TokenRevocation)\
+            .filter(models.TokenRevocation.revoked_at >= since)\
+            .order_by(models.TokenRevocation.revoked_at).all()
+        for row in rows:
+            if str(row.id) not in self._applied:
+                self.apply(row)
+                self.applied(str(row.id), row.revoked_at) # type: ignore
+            if self.last_synced is None or row.revoked_at > self.last_synced:
+                self.last_synced = row.revoked_at # type: ignore
+        if self.last_synced is None:
+            self.last_synced = since
+        # Rows older than the next sync's window will not be read again.
+        floor = self.last_synced - timedelta(seconds=REVOCATION_SYNC_OVERLAP)
+        horizon = time.time() - TOKEN_LIFETIME_SECONDS
+        with self._lock:
+            self._rotate_if_needed()
+            for user_id in [u for u, at in self._stale_users.items() if at < horizon]:
+                del self._stale_users[user_id]
+            for row_id in [r for r, at in self._applied.items() if at < floor]:
+                del self._applied[row_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "filter_bits": self._current.size,
+            "filter_hashes": self._current.hashes,
+            "revoked_tokens": self._current.count + self._previous.count,
+            "stale_users": len(self._stale_users),
+            "confirmed_revocations": self.confirmed,
+            "false_positives": self.false_positives,
+            "last_synced": self.last_synced.isoformat() if self.last_synced else None,
+        }
+
+
+revocations = RevocationFilter()
+metrics.register("token_revocation", revocations.stats)
+
+
+def revoke_token(db: Session, jti: str, expires_at: datetime):
+    """
+    Revokes a single access token, e.g. on logout.
+    """
+    row_id, now = str(uuid.uuid4()), datetime.utcnow()
+    db.add(models.TokenRevocation(id=row_id, jti=jti, revoked_at=now, expires_at=expires_at))
+    db.commit()
+    revocations.add_jti(jti)
+    revocations.applied(row_id, now)
+
+
+def mark_user_changed(db: Session, user_id: str):
+    """
+    Records that tokens issued to `user_id` until now carry stale claims.
+    """
+    row_id, now = str(uuid.uuid4()), datetime.utcnow()
+    db.add(models.TokenRevocation(
+        id=row_id,
+        user_id=str(user_id),
+        revoked_at=now,
+        expires_at=now + timedelta(seconds=TOKEN_LIFETIME_SECONDS),
+    ))
+    db.commit()
+    revocations.mark_user(str(user_id), _epoch(now))
+    revocations.applied(row_id, now)
+
+
+def is_token_revoked(db: Session, jti: Optional[str]) -> bool:
+    """
+    Checks a token id against the filter, confirming positives in the database.
+    """
+    if not jti or not revocations.might_be_revoked(jti):
+        return False
+    revoked = db.query(models.TokenRevocation.id).filter(models.TokenRevocation.jti == jti).first() is not None
+    if revoked:
+        revocations.confirmed += 1
+    else:
+        revocations.false_positives += 1
+    return revoked
+
+
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def _sync_loop():
+    last_cleanup = time.monotonic()
+    while True:
+        db = SessionLocal()
+        try:
+            revocations.sync(db)
+            if time.monotonic() - last_cleanup >= TOKEN_LIFETIME_SECONDS:
+                # Rows outlive the tokens they refer to only by one lifetime.
+                db.query(models.TokenRevocation)\
+                    .filter(models.TokenRevocation.expires_at < datetime.utcnow())\
+                    .delete(synchronize_session=False)
+                db.commit()
+                last_cleanup = time.monotonic()
+        except Exception as e:
+            print(f"Token revocation sync failed: {e}")
+        finally:
+            db.close()
+        if _stop.wait(REVOCATION_SYNC_INTERVAL):
+            return
+
+
+def start_sync():
+    """
+    Starts the background thread that keeps this worker's filter in sync.
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_sync_loop, name="revocation-sync", daemon=True)
+    _thread.start()
+
+
+def stop_sync():
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=REVOCATION_SYNC_INTERVAL)
@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from sqlalchemy.orm import Session
-from typing import List, Dict
+from typing import List, Dict, Optional
 from datetime import datetime
 import schemas, models, crud, auth
-from database import get_db
+from database import get_db, scoped_session, MAX_PAGE_SIZE
+from proj_websockets import chat_ws, events
+from proj_websockets.manager import valid_room_id
 import secrets
+import etags
 
 router = APIRouter(
     prefix="",
@@ -26,13 +29,23 @@ def create_conversation_route(
 
 
 @router.get("/conversations/{conversation_id}", response_model=schemas.ConversationOut)
-def read_conversation_route(conversation_id: str, db: Session = Depends(get_db)):
+def read_conversation_route(conversation_id: str, request: Request, response: Response, db: Session = Depends(get_db)):
     """
-    Get a specific conversation by ID.
+    Get a specific conversation by ID. Sends an ETag; If-None-Match is answered
+    with 304 from one column query, before the conversation and its users are loaded.
     """
+    version = crud.get_conversation_version(db=db, conversation_id=conversation_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    not_modified = etags.conditional(request, response, etags.make_etag(conversation_id, *version))
+    if not_modified is not None:
+        return not_modified
     conversation = crud.get_conversation(db=db, conversation_id=conversation_id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    if conversation.updated_at != version[0]:
+        # A cached copy predating a write through another worker; the body must match the ETag.
+        db.refresh(conversation)
     return conversation
 
 
@@ -87,8 +100,13 @@ def create_message_route(
     
     if str(current_user.id) != str(message.sender_id):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to send message as this user")
+    if not crud.is_conversation_participant(db, current_user.id, message.conversation_id): # type: ignore
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a participant of this conversation")
 
-    return crud.create_message(db=db, message=message)
+    db_message = crud.create_message(db=db, message=message)
+    # Not broadcast, so WebSocket resumes must not trust the room's replay buffers.
+    chat_ws.manager.invalidate_replay(str(message.conversation_id))
+    return db_message
 
 
 @router.get("/messages/{message_id}", response_model=schemas.OneToOneMessageOut)
@@ -103,11 +121,34 @@ def read_message_route(message_id: str, db: Session = Depends(get_db)):
 
 
 @router.get("/messages/conversation/{conversation_id}", response_model=List[schemas.OneToOneMessageOut])
-def read_messages_by_conversation_route(conversation_id: str, db: Session = Depends(get_db)):
+def read_messages_by_conversation_route(
+    conversation_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_db),
+):
     """
-    Get all messages for a specific conversation.
+    Get all messages for a specific conversation, oldest first,
+    or only the newest `limit` ones (at most MAX_PAGE_SIZE).
     """
-    return crud.get_messages_by_conversation(db=db, conversation_id=conversation_id)
+    return crud.get_recent_messages(db=db, conversation_id=conversation_id, limit=limit)
+
+
+@router.get("/conversations/{conversation_id}/events/")
+def conversation_events_route(conversation_id: str, request: Request):
+    """
+    Server-Sent Events feed of a conversation for its participants, carrying the
+    frames of /ws/chat/{conversation_id}/. Authenticate with ?token= (EventSource
+    cannot set headers); reconnecting with Last-Event-ID resumes after the last event.
+    The DB session is only held for the access check.
+    """
+    if not valid_room_id(conversation_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+    with scoped_session("sse.join") as db:
+        user = auth.authenticate_event_stream(request, db)
+        allowed = crud.is_conversation_participant(db, user.id, conversation_id)
+    if not allowed:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a participant of this conversation")
+    return events.stream_room(request, chat_ws.manager, conversation_id, chat_ws.load_gap)
 
 
 @router.delete("/messages/{message_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -115,9 +156,15 @@ def delete_message_route(message_id: str, db: Session = Depends(get_db)):
     """
     Delete a message by ID.
     """
+    message = crud.get_message(db=db, message_id=message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    conversation_id = str(message.conversation_id)
     success = crud.delete_message(db=db, message_id=message_id)
     if not success:
         raise HTTPException(status_code=404, detail="Message not found")
+    # Resumes from a replay buffer would still send the deleted message.
+    chat_ws.manager.invalidate_replay(conversation_id)
     return {"detail": "Message deleted successfully"}
 
 @router.post("/requests/", response_model=schemas.ConversationRequestOut)
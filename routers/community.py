@@ -1,9 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import schemas, models, crud, auth
-from database import get_db
+from database import get_db, scoped_session, MAX_PAGE_SIZE
+from proj_websockets import community_ws, events
+from proj_websockets.manager import valid_room_id
 from fastapi import Response
+import etags
 
 router = APIRouter(
     prefix="",
@@ -62,19 +65,25 @@ def create_community_route(
 @router.get("/{community_id}/details/", response_model=schemas.CommunityOut)
 def get_community_details_route(
     community_id: str,
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     """
     Get details of a specific community, including its member count.
+    Sends an ETag and answers If-None-Match with 304 when the community is unchanged.
     """
-    community = crud.get_community(db=db, community_id=community_id)
-    if not community:
+    row = crud.get_community_row(db=db, community_id=community_id)
+    if not row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Community not found")
-    
+
     # member_count = crud.get_community_member_count(db, community_id)
     # return {"community": schemas.CommunityOut.from_orm(community), "member_count": member_count}
-    
-    return community
+
+    not_modified = etags.conditional(request, response, etags.make_etag(*row))
+    if not_modified is not None:
+        return not_modified
+    return schemas.CommunityOut.model_validate(row)
 
 @router.post("/{community_id}/join/", response_model=schemas.MembershipOut, status_code=status.HTTP_201_CREATED)
 def join_community_route(
@@ -122,6 +131,8 @@ def send_community_message_route(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not a member of this community")
 
     db_message = crud.create_community_message(db=db, message=message_create)
+    # Not broadcast, so WebSocket resumes must not trust the room's replay buffers.
+    community_ws.manager.invalidate_replay(str(message_create.community_id))
     return db_message
 
 
@@ -146,28 +157,62 @@ def send_reply_route(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not a member of this community")
 
     db_reply = crud.create_reply(db=db, reply=reply_create)
+    community_ws.manager.invalidate_replay(str(message.community_id))
     return db_reply
 
 
 @router.get("/{community_id}/discussion/", response_model=List[schemas.CommunityMessageOut])
 def get_community_discussion_route(
     community_id: str,
-    skip: int = 0,
-    limit: int = 20,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
     db: Session = Depends(get_db)
 ):
     """
     Get paginated discussion (messages and their replies) for a specific community.
     Messages are ordered from newest to oldest.
+    Sends an ETag over the page; If-None-Match is answered with 304 without
+    serializing it (the first page usually comes from the recent-messages cache).
     """
-    community = crud.get_community(db, community_id)
+    community = crud.get_community_row(db, community_id)
     if not community:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Community not found")
-    
-    messages = crud.get_community_discussion_paginated(db=db, community_id=community_id, skip=skip, limit=limit)
+
+    if skip == 0:
+        messages = crud.get_recent_community_messages(db=db, community_id=community_id, limit=limit)
+    else:
+        messages = crud.get_community_discussion_paginated(db=db, community_id=community_id, skip=skip, limit=limit)
+    etag = etags.make_etag(tuple(community), [
+        (message.id, message.updated_at, message.content, message.sender_id,
+         (message.sender_obj.email, message.sender_obj.name, message.sender_obj.profile_picture,
+          message.sender_obj.is_staff, message.sender_obj.is_active) if message.sender_obj else None)
+        for message in messages
+    ])
+    not_modified = etags.conditional(request, response, etag)
+    if not_modified is not None:
+        return not_modified
     return messages
 
 
+@router.get("/{community_id}/events/")
+def community_events_route(community_id: str, request: Request):
+    """
+    Server-Sent Events feed of a community's messages and replies, for readers
+    who do not post. Events carry the frames of /ws/community/{community_id}/;
+    reconnecting with Last-Event-ID resumes after the last event received.
+    The DB session is only held for the existence check.
+    """
+    if not valid_room_id(community_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Community not found")
+    with scoped_session("sse.join") as db:
+        community = crud.get_community(db=db, community_id=community_id)
+    if not community:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Community not found")
+    return events.stream_room(request, community_ws.manager, community_id, community_ws.load_gap)
+
+
 @router.get("/{community_id}/users/search/", response_model=List[schemas.UserOut])
 def search_community_users_route(
     community_id: str,
@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Header, HTTPException, status, Query
+from typing import Optional
+import asyncio
+import profiling
+
+router = APIRouter(
+    prefix="",
+    tags=["Debug"],
+)
+
+@router.post("/profile")
+async def profile_window_route(
+    seconds: float = Query(10, gt=0, le=profiling.PROFILER_MAX_SECONDS),
+    x_profile: Optional[str] = Header(None),
+):
+    """
+    Sample every thread in this worker for a time window and write a collapsed-stack profile.
+    Requires the `X-Profile` header to match PROFILER_TOKEN.
+    """
+    if not profiling.is_authorized(x_profile):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to profile")
+
+    sampler = profiling.profile_window_start()
+    await asyncio.sleep(seconds)
+    path = profiling.profile_window_finish(sampler)
+    return {"path": path, "samples": sum(sampler.samples.values())}
@@ -1,9 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Response
 from sqlalchemy.orm import Session
 from typing import List
+from datetime import datetime
 import schemas, models, crud, auth
 from database import get_db
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
+import passwords
+import revocation
+import etags
 
 router = APIRouter(
     prefix="",
@@ -11,17 +16,18 @@ router = APIRouter(
 )
 
 @router.post("/", response_model=schemas.UserOut, status_code=status.HTTP_201_CREATED)
-def create_user_route(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_user_route(user: schemas.UserCreate, db: Session = Depends(get_db)):
     """
     Create a new user.
     """
-    existing_user = crud.get_user_by_email(db, email=user.email)
+    existing_user = await run_in_threadpool(crud.get_user_by_email, db, email=user.email)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
-    return crud.create_user(db=db, user=user)
+    password_hash = await passwords.hash_password(user.password)
+    return await run_in_threadpool(crud.create_user, db=db, user=user, password_hash=password_hash)
 
 
 @router.get("/", response_model=List[schemas.UserOut])
@@ -42,14 +48,18 @@ def read_current_user(current_user: models.User = Depends(auth.get_current_activ
 
 
 @router.get("/{user_id}", response_model=schemas.UserOut)
-def read_user(user_id: str, db: Session = Depends(get_db)):
+def read_user(user_id: str, request: Request, response: Response, db: Session = Depends(get_db)):
     """
-    Get a user by ID.
+    Get a user by ID. Sends an ETag and answers If-None-Match with 304 when
+    the user is unchanged.
     """
-    db_user = crud.get_user(db, user_id=user_id)
-    if not db_user:
+    row = crud.get_user_row(db, user_id=user_id)
+    if not row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    return db_user
+    not_modified = etags.conditional(request, response, etags.make_etag(*row))
+    if not_modified is not None:
+        return not_modified
+    return schemas.UserOut.model_validate(row)
 
 
 @router.put("/{user_id}", response_model=schemas.UserOut)
@@ -87,7 +97,7 @@ def delete_user_route(
     return {"detail": "User deleted successfully"}
 
 @router.post("/token", response_model=schemas.Token)
-def login_for_access_token(
+async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db)
 ):
@@ -97,16 +107,26 @@ def login_for_access_token(
     Returns:
         {"access_token": "JWT_TOKEN", "token_type": "bearer"}
     """
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+    user = await auth.authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = auth.create_access_token(data={"sub": user.email})
+    access_token = auth.create_user_access_token(user)
     return {"access_token": access_token, "token_type": "bearer"}
 
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout_route(token: str = Depends(auth.oauth2_scheme), db: Session = Depends(get_db)):
+    """
+    Revoke the access token used for this request.
+    """
+    payload = auth.decode_token(token)
+    if payload.get("jti"):
+        revocation.revoke_token(db, payload["jti"], datetime.utcfromtimestamp(payload["exp"]))
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 # @router.post("/token", response_model=schemas.Token)
 # def login_for_access_token(
 #     login_request: schemas.LoginRequest,
@@ -0,0 +1,15 @@
+"""
+Unit tests for the in-memory caches and the revocation filter. Run from the
+repository root with `python -m pytest -q`; no MySQL server is needed.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# database.py creates its engine at import time, so this runs before any test module imports it.
+from benchmarks.common import use_embedded_db
+
+use_embedded_db()
@@ -0,0 +1,161 @@
+from cache import EntityCache, MembershipCache, RecentMessagesCache
+
+
+def recent_cache(per_room: int = 3, max_entries: int = 100) -> RecentMessagesCache:
+    return RecentMessagesCache("test_recent", per_room=per_room, max_entries=max_entries, ttl=60, key=lambda item: item)
+
+
+def test_entity_cache_serves_loaded_value():
+    cache = EntityCache("test_entities", maxsize=10, ttl=60)
+    loads = []
+    assert cache.get_or_load("a", lambda: loads.append(1) or "row") == "row"
+    assert cache.get_or_load("a", lambda: loads.append(1) or "other") == "row"
+    assert len(loads) == 1
+
+
+def test_entity_cache_skips_value_invalidated_during_load():
+    cache = EntityCache("test_entities", maxsize=10, ttl=60)
+
+    def load():
+        cache.invalidate("a")
+        return "old"
+
+    assert cache.get_or_load("a", load) == "old"
+    assert cache.get_or_load("a", lambda: "new") == "new"
+    assert cache.get_or_load("a", lambda: "newer") == "new"
+
+
+def test_entity_cache_skips_value_cleared_during_load():
+    cache = EntityCache("test_entities", maxsize=10, ttl=60)
+
+    def load():
+        cache.clear()
+        return "old"
+
+    cache.get_or_load("a", load)
+    assert cache.get_or_load("a", lambda: "new") == "new"
+
+
+def test_entity_cache_does_not_cache_missing_rows():
+    cache = EntityCache("test_entities", maxsize=10, ttl=60)
+    assert cache.get_or_load("a", lambda: None) is None
+    assert cache.get_or_load("a", lambda: "row") == "row"
+
+
+def test_recent_messages_skips_room_written_during_load():
+    cache = recent_cache()
+
+    def load(count):
+        cache.append("room", lambda: 3)
+        return [1, 2]
+
+    assert cache.get("room", 2, load) == [1, 2]
+    assert cache.stats()["rooms"] == 0
+    assert cache.get("room", 2, lambda count: [2, 3]) == [2, 3]
+    assert cache.stats()["rooms"] == 1
+
+
+def test_recent_messages_skips_room_dropped_during_load():
+    cache = recent_cache()
+
+    def load(count):
+        cache.drop("room")
+        return [1]
+
+    cache.get("room", 1, load)
+    assert cache.stats()["rooms"] == 0
+
+
+def test_recent_messages_answers_from_loaded_room():
+    cache = recent_cache(per_room=3)
+    assert cache.get("room", None, lambda count: [1, 2]) == [1, 2]
+    cache.append("room", lambda: 3)
+    assert cache.get("room", None, lambda count: []) == [1, 2, 3]
+    cache.append("room", lambda: 4)
+    # The oldest message fell out, so only bounded reads can be answered now.
+    assert cache.get("room", None, lambda count: []) is None
+    assert cache.get("room", 3, lambda count: []) == [2, 3, 4]
+    assert cache.get("room", 4, lambda count: []) is None
+
+
+def test_recent_messages_bounds_entries():
+    cache = recent_cache(per_room=3, max_entries=5)
+    cache.get("a", 1, lambda count: [1, 2, 3])
+    cache.get("b", 1, lambda count: [1, 2, 3])
+    stats = cache.stats()
+    assert stats["entries"] <= 5
+    assert stats["rooms"] == 1 and stats["evictions"] == 1
+
+
+def test_recent_messages_counts_empty_rooms():
+    cache = recent_cache(max_entries=3)
+    for room_id in ("a", "b", "c", "d", "e"):
+        assert cache.get(room_id, 1, lambda count: []) == []
+    stats = cache.stats()
+    assert stats["rooms"] == 3 and stats["entries"] == 3 and stats["evictions"] == 2
+
+
+def test_recent_messages_appends_keep_entries_in_step():
+    cache = recent_cache(per_room=2, max_entries=100)
+    cache.get("room", 1, lambda count: [])
+    cache.append("room", lambda: 1)
+    cache.append("room", lambda: 2)
+    cache.append("room", lambda: 3)
+    assert cache.stats()["entries"] == 2
+    cache.drop("room")
+    assert cache.stats()["entries"] == 0
+
+
+def test_membership_rechecks_cached_no():
+    cache = MembershipCache("test_members", max_entries=100, ttl=60)
+    members = {"a"}
+    load = lambda limit: members
+    confirm_calls = []
+
+    def confirm(user_id):
+        def check():
+            confirm_calls.append(user_id)
+            return user_id in members
+        return check
+
+    assert cache.contains("room", "b", load, confirm("b")) is False
+    # Added through another worker: the cached set does not have it, the database does.
+    members.add("b")
+    assert cache.contains("room", "b", load, confirm("b")) is True
+    assert cache.contains("room", "b", load, confirm("b")) is True
+    assert confirm_calls == ["b", "b"]
+
+
+def test_membership_counts_empty_rooms():
+    cache = MembershipCache("test_members", max_entries=3, ttl=60)
+    for room_id in ("a", "b", "c", "d", "e"):
+        assert cache.contains(room_id, "u", lambda limit: [], lambda: False) is False
+    stats = cache.stats()
+    assert stats["rooms"] == 3 and stats["entries"] == 3 and stats["evictions"] == 2
+
+
+def test_membership_checks_oversized_rooms_one_user_at_a_time():
+    cache = MembershipCache("test_members", max_entries=2, ttl=60)
+    limits = []
+
+    def load(limit):
+        limits.append(limit)
+        return ["a", "b", "c"][:limit]
+
+    assert cache.contains("room", "a", load, lambda: False) is True
+    assert cache.contains("room", "c", load, lambda: True) is True
+    assert cache.contains("room", "d", load, lambda: False) is False
+    assert limits == [3]
+    stats = cache.stats()
+    assert stats["oversized"] == 1 and stats["entries"] == 1
+
+
+def test_membership_skips_room_written_during_load():
+    cache = MembershipCache("test_members", max_entries=100, ttl=60)
+
+    def load(limit):
+        cache.remove("room", "a")
+        return ["a"]
+
+    cache.contains("room", "a", load, lambda: False)
+    assert cache.stats()["rooms"] == 0
@@ -0,0 +1,52 @@
+import revocation
+from revocation import BloomFilter, RevocationFilter, STALE_CLAIMS_MARGIN
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [f"jti-{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert sum(f"other-{i}" in bloom for i in range(1000)) < 50
+
+
+def test_revocation_filter_keeps_one_previous_generation():
+    revocations = RevocationFilter()
+    revocations.add_jti("old")
+    revocations._rotated_at -= revocation.TOKEN_LIFETIME_SECONDS
+    revocations.add_jti("new")
+    # The first rotation moves "old" to the previous generation: its token may not have expired yet.
+    assert revocations.might_be_revoked("old")
+    assert revocations.might_be_revoked("new")
+    revocations._rotated_at -= revocation.TOKEN_LIFETIME_SECONDS
+    revocations.add_jti("newest")
+    assert not revocations.might_be_revoked("old")
+    assert revocations.might_be_revoked("new")
+    assert revocations.might_be_revoked("newest")
+
+
+def test_revocation_filter_does_not_rotate_early():
+    revocations = RevocationFilter()
+    revocations.add_jti("a")
+    revocations._rotated_at -= revocation.TOKEN_LIFETIME_SECONDS - 60
+    revocations.add_jti("b")
+    assert revocations._current.count == 2 and revocations._previous.count == 0
+
+
+def test_claims_stale_boundary():
+    revocations = RevocationFilter()
+    assert not revocations.claims_stale("user", 100.0)
+    revocations.mark_user("user", 100.0)
+    assert revocations.claims_stale("user", 50.0)
+    assert revocations.claims_stale("user", 100.0)
+    assert revocations.claims_stale("user", 100.0 + STALE_CLAIMS_MARGIN)
+    assert not revocations.claims_stale("user", 100.0 + STALE_CLAIMS_MARGIN + 0.001)
+    assert not revocations.claims_stale("other", 50.0)
+
+
+def test_claims_stale_keeps_latest_mark():
+    revocations = RevocationFilter()
+    revocations.mark_user("user", 200.0)
+    revocations.mark_user("user", 100.0)
+    assert revocations.claims_stale("user", 150.0)